@@ -0,0 +1,138 @@
+##	PETRcache.py [module]
+##
+# On-disk cache of sentence coding results for the PETRARCH event coder
+#
+# Wire stories are reprinted and re-scraped, so the same sentence, with the same parse,
+# turns up many times in a large batch and in batch after batch. What
+# PETRtree.Sentence.get_events() returns depends only on the parse, the dictionaries,
+# a couple of options and the sentence date -- and the date only through the actor and
+# agent date restrictions. ResultCache keeps those results in an SQLite file keyed by
+# a hash of all of these, so that code_story() can skip building and walking the tree
+# for a sentence it has coded before.
+#
+# The date goes into the key as its bucket: the number of actor and agent date bounds
+# at or before it. Two dates in the same bucket fall inside exactly the same date
+# restrictions, so a sentence repeated on different days of the same period is still
+# a hit.
+#
+# This code is covered under the MIT license
+# ------------------------------------------------------------------------
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import pickle
+import sqlite3
+import hashlib
+import logging
+from bisect import bisect_right
+
+import PETRglobals
+import PETRreader
+
+
+class ResultCache(object):
+    """
+    The coded events, metadata and sentence text of parsed sentences, stored in the
+    SQLite file path for the dictionaries identified by version.
+    """
+
+    def __init__(self, path, version):
+        self.path = path
+        self.version = version
+        self.connection = sqlite3.connect(path, timeout=60)
+        # a lost or stale result is only recomputed, so durability is not needed
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=OFF')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS results '
+                                '(key BLOB PRIMARY KEY, value BLOB)')
+        self.connection.commit()
+        self.bounds = date_bounds()
+        self.pending = 0
+
+    def key(self, parse, date):
+        """
+        The cache key of a sentence with the parse parse on date: the formatted parse
+        string or, for a parse read from a tree structure, its list of elements. Either
+        way the key is made from the elements, so a parse has the same key in both forms.
+        """
+        parse = ' '.join(parse if isinstance(parse, list) else parse.split())
+        if self.bounds is not None:
+            date = bisect_right(self.bounds, date)
+        sha = hashlib.sha1()
+        sha.update('{}\0{}\0{}\0'.format(self.version, date,
+                                         PETRglobals.NewActorLength).encode('utf-8'))
+        sha.update(parse.encode('utf-8'))
+        return sqlite3.Binary(sha.digest())
+
+    def get(self, key):
+        """ The (events, meta, text) stored under key, or None. """
+        row = self.connection.execute('SELECT value FROM results WHERE key = ?',
+                                      (key,)).fetchone()
+        if row is None:
+            return None
+        return pickle.loads(bytes(row[0]))
+
+    def put(self, key, result):
+        """ Stores result, an (events, meta, text) tuple, under key. """
+        self.connection.execute(
+            'INSERT OR REPLACE INTO results VALUES (?, ?)',
+            (key, sqlite3.Binary(pickle.dumps(result, 2))))
+        self.pending += 1
+
+    def commit(self):
+        if self.pending:
+            try:
+                self.connection.commit()
+            except sqlite3.OperationalError as e:  # locked for too long by another run
+                logging.getLogger('petr_log').warning(
+                    'Could not write to the result cache {}: {}'.format(self.path, e))
+                self.connection.rollback()
+            self.pending = 0
+
+    def close(self):
+        self.commit()
+        self.connection.close()
+
+
+def date_bounds():
+    """
+    The sorted date bounds of the actor and agent date restrictions, or None if the
+    dictionaries have not been compiled into tries, in which case the cache is keyed
+    by the date itself.
+    """
+    bounds = set()
+    for trie in [PETRglobals.ActorDict, PETRglobals.AgentDict]:
+        if not hasattr(trie, 'seg_bound'):
+            return None
+        bounds.update(trie.seg_bound)
+    return sorted(bounds)
+
+
+def dictionary_version():
+    """
+    The key of the dictionary manifest -- see PETRreader.make_dictionary_manifest() --
+    for the dictionaries in use.
+    """
+    if not PETRglobals.DictVersion:
+        PETRglobals.DictVersion = PETRreader.make_dictionary_manifest(
+            PETRreader.get_dictionary_paths())['key']
+    return PETRglobals.DictVersion
+
+
+_cache = None
+
+
+def result_cache():
+    """
+    The ResultCache of the result_cache file in the config, or None if there is none.
+    Each process opens its own connection, since one cannot be shared across a fork.
+    """
+    global _cache
+    if not PETRglobals.ResultCacheFileName:
+        return None
+    owner = (os.getpid(), PETRglobals.ResultCacheFileName, dictionary_version())
+    if _cache is None or _cache[0] != owner:
+        _cache = (owner, ResultCache(PETRglobals.ResultCacheFileName, owner[2]))
+    return _cache[1]
@@ -47,6 +47,9 @@ DiscardFileName = ""  # discard list
 TextFileList = []  # current text or validation file
 EventFileName = ""  # event output file
 IssueFileName = ""  # issues list
+DictCacheFileName = ""  # compiled dictionary cache
+DictMapImage = False  # map the verb, actor and agent dictionaries from an image file
+DictVersion = ""  # manifest key of the dictionaries read; see PETRcache.dictionary_version()
 
 # element followed by attribute and content pairs for XML line
 AttributeList = []
@@ -60,6 +63,14 @@ NewActorLength = 0  # Maximum length for new actors extracted from noun phrases
 # Defaults are more or less equivalent to TABARI
 RequireDyad = True  # Events require a non-null source and target
 StoponError = False  # Raise stop exception on errors rather than recovering
+PreFilter = False  # Skip sentences with no dictionary verb or no actor/agent word
+PreFilterVerbs = None  # words of VerbDict['verbs'], used by the pre-filter
+StreamWindow = 256  # Maximum number of stories read ahead when coding a stream
+MaxSentences = 7  # Sentences coded from each unsegmented story; 0 for all of them
+ResultCacheFileName = ""  # SQLite cache of sentence coding results; see PETRcache
+CheckpointStories = 1000  # Stories between batch --checkpoint checkpoints; 0 for none
+CheckpointSeconds = 300  # Seconds between batch --checkpoint checkpoints; 0 for none
+Quiet = False  # Don't print the progress of coding; set by PETRserver while it codes
 
 # OUTPUT OPTIONS
 WriteActorRoot = False  # Include actor root in event record
@@ -0,0 +1,197 @@
+##	PETRindex.py [module]
+##
+# Store of coded stories for incremental re-coding with the PETRARCH event coder
+#
+# An edit to the actor, agent or verb dictionaries can only change the events of
+# sentences that contain one of the words of the edited entries, yet without some
+# record of which sentences those are the whole archive has to be coded again.
+#
+# CodedStore keeps, in an SQLite file, each story of a batch as it was read and as it
+# was coded, an inverted index from every word of the stories' parses to the stories
+# containing it, and a signature of the dictionaries used: for every word, a hash of
+# the dictionary entries that can only apply to a sentence containing that word.
+# recode() in petrarch2.py compares the signatures of the current dictionaries with
+# the stored ones, looks the words whose signature changed up in the index and codes
+# just those stories again, then writes the events of the whole store.
+#
+# Entries that cannot be tied to a word -- the verb transformations -- and the other
+# files and options that the coding depends on go into the signature of ALL_WORDS, a
+# change to which re-codes everything.
+#
+# This code is covered under the MIT license
+# ------------------------------------------------------------------------
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import pickle
+import sqlite3
+import hashlib
+from collections import defaultdict
+
+import PETRglobals
+import PETRreader
+import PETRtrie
+import utilities
+
+ALL_WORDS = ''  # the signature key of what every sentence depends on
+
+
+class CodedStore(object):
+    """ The stories, their coded form and the word index kept in the SQLite file path. """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS stories
+                (seq INTEGER PRIMARY KEY, id TEXT, raw BLOB, coded BLOB);
+            CREATE TABLE IF NOT EXISTS postings (word TEXT, seq INTEGER);
+            CREATE INDEX IF NOT EXISTS postings_word ON postings (word);
+            CREATE TABLE IF NOT EXISTS signatures (word TEXT PRIMARY KEY, digest TEXT);
+            """)
+
+    def clear(self):
+        self.connection.executescript("""
+            DELETE FROM stories; DELETE FROM postings; DELETE FROM signatures;
+            """)
+
+    def add(self, key, raw, coded):
+        """
+        Adds a story: raw is the pickled story as read, coded the story dictionary after
+        coding, and the words of its parses are added to the index.
+        """
+        cursor = self.connection.execute(
+            'INSERT INTO stories (id, raw, coded) VALUES (?, ?, ?)',
+            (key, sqlite3.Binary(raw), sqlite3.Binary(pickle.dumps(coded, 2))))
+        self.connection.executemany(
+            'INSERT INTO postings VALUES (?, ?)',
+            [(word, cursor.lastrowid) for word in story_words(coded)])
+
+    def update(self, seq, coded):
+        """ Replaces the coded form of story seq. """
+        self.connection.execute('UPDATE stories SET coded = ? WHERE seq = ?',
+                                (sqlite3.Binary(pickle.dumps(coded, 2)), seq))
+
+    def story(self, seq):
+        """ The (StoryID, story as read) of story seq. """
+        key, raw = self.connection.execute(
+            'SELECT id, raw FROM stories WHERE seq = ?', (seq,)).fetchone()
+        return key, pickle.loads(bytes(raw))
+
+    def affected(self, words):
+        """ The stories, in input order, that contain at least one of words. """
+        seqs = set()
+        words = list(words)
+        for start in range(0, len(words), 500):  # keep under SQLite's parameter limit
+            batch = words[start:start + 500]
+            seqs.update(seq for seq, in self.connection.execute(
+                'SELECT DISTINCT seq FROM postings WHERE word IN ({})'.format(
+                    ', '.join('?' * len(batch))), batch))
+        return sorted(seqs)
+
+    def all_stories(self):
+        return [seq for seq, in self.connection.execute(
+            'SELECT seq FROM stories ORDER BY seq')]
+
+    def coded_stories(self):
+        """ Yields the (StoryID, coded story) pairs of the store in input order. """
+        for key, coded in self.connection.execute(
+                'SELECT id, coded FROM stories ORDER BY seq'):
+            yield key, pickle.loads(bytes(coded))
+
+    def signatures(self):
+        return dict(self.connection.execute('SELECT word, digest FROM signatures'))
+
+    def set_signatures(self, signatures):
+        self.connection.execute('DELETE FROM signatures')
+        self.connection.executemany('INSERT INTO signatures VALUES (?, ?)',
+                                    signatures.items())
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+
+def story_words(story):
+    """ The set of words in the parses and texts of the sentences of story. """
+    words = set()
+    for sent in (story.get('sents') or {}).values():
+        if 'parsed' in sent:
+            tokens = utilities.SentenceTokens(sent['content'], sent['parsed'])
+            words.update(tokens.words)
+            words.update(seg for seg in tokens.segs
+                         if not seg.startswith('(') and seg != ')')
+    return words
+
+
+def _entries(tree, path=()):
+    # the (path of keys, leaf) pairs of a tree of nested dicts or MappedDicts
+    for key, value in tree.items():
+        if isinstance(value, (dict, PETRtrie.MappedDict)):
+            for entry in _entries(value, path + (key,)):
+                yield entry
+        else:
+            yield path + (key,), value
+
+
+def _entry_hash(entry):
+    return int(hashlib.sha1(repr(entry).encode('utf-8')).hexdigest(), 16)
+
+
+def dictionary_signatures():
+    """
+    Returns {word: digest} for the dictionaries in PETRglobals. The digest of a word
+    covers every actor and agent phrase containing it and, for a verb, its verb
+    dictionary entry and the patterns of its meaning, so it changes exactly when an
+    entry that could apply to a sentence with that word is added, removed or edited.
+
+    A digest is the sum of the hashes of the word's entries, so that it does not
+    depend on the order in which they are visited.
+    """
+    totals = defaultdict(int)
+    for label, trie in [('actors', PETRglobals.ActorDict),
+                        ('agents', PETRglobals.AgentDict)]:
+        tree = trie.to_dict() if hasattr(trie, 'to_dict') else trie
+        for path, value in _entries(tree):
+            entry = _entry_hash((label, path, value))
+            for word in path[:-1]:
+                totals[word] += entry
+
+    verbs = PETRglobals.VerbDict['verbs']
+    meanings = defaultdict(set)
+    for verb in verbs:
+        for path, value in _entries(verbs[verb]):
+            totals[verb] += _entry_hash(('verbs', verb, path, value))
+            if path[-1] == 'meaning' and value:
+                meanings[value].add(verb)
+    # a verb's patterns are found by its meaning, or by the verb itself if it has none
+    for meaning, patterns in PETRglobals.VerbDict['phrases'].items():
+        entry = _entry_hash(('phrases', meaning, sum(
+            _entry_hash(entry) for entry in _entries(patterns))))
+        for verb in meanings[meaning] | set([meaning]):
+            totals[verb] += entry
+
+    try:
+        other = [(label, digest) for label, _, digest in
+                 PETRreader.make_dictionary_manifest(
+                     PETRreader.get_dictionary_paths())['sources']
+                 if label in ('discards', 'issues')]
+    except IOError:  # read from a bundle: any change to it re-codes everything
+        other = PETRglobals.DictVersion
+    totals[ALL_WORDS] += _entry_hash((
+        sum(_entry_hash(entry) for entry in
+            _entries(PETRglobals.VerbDict['transformations'])),
+        other, sorted(PETRreader.dictionary_options().items()),
+        PETRglobals.NewActorLength))
+
+    return dict((word, '{:040x}'.format(total % (1 << 160)))
+                for word, total in totals.items())
+
+
+def changed_words(old, new):
+    """ The words whose signature differs between the signature dicts old and new. """
+    return set(word for word in set(old) | set(new) if old.get(word) != new.get(word))
@@ -41,19 +41,53 @@ from __future__ import unicode_literals
 
 import io
 import re
+import bz2
+import gzip
+import json
+import numbers
+import datetime
 import os
 import sys
+import gc
 import math  # required for ordinal date calculations
+import mmap
+import itertools
+import hashlib
 import logging
 import xml.etree.ElementTree as ET
 from functools import reduce
+from collections import OrderedDict
 
 try:
     from ConfigParser import ConfigParser
 except ImportError:
     from configparser import ConfigParser
 
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    import xml.etree.cElementTree as cET
+except ImportError:
+    cET = ET
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma  # optional: .xz input under Python 2
+    except ImportError:
+        lzma = None
+
+try:
+    from lxml import etree as lxml_etree  # optional: faster reading of XML input
+except ImportError:
+    lxml_etree = None
+
 import PETRglobals
+import PETRtrie
 import utilities
 
 
@@ -168,6 +202,20 @@ def parse_Config(config_path):
                 'Dictionaries',
                 'issuefile_name')
 
+        if parser.has_option('Dictionaries', 'cachefile_name'):
+            PETRglobals.DictCacheFileName = parser.get(
+                'Dictionaries',
+                'cachefile_name')
+        else:
+            PETRglobals.DictCacheFileName = ""
+
+        if parser.has_option('Dictionaries', 'map_image'):
+            PETRglobals.DictMapImage = parser.getboolean(
+                'Dictionaries',
+                'map_image')
+        else:
+            PETRglobals.DictMapImage = False
+
         if parser.has_option('Options', 'new_actor_length'):
             try:
                 PETRglobals.NewActorLength = parser.getint(
@@ -179,7 +227,43 @@ def parse_Config(config_path):
                 raise
         print("new_actor_length =", PETRglobals.NewActorLength)
 
+        if parser.has_option('Options', 'stream_window'):
+            try:
+                PETRglobals.StreamWindow = parser.getint(
+                    'Options',
+                    'stream_window')
+            except ValueError:
+                print(
+                    "Error in config.ini Option: stream_window value must be an integer")
+                raise
+
+        for option, name in [('checkpoint_stories', 'CheckpointStories'),
+                             ('checkpoint_seconds', 'CheckpointSeconds')]:
+            if parser.has_option('Options', option):
+                try:
+                    setattr(PETRglobals, name, parser.getint('Options', option))
+                except ValueError:
+                    print(
+                        "Error in config.ini Option: " + option + " value must be an integer")
+                    raise
+
+        if parser.has_option('Options', 'result_cache'):
+            PETRglobals.ResultCacheFileName = parser.get('Options', 'result_cache')
+        else:
+            PETRglobals.ResultCacheFileName = ""
+
+        if parser.has_option('Options', 'max_sentences'):
+            try:
+                PETRglobals.MaxSentences = parser.getint(
+                    'Options',
+                    'max_sentences')
+            except ValueError:
+                print(
+                    "Error in config.ini Option: max_sentences value must be an integer")
+                raise
+
         PETRglobals.StoponError    = get_config_boolean('stop_on_error')
+        PETRglobals.PreFilter      = get_config_boolean('prefilter')
         PETRglobals.WriteActorRoot = get_config_boolean('write_actor_root')
         PETRglobals.WriteActorText = get_config_boolean('write_actor_text')
         PETRglobals.WriteEventText = get_config_boolean('write_event_text')
@@ -464,8 +548,8 @@ def read_discard_list(discard_path):
 
     The file format allows # to be used as a in-line comment delimiter.
 
-    File is stored as a simple list and the interpretation of the strings is done in
-    check_discards()
+    The phrases are stored as a tree of words ending in a '+' or '$' marker, which
+    compile_discard_list() then turns into the automaton used by check_discards()
 
     ===== EXAMPLE =====
     +5K RUN #  ELH 06 Oct 2009
@@ -520,6 +604,25 @@ def read_discard_list(discard_path):
     close_FIN()
 
 
+def compile_discard_list():
+    """
+    Replaces the word tree built by read_discard_list() with a PETRtrie.PhraseAutomaton
+    over the discard phrases, whose values are the '+' (story) or '$' (sentence) markers.
+    """
+    if not isinstance(PETRglobals.DiscardList, dict):
+        return
+    phrases = []
+    stack = [((), PETRglobals.DiscardList)]
+    while stack:
+        words, level = stack.pop()
+        for word, sublevel in level.items():
+            if word in ('+', '$') and not sublevel:
+                phrases.append((words, word))
+            else:
+                stack.append((words + (word,), sublevel))
+    PETRglobals.DiscardList = PETRtrie.PhraseAutomaton(phrases)
+
+
 def read_issue_list(issue_path):
     """
     "Issues" do simple string matching and return a comma-delimited list of codes.
@@ -536,9 +639,9 @@ def read_issue_list(issue_path):
 
     The file format allows # to be used as a in-line comment delimiter.
 
-    File is stored in PETRglobals.IssueList as a list of tuples (string, index) where
-    index refers to the location of the code in PETRglobals.IssueCodes. The coding is done
-    in check_issues()
+    The phrases are stored in PETRglobals.IssueList as a tree of words ending in a '#' key
+    whose value is the index of the code in PETRglobals.IssueCodes; compile_issue_list()
+    then turns the tree into the automaton used by get_issues()
 
     Issues are written to the event record as a comma-delimited list to a tab-delimited
     field, e.g.
@@ -671,6 +774,25 @@ def read_issue_list(issue_path):
 		ka += 1
 	"""
 
+
+def compile_issue_list():
+    """
+    Replaces the word tree built by read_issue_list() with a PETRtrie.PhraseAutomaton
+    over the issue phrases, whose values are the indices into PETRglobals.IssueCodes.
+    """
+    if not isinstance(PETRglobals.IssueList, dict):
+        return
+    phrases = []
+    stack = [((), PETRglobals.IssueList)]
+    while stack:
+        words, level = stack.pop()
+        for word, sublevel in level.items():
+            if word == '#':
+                phrases.append((words, sublevel))
+            else:
+                stack.append((words + (word,), sublevel))
+    PETRglobals.IssueList = PETRtrie.PhraseAutomaton(phrases)
+
 # ================== VERB DICTIONARY INPUT ================== #
 
 
@@ -1798,6 +1920,23 @@ def read_actor_dictionary(actorfile):
 
         """
 
+    if not isinstance(PETRglobals.ActorDict, dict):
+        # already compiled by compile_actor_dictionary(): add to the nested form
+        PETRglobals.ActorDict = PETRglobals.ActorDict.to_dict()
+
+    logger = logging.getLogger('petr_log')
+
+    def check_dates(code, dates):
+        # reports date restrictions that NounPhrase.check_date() cannot apply as written
+        if actor_date_interval(dates)[0] == PETRtrie.POISON:
+            problem = "cannot be read; the actor will get a null code"
+        elif len(dates) == 1 and dates[0][:1] not in ('<', '>'):
+            problem = "has no '<' or '>' prefix"
+        else:
+            return
+        logger.warning('Date restriction "{}" of code {} in {} line {} {}'.format(
+            '-'.join(dates), code, os.path.basename(CurrentFINname), FINnline, problem))
+
     open_FIN(actorfile, "actor")
 
     line = read_FIN_line().strip()
@@ -1819,6 +1958,7 @@ def read_actor_dictionary(actorfile):
                         dates = [datetemp]
                 except:
                     dates = []
+            check_dates(code, dates)
             datelist.append((code, dates))
         else:
             if line[0] == '+':  # Synonym
@@ -1885,6 +2025,7 @@ def read_actor_dictionary(actorfile):
                     except:
                         dates = []
 
+                    check_dates(code, dates)
                     datelist.append((code, dates))
 
                 actor = actortemp.replace("_", ' ').split()
@@ -1901,6 +2042,52 @@ def read_actor_dictionary(actorfile):
 #    exit()
 
 
+def actor_date_interval(dates):
+    """
+    Converts the date restrictions stored with an actor code -- [], ['<YYMMDD'],
+    ['>YYMMDD'] or ['YYMMDD', 'YYMMDD'] -- into the (lo, hi) ordinal bounds of an
+    ActorTrie record. The code applies to dates with lo <= date < hi; PETRtrie.NO_LO
+    and PETRtrie.NO_HI mark a missing bound.
+
+    This reproduces NounPhrase.check_date() exactly, including two of its quirks: a
+    single date without a '<' or '>' prefix is compared after dropping the first digit
+    of its ordinal, and a restriction that cannot be evaluated gives PETRtrie.POISON,
+    where check_date() stopped and returned the null code.
+    """
+    try:
+        date = []
+        for d in dates:
+            if d[0] in '<>':
+                date.append(d[0] + str(dstr_to_ordate(d[1:])))
+            else:
+                date.append(str(dstr_to_ordate(d)))
+        if not date:
+            return PETRtrie.NO_LO, PETRtrie.NO_HI
+        if len(date) == 1:
+            if date[0][0] == '<':
+                return PETRtrie.NO_LO, int(date[0][1:])
+            return int(date[0][1:]), PETRtrie.NO_HI
+        hi = int(date[1])
+    except (DateError, ValueError, IndexError):
+        return PETRtrie.POISON, PETRtrie.NO_HI
+    try:
+        lo = int(date[0])
+    except ValueError:
+        # check_date() only evaluated this -- and failed -- when date < hi
+        return PETRtrie.POISON, hi
+    return lo, hi
+
+
+def compile_actor_dictionary():
+    """
+    Replaces the nested dicts built by read_actor_dictionary() with the equivalent
+    PETRtrie.ActorTrie. Call this once all of the actor files have been read.
+    """
+    if isinstance(PETRglobals.ActorDict, dict):
+        PETRglobals.ActorDict = PETRtrie.ActorTrie.from_dict(
+            PETRglobals.ActorDict, actor_date_interval)
+
+
 # ================== AGENT DICTIONARY INPUT ================== #
 def read_agent_dictionary(agent_path):
     """ Reads an agent dictionary
@@ -1992,6 +2179,10 @@ def read_agent_dictionary(agent_path):
     """
     global subdict
 
+    if not isinstance(PETRglobals.AgentDict, dict):
+        # already compiled by compile_agent_dictionary(): add to the nested form
+        PETRglobals.AgentDict = PETRglobals.AgentDict.to_dict()
+
     def store_agent(nounst, code):
         # parses nounstring and stores the result with code
 
@@ -2098,9 +2289,269 @@ def read_agent_dictionary(agent_path):
 
     close_FIN()
 
+
+def compile_agent_dictionary():
+    """
+    Replaces the nested dicts built by read_agent_dictionary() with the equivalent
+    PETRtrie.ActorTrie.
+    """
+    if isinstance(PETRglobals.AgentDict, dict):
+        PETRglobals.AgentDict = PETRtrie.ActorTrie.from_dict(PETRglobals.AgentDict)
+
+# ================== COMPILED DICTIONARY CACHE ================== #
+
+# Bump this whenever the in-memory layout of any of the dictionaries changes: cache
+# files written with another version are ignored and rebuilt.
+DictCacheVersion = 6
+
+
+def reset_dictionaries():
+    """ Empties the dictionaries in PETRglobals so the readers start from scratch. """
+    PETRglobals.VerbDict = {'verbs': {}, 'phrases': {}, 'transformations': {}}
+    PETRglobals.ActorDict = {}
+    PETRglobals.AgentDict = {}
+    PETRglobals.DiscardList = {}
+    PETRglobals.IssueList = []
+    PETRglobals.IssueCodes = []
+    PETRglobals.PreFilterVerbs = None
+    PETRglobals.DictVersion = ""
+
+
+def prefilter_verbs():
+    """
+    Returns the set of the verbs in VerbDict['verbs'] used by the sentence pre-filter,
+    building it from the loaded verb dictionary the first time.
+    """
+    if PETRglobals.PreFilterVerbs is None:
+        PETRglobals.PreFilterVerbs = set(PETRglobals.VerbDict['verbs'].keys())
+    return PETRglobals.PreFilterVerbs
+
+
+def get_dictionary_paths():
+    """
+    Returns (label, path) pairs for the dictionary files named in the config, in the
+    order read_dictionaries() reads them. The issues file is only included if one is set.
+    """
+    paths = [('verbs', utilities._get_data('data/dictionaries',
+                                           PETRglobals.VerbFileName))]
+    for actdict in PETRglobals.ActorFileList:
+        paths.append(('actors', utilities._get_data('data/dictionaries', actdict)))
+    paths.append(('agents', utilities._get_data('data/dictionaries',
+                                                PETRglobals.AgentFileName)))
+    paths.append(('discards', utilities._get_data('data/dictionaries',
+                                                  PETRglobals.DiscardFileName)))
+    if PETRglobals.IssueFileName != "":
+        paths.append(('issues', utilities._get_data('data/dictionaries',
+                                                    PETRglobals.IssueFileName)))
+    return paths
+
+
+def _file_hash(path):
+    # SHA-1 of the raw bytes of path; raises IOError if the file is missing
+    sha = hashlib.sha1()
+    with open(path, 'rb') as fin:
+        for block in iter(lambda: fin.read(1 << 16), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def dictionary_options():
+    """ The config options that change what the dictionary readers store. """
+    return {'WriteActorRoot': PETRglobals.WriteActorRoot}
+
+
+def make_dictionary_manifest(paths):
+    """
+    Describes the dictionaries that the readers would build from paths: the content hash
+    of every source file plus the options that change what the readers store. Two
+    manifests with the same 'key' always describe identical dictionaries.
+    """
+    sources = [(label, os.path.basename(path), _file_hash(path))
+               for label, path in paths]
+    options = dictionary_options()
+    sha = hashlib.sha1()
+    sha.update(repr((DictCacheVersion, sources,
+                     sorted(options.items()))).encode('utf-8'))
+    return {'version': DictCacheVersion, 'sources': sources,
+            'options': options, 'key': sha.hexdigest()}
+
+
+def dictionary_image_path(cache_path):
+    """ The memory-mapped image of the verb, actor and agent dictionaries of cache_path. """
+    return cache_path + '.img'
+
+
+def write_dictionary_image(cache_path, manifest):
+    """
+    Writes the verb, actor and agent dictionaries in PETRglobals to the image file of
+    cache_path, again under a temporary name. Returns True if the image was written.
+    """
+    logger = logging.getLogger('petr_log')
+    image_path = dictionary_image_path(cache_path)
+    temp_path = '{}.{}.tmp'.format(image_path, os.getpid())
+    try:
+        PETRtrie.write_image(temp_path, manifest['key'],
+                             [('actors', PETRglobals.ActorDict),
+                              ('agents', PETRglobals.AgentDict),
+                              ('verbs', PETRglobals.VerbDict)])
+        os.rename(temp_path, image_path)
+    except (IOError, OSError) as e:
+        logger.warning('Could not write dictionary image {}: {}'.format(
+            image_path, e))
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return False
+    logger.info('Wrote dictionary image ' + image_path)
+    return True
+
+
+def map_dictionary_image(cache_path, manifest):
+    """
+    Points PETRglobals.VerbDict, ActorDict and AgentDict at the mapped image of
+    cache_path if it was compiled from the dictionaries described by manifest. Returns
+    True on success.
+    """
+    images = PETRtrie.open_image(dictionary_image_path(cache_path), manifest['key'])
+    if not images:
+        return False
+    PETRglobals.VerbDict = images['verbs']
+    PETRglobals.ActorDict = images['actors']
+    PETRglobals.AgentDict = images['agents']
+    logging.getLogger('petr_log').info(
+        'Mapped dictionary image ' + dictionary_image_path(cache_path))
+    return True
+
+
+def write_dictionary_cache(cache_path, manifest):
+    """
+    Writes the dictionaries currently in PETRglobals to cache_path. The manifest goes
+    first so that read_dictionary_cache() can reject a stale file without unpickling the
+    dictionaries, and the verb, actor and agent dictionaries go last so that they can be
+    skipped when they are mapped from the image instead. The file is written under a temporary name
+    and then renamed, so workers starting at the same time never see a partial cache.
+
+    Returns True if the cache was written.
+    """
+    logger = logging.getLogger('petr_log')
+    state = {'DiscardList': PETRglobals.DiscardList,
+             'IssueList': PETRglobals.IssueList,
+             'IssueCodes': PETRglobals.IssueCodes}
+    mappable = {'VerbDict': PETRglobals.VerbDict,
+                'ActorDict': PETRglobals.ActorDict,
+                'AgentDict': PETRglobals.AgentDict}
+    temp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+    try:
+        with open(temp_path, 'wb') as fout:
+            pickle.dump(manifest, fout, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(state, fout, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(mappable, fout, pickle.HIGHEST_PROTOCOL)
+        os.rename(temp_path, cache_path)
+    except (IOError, OSError) as e:
+        logger.warning('Could not write dictionary cache {}: {}'.format(
+            cache_path, e))
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return False
+    logger.info('Wrote dictionary cache ' + cache_path)
+    if PETRglobals.DictMapImage:
+        write_dictionary_image(cache_path, manifest)
+    return True
+
+
+def read_dictionary_cache(cache_path, manifest=None):
+    """
+    Loads the dictionaries stored in cache_path into PETRglobals. If manifest is given,
+    the file is only used when its key matches, i.e. when it was compiled from the same
+    source files and options. With PETRglobals.DictMapImage set, the verb, actor and
+    agent dictionaries are mapped from the image file, which is written first if needed.
+
+    Returns the manifest stored in the file, or None if the file is missing, stale or
+    unreadable, in which case PETRglobals is left untouched.
+    """
+    logger = logging.getLogger('petr_log')
+    gc_enabled = gc.isenabled()
+    try:
+        with open(cache_path, 'rb') as fin:
+            cached = pickle.load(fin)
+            if (not isinstance(cached, dict) or
+                    cached.get('version') != DictCacheVersion):
+                logger.info('Ignoring dictionary cache {}: wrong version'.format(
+                    cache_path))
+                return None
+            if manifest and cached.get('key') != manifest['key']:
+                logger.info('Ignoring dictionary cache {}: dictionaries changed'.format(
+                    cache_path))
+                return None
+            # the dictionaries are several million small containers, none of them
+            # cyclic: letting the collector scan them while they are created more
+            # than triples the load time
+            gc.disable()
+            state = pickle.load(fin)
+            images = PETRtrie.open_image(dictionary_image_path(cache_path),
+                                         cached['key']) \
+                if PETRglobals.DictMapImage else None
+            if images:
+                mappable = {'VerbDict': images['verbs'],
+                            'ActorDict': images['actors'],
+                            'AgentDict': images['agents']}
+            else:
+                mappable = pickle.load(fin)
+    except IOError:
+        return None  # no cache yet
+    except Exception as e:
+        logger.warning('Could not read dictionary cache {}: {}'.format(
+            cache_path, e))
+        return None
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+    PETRglobals.VerbDict = mappable['VerbDict']
+    PETRglobals.ActorDict = mappable['ActorDict']
+    PETRglobals.AgentDict = mappable['AgentDict']
+    PETRglobals.DiscardList = state['DiscardList']
+    PETRglobals.IssueList = state['IssueList']
+    PETRglobals.IssueCodes = state['IssueCodes']
+    PETRglobals.PreFilterVerbs = None
+    logger.info('Read dictionary cache ' + cache_path)
+    if images:
+        logger.info('Mapped dictionary image ' + dictionary_image_path(cache_path))
+    elif PETRglobals.DictMapImage:
+        # no usable image yet: write one and switch to it
+        if write_dictionary_image(cache_path, cached):
+            map_dictionary_image(cache_path, cached)
+    return cached
+
 # ==== Input format reading
 
 
+def read_input(filepaths, parsed=False):
+    """
+    Reads the input files into the global holding dictionary, using
+    read_jsonl_input() for JSON-lines files (see is_jsonl_input()) and
+    read_xml_input() for the others.
+    """
+    holding = read_xml_input([path for path in filepaths
+                              if not is_jsonl_input(path)], parsed)
+    holding.update(read_jsonl_input([path for path in filepaths
+                                     if is_jsonl_input(path)]))
+    return holding
+
+
+def iter_input_stories(filepaths, parsed=False, window=1):
+    """
+    Reads the input files one story at a time, in file order, using
+    iter_jsonl_stories() for JSON-lines files and iter_xml_stories() for the others.
+    """
+    for path in filepaths:
+        if is_jsonl_input(path):
+            stories = iter_jsonl_stories([path])
+        else:
+            stories = iter_xml_stories([path], parsed, window)
+        for story in stories:
+            yield story
+
+
 def read_xml_input(filepaths, parsed=False):
     """
     Reads input in the PETRARCH XML-input format and creates the global holding
@@ -2129,65 +2580,257 @@ def read_xml_input(filepaths, parsed=False):
                 the format of this dictionary.
     """
     holding = {}
+    for entry_id, content_dict in _iter_xml_records(filepaths, parsed):
+        if entry_id not in holding:
+            holding[entry_id] = content_dict
+        else:
+            holding[entry_id]['sents'].update(content_dict['sents'])
+
+    return holding
+
+
+def iter_xml_stories(filepaths, parsed=False, window=1):
+    """
+    Reads input in the PETRARCH XML-input format one story at a time: a generator of
+    (StoryID, story) pairs, where story is the entry that read_xml_input() would
+    have made for StoryID. This is the reader for streaming coding, so at most
+    window stories are held here at once: a story is yielded when window other
+    stories have been read since its last sentence. The sentences of a story
+    should therefore lie within window stories of each other in the input; a story
+    whose sentences are further apart is yielded once for each group of them, and a
+    warning is logged when it turns up again.
+    """
+    return _group_stories(_iter_xml_records(filepaths, parsed), window)
+
+
+def xml_byte_ranges(path, chunk_bytes):
+    """
+    Splits the XML file path into byte ranges of about chunk_bytes that each hold
+    whole <Sentence> elements, for reading the file in parallel with
+    iter_xml_range(). A range only starts at a <Sentence> of a different story than
+    the one before it, so the consecutive sentences of a story stay together, and
+    never inside a comment; sentences of a story elsewhere in the file can fall into
+    another range. Returns a list of (start, end) offsets in file order.
+    """
+    with open(path, 'rb') as fin:
+        if not os.fstat(fin.fileno()).st_size:
+            return []
+        mm = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        first = _next_sentence(mm, 0)
+        last = mm.rfind(b'</Sentence>')
+        if first < 0 or last < first:
+            return []
+        last += len(b'</Sentence>')
+        bounds = [first]
+        while True:
+            pos = _next_sentence(mm, bounds[-1] + chunk_bytes, bounds[-1])
+            # move on to the first sentence of the next story
+            while 0 <= pos < last and _story_at(mm, pos) == _story_at(
+                    mm, mm.rfind(b'<Sentence', bounds[-1], pos)):
+                pos = _next_sentence(mm, pos + 1, bounds[-1])
+            if pos < 0 or pos >= last:
+                break
+            bounds.append(pos)
+        bounds.append(last)
+        return list(zip(bounds[:-1], bounds[1:]))
+    finally:
+        mm.close()
+
+
+def _next_sentence(mm, pos, lo=0):
+    """
+    Offset of the first <Sentence> tag at or after pos that is not in a comment, or
+    -1. lo is an offset before pos known to be outside any comment.
+    """
+    while True:
+        pos = mm.find(b'<Sentence', pos)
+        if pos < 0:
+            return pos
+        after = mm[pos + 9:pos + 10]
+        if after and after not in b' \t\r\n>':
+            pos += 9  # <Sentences> or some other tag
+            continue
+        comment = mm.rfind(b'<!--', lo, pos)
+        if comment >= 0 and mm.rfind(b'-->', comment, pos) < 0:
+            pos = mm.find(b'-->', pos)  # in a comment: carry on after it
+            if pos < 0:
+                return pos
+            continue
+        return pos
+
+
+_id_attribute = re.compile(br'\bid\s*=\s*"([^"]*)"')
+_sentence_attribute = re.compile(br'\bsentence\s*=\s*"([^"]*)"')
+
 
+def _story_at(mm, pos):
+    """ The StoryID of the <Sentence> tag at offset pos, as read_xml_input() forms it. """
+    tag = mm[pos:mm.find(b'>', pos)]
+    match = _id_attribute.search(tag)
+    entry_id = match.group(1) if match else b''
+    match = _sentence_attribute.search(tag)
+    if match and match.group(1) == b'True':
+        entry_id = entry_id.split(b'_')[0]
+    return entry_id
+
+
+class _XMLRange(object):
+    """
+    Read-only file object for iterparse over the bytes start ... end of an XML file,
+    wrapped in a <Sentences> element (after the file's XML declaration, if it has
+    one) so that the range parses on its own. The file is memory-mapped and handed
+    to the parser a block at a time, so the range is never copied as a whole.
+    """
+
+    def __init__(self, path, start, end):
+        with open(path, 'rb') as fin:
+            self.mm = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        head = b''
+        if self.mm[:5] == b'<?xml':
+            head = self.mm[:self.mm.find(b'?>') + 2]
+        self.parts = [head + b'<Sentences>', (start, end), b'</Sentences>']
+
+    def read(self, size=-1):
+        while self.parts:
+            part = self.parts[0]
+            if not isinstance(part, tuple):
+                self.parts.pop(0)
+                return part
+            start, end = part
+            if size < 0 or start + size >= end:
+                self.parts.pop(0)
+                return self.mm[start:end]
+            self.parts[0] = (start + size, end)
+            return self.mm[start:start + size]
+        self.mm.close()
+        return b''
+
+
+def iter_xml_range(path, start, end, parsed=False, window=1):
+    """
+    Reads the byte range start ... end of the XML file path -- one of the ranges of
+    xml_byte_ranges() -- one story at a time, as iter_xml_stories() does for whole
+    files.
+    """
+    return _group_stories(_xml_records(_XMLRange(path, start, end), parsed), window)
+
+
+def _group_stories(records, window):
+    """ Puts the (StoryID, entry) records of one sentence each together into stories. """
+    pending = OrderedDict()
+    done = set()  # the StoryIDs already yielded
+    for entry_id, content_dict in records:
+        if entry_id in pending:
+            story = pending.pop(entry_id)
+            story['sents'].update(content_dict['sents'])
+            pending[entry_id] = story
+            continue
+        if entry_id in done:
+            logging.getLogger('petr_log').warning(
+                'Story {} has sentences too far apart for a window of {} stories: '
+                'they are coded as separate stories'.format(entry_id, window))
+        pending[entry_id] = content_dict
+        if len(pending) > window:
+            story = pending.popitem(last=False)
+            done.add(story[0])
+            yield story
+    while pending:
+        yield pending.popitem(last=False)
+
+
+def _iter_xml_records(filepaths, parsed):
+    """
+    Yields (StoryID, entry) for each <Sentence> element of the XML files in
+    filepaths, where entry is a holding-dictionary entry with just the sentences of
+    that element.
+    """
     for path in filepaths:
-        tree = ET.iterparse(path)
-
-        for event, elem in tree:
-            if event == "end" and elem.tag == "Sentence":
-                story = elem
-
-                # Check to make sure all the proper XML attributes are included
-                attribute_check = [key in story.attrib for key in
-                                   ['date', 'id', 'sentence', 'source']]
-                if not attribute_check:
-                    print('Need to properly format your XML...')
-                    break
-
-                # If the XML contains StanfordNLP parsed data, pull that out
-                # TODO: what to do about parsed content at the story level,
-                # i.e., multiple parsed sentences within the XML entry?
-                if parsed:
-                    parsed_content = story.find('Parse').text
-                    parsed_content = utilities._format_parsed_str(
-                        parsed_content)
-                else:
-                    parsed_content = ''
-
-                # Get the sentence information
-                if story.attrib['sentence'] == 'True':
-                    entry_id, sent_id = story.attrib['id'].split('_')
-
-                    text = story.find('Text').text
-                    text = text.replace('\n', ' ').replace('  ', ' ')
-                    sent_dict = {'content': text, 'parsed': parsed_content}
-                    meta_content = {'date': story.attrib['date'],
-                                    'source': story.attrib['source']}
-                    content_dict = {'sents': {sent_id: sent_dict},
-                                    'meta': meta_content}
-                else:
-                    entry_id = story.attrib['id']
-
-                    text = story.find('Text').text
-                    text = text.replace('\n', ' ').replace('  ', ' ')
-                    split_sents = _sentence_segmenter(text)
-                    # TODO Make the number of sents a setting
-                    sent_dict = {}
-                    for i, sent in enumerate(split_sents[:7]):
-                        sent_dict[i] = {'content': sent, 'parsed':
-                                        parsed_content}
-
-                    meta_content = {'date': story.attrib['date']}
-                    content_dict = {'sents': sent_dict, 'meta': meta_content}
-
-                if entry_id not in holding:
-                    holding[entry_id] = content_dict
-                else:
-                    holding[entry_id]['sents'][sent_id] = sent_dict
+        for record in _xml_records(path, parsed):
+            yield record
+
+
+def _xml_records(source, parsed):
+    """ The records of _iter_xml_records() for one file name or file object. """
+    for story in _iter_sentence_elements(source):
+        # Check to make sure all the proper XML attributes are included
+        attribute_check = [key in story.attrib for key in
+                           ['date', 'id', 'sentence', 'source']]
+        if not attribute_check:
+            print('Need to properly format your XML...')
+            break
 
-                elem.clear()
+        # If the XML contains StanfordNLP parsed data, pull that out
+        # TODO: what to do about parsed content at the story level,
+        # i.e., multiple parsed sentences within the XML entry?
+        if parsed:
+            parsed_content = story.find('Parse').text
+            parsed_content = utilities._format_parsed_str(
+                parsed_content)
+        else:
+            parsed_content = ''
+
+        # Get the sentence information
+        if story.attrib['sentence'] == 'True':
+            entry_id, sent_id = story.attrib['id'].split('_')
+
+            text = story.find('Text').text
+            text = text.replace('\n', ' ').replace('  ', ' ')
+            sent_dict = {'content': text, 'parsed': parsed_content}
+            meta_content = {'date': story.attrib['date'],
+                            'source': story.attrib['source']}
+            content_dict = {'sents': {sent_id: sent_dict},
+                            'meta': meta_content}
+        else:
+            entry_id = story.attrib['id']
 
-    return holding
+            text = story.find('Text').text
+            text = text.replace('\n', ' ').replace('  ', ' ')
+            sent_dict = {}
+            for i, sent in enumerate(story_sentences(text)):
+                sent_dict[i] = {'content': sent, 'parsed':
+                                parsed_content}
+
+            meta_content = {'date': story.attrib['date']}
+            content_dict = {'sents': sent_dict, 'meta': meta_content}
+
+        yield entry_id, content_dict
+
+
+def _iter_sentence_elements(path):
+    """
+    Yields the <Sentence> elements of the XML file path -- a file name or a file
+    object -- as each one is completed.
+    Once the caller is done with an element it is cleared and dropped from the
+    tree, so the memory used does not grow with the file.
+
+    lxml is used when it is installed: it only reports the end of <Sentence>
+    elements and knows their parents. Otherwise cElementTree reports the start and
+    end of every element, and the open elements are tracked to find the parent.
+    """
+    if lxml_etree is not None:
+        for _, elem in lxml_etree.iterparse(path, events=("end",), tag="Sentence"):
+            yield elem
+            elem.clear()
+            parent = elem.getparent()
+            if parent is not None:
+                while elem.getprevious() is not None:
+                    del parent[0]
+                parent.remove(elem)
+        return
+
+    open_elems = []  # the elements enclosing the current one
+    # cElementTree wants the event names as native strings
+    for event, elem in cET.iterparse(path, events=(str("start"), str("end"))):
+        if event == "start":
+            open_elems.append(elem)
+            continue
+        open_elems.pop()
+        if elem.tag == "Sentence":
+            yield elem
+            elem.clear()
+            if open_elems:
+                open_elems[-1].remove(elem)
 
 
 def read_pipeline_input(pipeline_list):
@@ -2204,6 +2847,10 @@ def read_pipeline_input(pipeline_list):
                     List of dictionaries as stored in the MongoDB instance.
                     These records are originally generated by the
                     `web scraper <https://github.com/openeventdata/scraper>`_.
+                    The parse of each sentence is in 'parsed_sents' as a Penn
+                    Treebank string, or in 'parsed_trees' as a tree structure
+                    read by utilities.tree_tokens(), in which case the
+                    sentence's 'parsed' entry is the list of its elements.
 
     Returns
     -------
@@ -2216,42 +2863,177 @@ def read_pipeline_input(pipeline_list):
     """
     holding = {}
     for entry in pipeline_list:
-        entry_id = str(entry['_id'])
-        meta_content = {'date': utilities._format_datestr(entry['date']),
-                        'date_added': entry['date_added'],
-                        'source': entry['source'],
-                        'story_title': entry['title'],
-                        'url': entry['url']}
-        if 'parsed_sents' in entry:
-            parsetrees = entry['parsed_sents']
+        entry_id, content_dict = _pipeline_story(entry)
+        holding[entry_id] = content_dict
+
+    return holding
+
+
+def _pipeline_story(entry):
+    """ Makes the (StoryID, story) holding-dictionary entry for a pipeline record. """
+    entry_id = str(entry['_id'])
+    meta_content = {'date': utilities._format_datestr(entry['date']),
+                    'date_added': entry['date_added'],
+                    'source': entry['source'],
+                    'story_title': entry['title'],
+                    'url': entry['url']}
+    if 'parsed_trees' in entry:
+        parsetrees = entry['parsed_trees']
+        read_parse = utilities.tree_tokens
+    elif 'parsed_sents' in entry:
+        parsetrees = entry['parsed_sents']
+        read_parse = utilities._format_parsed_str
+    else:
+        parsetrees = ''
+    if 'corefs' in entry:
+        corefs = entry['corefs']
+        meta_content.update({'corefs': corefs})
+
+    sent_dict = {}
+    for i, sent in enumerate(story_sentences(entry['content'])):
+        if parsetrees:
+            try:
+                tree = read_parse(parsetrees[i])
+            except IndexError:
+                tree = ''
+            sent_dict[i] = {'content': sent, 'parsed': tree}
         else:
-            parsetrees = ''
-        if 'corefs' in entry:
-            corefs = entry['corefs']
-            meta_content.update({'corefs': corefs})
-
-        split_sents = _sentence_segmenter(entry['content'])
-        # TODO Make the number of sents a setting
-        sent_dict = {}
-        for i, sent in enumerate(split_sents[:7]):
-            if parsetrees:
-                try:
-                    tree = utilities._format_parsed_str(parsetrees[i])
-                except IndexError:
-                    tree = ''
-                sent_dict[i] = {'content': sent, 'parsed': tree}
-            else:
-                sent_dict[i] = {'content': sent}
+            sent_dict[i] = {'content': sent}
+
+    return entry_id, {'sents': sent_dict, 'meta': meta_content}
+
+
+JSONLSuffixes = ('.jsonl', '.ndjson')  # not .json, which is usually a single document
+CompressedSuffixes = ('.gz', '.bz2', '.xz')
+
+
+def is_jsonl_input(path):
+    """ Whether path names a JSON-lines input file, compressed or not. """
+    root, ext = os.path.splitext(path)
+    if ext in CompressedSuffixes:
+        root, ext = os.path.splitext(root)
+    return ext in JSONLSuffixes
 
-        content_dict = {'sents': sent_dict, 'meta': meta_content}
-        holding[entry_id] = content_dict
 
+def read_jsonl_input(filepaths):
+    """
+    Reads input in the JSON-lines format -- one pipeline record per line, as taken by
+    read_pipeline_input(), with the parse trees in 'parsed_sents' or 'parsed_trees' --
+    and creates the global holding dictionary. Files ending in .gz, .bz2 or .xz are
+    decompressed as they are read.
+
+    Parameters
+    ----------
+
+    filepaths: List.
+                List of JSON-lines files to process.
+
+    Returns
+    -------
+
+    holding: Dictionary.
+                Global holding dictionary with StoryIDs as keys, as made by
+                read_pipeline_input().
+    """
+    holding = {}
+    for entry_id, content_dict in iter_jsonl_stories(filepaths):
+        holding[entry_id] = content_dict
     return holding
 
 
+def iter_jsonl_stories(filepaths):
+    """
+    Reads input in the JSON-lines format one story at a time: a generator of
+    (StoryID, story) pairs as made by read_jsonl_input(), for streaming coding.
+
+    MongoDB extended JSON is accepted for the id and dates, so records exported with
+    mongoexport can be read as they are: {"$oid": ...} ids and {"$date": ...} dates,
+    the latter as ISO strings or milliseconds since 1970.
+    """
+    for path in filepaths:
+        with _open_input(path) as fin:
+            for nline, line in enumerate(fin, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line.decode('utf-8'))
+                except ValueError as err:
+                    raise ValueError('{}, line {}: {}'.format(path, nline, err))
+                for key in ['_id', 'date', 'date_added']:
+                    if isinstance(entry.get(key), dict):
+                        entry[key] = _extended_json_value(entry[key])
+                yield _pipeline_story(entry)
+
+
+def _extended_json_value(value):
+    """ The plain value of a MongoDB extended-JSON {"$oid": ...} or {"$date": ...}. """
+    if '$oid' in value:
+        return value['$oid']
+    date = value.get('$date')
+    if isinstance(date, dict):  # {"$date": {"$numberLong": "..."}}
+        date = int(date['$numberLong'])
+    if isinstance(date, numbers.Number):
+        return datetime.datetime.utcfromtimestamp(date / 1000.0).isoformat()
+    return date
+
+
+def _open_input(path):
+    """ Opens the input file path for reading bytes, decompressing it by its suffix. """
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    if path.endswith('.bz2'):
+        return bz2.BZ2File(path, 'rb')
+    if path.endswith('.xz'):
+        if lzma is None:
+            raise IOError('Reading {} needs the lzma module '
+                          '(backports.lzma under Python 2)'.format(path))
+        return lzma.open(path, 'rb')
+    return io.open(path, 'rb')
+
+
+# this is relatively high because we are only looking for sentences that
+# will have subject and object
+MIN_SENTLENGTH = 100
+MAX_SENTLENGTH = 512
+
+# sentence termination pattern used in _sentence_segmenter(paragr)
+SENTENCE_END = re.compile('[\.\?!]\s+[A-Z\"]')
+
+# source: LbjNerTagger1.11.release/Data/KnownLists/known_title.lst from
+# University of Illinois with editing
+ABBREV_LIST = frozenset([
+    'mrs.', 'ms.', 'mr.', 'dr.', 'gov.', 'sr.', 'rev.', 'r.n.',
+    'pres.', 'treas.', 'sect.', 'maj.', 'ph.d.', 'ed. psy.',
+    'proc.', 'fr.', 'asst.', 'p.f.c.', 'prof.', 'admr.',
+    'engr.', 'mgr.', 'supt.', 'admin.', 'assoc.', 'voc.',
+    'hon.', 'm.d.', 'dpty.', 'sec.', 'capt.', 'c.e.o.',
+    'c.f.o.', 'c.i.o.', 'c.o.o.', 'c.p.a.', 'c.n.a.', 'acct.',
+    'llc.', 'inc.', 'dir.', 'esq.', 'lt.', 'd.d.', 'ed.',
+    'revd.', 'psy.d.', 'v.p.', 'senr.', 'gen.', 'prov.',
+    'cmdr.', 'sgt.', 'sen.', 'col.', 'lieut.', 'cpl.', 'pfc.',
+    'k.p.h.', 'cent.', 'deg.', 'doz.', 'Fahr.', 'Cel.', 'F.',
+    'C.', 'K.', 'ft.', 'fur.', 'gal.', 'gr.', 'in.', 'kg.',
+    'km.', 'kw.', 'l.', 'lat.', 'lb.', 'lb per sq in.', 'long.',
+    'mg.', 'mm.,, m.p.g.', 'm.p.h.', 'cc.', 'qr.', 'qt.', 'sq.',
+    't.', 'vol.', 'w.', 'wt.'])
+
+
+def story_sentences(paragr):
+    """
+    The sentences of a story's text that are coded: the first
+    PETRglobals.MaxSentences from _sentence_segmenter(paragr), or all of them
+    if that is 0.
+    """
+    sentences = _sentence_segmenter(paragr)
+    if PETRglobals.MaxSentences > 0:
+        sentences = itertools.islice(sentences, PETRglobals.MaxSentences)
+    return list(sentences)
+
+
 def _sentence_segmenter(paragr):
     """
-    Function to break a string 'paragraph' into a list of sentences based on
+    Generator that breaks a string 'paragraph' into sentences based on
     the following rules:
 
     1. Look for terminal [.,?,!] followed by a space and [A-Z]
@@ -2260,9 +3042,12 @@ def _sentence_segmenter(paragr):
     the list. Also check for single-letter initials. If true, continue search
     for terminal punctuation
     3. Extend selection to balance (...) and "...". Reapply termination rules
-    4. Add to sentlist if the length of the string is between MIN_SENTLENGTH
+    4. Yield the sentence if the length of the string is between MIN_SENTLENGTH
     and MAX_SENTLENGTH
-    5. Returns sentlist
+
+    The text is scanned once: the parenthesis and quote counts since the start
+    of the current sentence are kept as running totals rather than recounted at
+    each candidate terminator, so the time is linear in the length of paragr.
 
     Parameters
     ----------
@@ -2270,73 +3055,55 @@ def _sentence_segmenter(paragr):
     paragr: String.
             Content that will be split into constituent sentences.
 
-    Returns
-    -------
+    Yields
+    ------
 
-    sentlist: List.
-                List of sentences.
-
-    """
-    # this is relatively high because we are only looking for sentences that
-    # will have subject and object
-    MIN_SENTLENGTH = 100
-    MAX_SENTLENGTH = 512
-
-    # sentence termination pattern used in sentence_segmenter(paragr)
-    terpat = re.compile('[\.\?!]\s+[A-Z\"]')
-
-    # source: LbjNerTagger1.11.release/Data/KnownLists/known_title.lst from
-    # University of Illinois with editing
-    ABBREV_LIST = ['mrs.', 'ms.', 'mr.', 'dr.', 'gov.', 'sr.', 'rev.', 'r.n.',
-                   'pres.', 'treas.', 'sect.', 'maj.', 'ph.d.', 'ed. psy.',
-                   'proc.', 'fr.', 'asst.', 'p.f.c.', 'prof.', 'admr.',
-                   'engr.', 'mgr.', 'supt.', 'admin.', 'assoc.', 'voc.',
-                   'hon.', 'm.d.', 'dpty.', 'sec.', 'capt.', 'c.e.o.',
-                   'c.f.o.', 'c.i.o.', 'c.o.o.', 'c.p.a.', 'c.n.a.', 'acct.',
-                   'llc.', 'inc.', 'dir.', 'esq.', 'lt.', 'd.d.', 'ed.',
-                   'revd.', 'psy.d.', 'v.p.', 'senr.', 'gen.', 'prov.',
-                   'cmdr.', 'sgt.', 'sen.', 'col.', 'lieut.', 'cpl.', 'pfc.',
-                   'k.p.h.', 'cent.', 'deg.', 'doz.', 'Fahr.', 'Cel.', 'F.',
-                   'C.', 'K.', 'ft.', 'fur.', 'gal.', 'gr.', 'in.', 'kg.',
-                   'km.', 'kw.', 'l.', 'lat.', 'lb.', 'lb per sq in.', 'long.',
-                   'mg.', 'mm.,, m.p.g.', 'm.p.h.', 'cc.', 'qr.', 'qt.', 'sq.',
-                   't.', 'vol.', 'w.', 'wt.']
-
-    sentlist = []
-    # controls skipping over non-terminal conditions
-    searchstart = 0
-    terloc = terpat.search(paragr)
+    sentence: String.
+
+    """
+    length = len(paragr)
+
+    def char_at(index):
+        # index is relative to the current sentence start, and as in the
+        # original slicing version a negative one counts from the end of paragr
+        return paragr[start + index] if index >= 0 else paragr[length + index]
+
+    start = 0  # of the current sentence
+    cursor = 0  # the counts below are of paragr[start:cursor]
+    nopen = nclose = nquote = 0
+    terloc = SENTENCE_END.search(paragr)
     while terloc:
+        pos = terloc.start()
         isok = True
-        if paragr[terloc.start()] == '.':
-            if (paragr[terloc.start() - 1].isupper() and
-                    paragr[terloc.start() - 2] == ' '):
+        if paragr[pos] == '.':
+            if (char_at(pos - start - 1).isupper() and
+                    char_at(pos - start - 2) == ' '):
                 isok = False      # single initials
             else:
                 # check abbreviations
-                loc = paragr.rfind(' ', 0, terloc.start() - 1)
-                if loc > 0:
-                    if paragr[
-                            loc + 1:terloc.start() + 1].lower() in ABBREV_LIST:
+                stop = pos - 1 if pos - 1 >= start else length + pos - start - 1
+                loc = paragr.rfind(' ', start, stop)
+                if loc > start:
+                    if paragr[loc + 1:pos + 1].lower() in ABBREV_LIST:
                         isok = False
-        if paragr[:terloc.start()].count(
-                '(') != paragr[:terloc.start()].count(')'):
-            isok = False
-        if paragr[:terloc.start()].count('"') % 2 != 0:
+        chunk = paragr[cursor:pos]
+        nopen += chunk.count('(')
+        nclose += chunk.count(')')
+        nquote += chunk.count('"')
+        cursor = pos
+        if nopen != nclose or nquote % 2 != 0:
             isok = False
         if isok:
-            if (len(paragr[:terloc.start()]) > MIN_SENTLENGTH and
-                    len(paragr[:terloc.start()]) < MAX_SENTLENGTH):
-                sentlist.append(paragr[:terloc.start() + 2])
-            paragr = paragr[terloc.end() - 1:]
-            searchstart = 0
+            if MIN_SENTLENGTH < pos - start < MAX_SENTLENGTH:
+                yield paragr[start:pos + 2]
+            start = cursor = terloc.end() - 1
+            nopen = nclose = nquote = 0
+            searchstart = start
         else:
-            searchstart = terloc.start() + 2
+            searchstart = pos + 2
 
-        terloc = terpat.search(paragr, searchstart)
+        terloc = SENTENCE_END.search(paragr, searchstart)
 
     # add final sentence
-    if (len(paragr) > MIN_SENTLENGTH and len(paragr) < MAX_SENTLENGTH):
-        sentlist.append(paragr)
-
-    return sentlist
+    if MIN_SENTLENGTH < length - start < MAX_SENTLENGTH:
+        yield paragr[start:]
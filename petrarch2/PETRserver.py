@@ -0,0 +1,242 @@
+##	PETRserver.py [module]
+##
+# Local HTTP coding server for the PETRARCH event coder
+#
+# run_pipeline() reads the config and the dictionaries on every call, which for a
+# caller coding a batch at a time is most of the time spent. CodingServer is started
+# once by the serve command, after the dictionaries have been read, and codes
+# pre-parsed stories sent to it over HTTP:
+#
+#   POST /code     a JSON list of pipeline records -- as passed to run_pipeline(), with
+#                  parsed_sents or parsed_trees -- or {"records": [...]}. The reply is
+#                  the events in the shape of PETRwriter.pipe_output():
+#                  {StoryID: [event, ...]}
+#   GET  /health   a JSON summary of the server's state and counts
+#
+# Requests are put on a bounded queue and answered with 503 and a Retry-After header
+# when it is full, so that a caller sending faster than the stories can be coded is
+# slowed down rather than piling up work in memory. A single coding thread takes the
+# requests off the queue and codes the stories of several waiting requests together,
+# up to batch_size stories, in one pass of petrarch2.iter_coding(); the dictionaries
+# and the rest of PETRglobals are only ever used by that thread.
+#
+# loadgen.py measures the throughput of a running server.
+#
+# This code is covered under the MIT license
+# ------------------------------------------------------------------------
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import json
+import time
+import logging
+import threading
+from collections import Counter
+
+try:
+    import Queue as queue
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    import queue
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+import PETRglobals
+import PETRreader
+import PETRwriter
+
+
+class _Job(object):
+    """ The stories of one /code request, and its result once coded. """
+
+    __slots__ = ('stories', 'result', 'error', 'done')
+
+    def __init__(self, stories):
+        self.stories = stories
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class CodingServer(ThreadingMixIn, HTTPServer):
+    """
+    HTTP server that codes the stories of /code requests with code_stories -- a
+    function like petrarch2.iter_coding() -- in batches of up to batch_size stories.
+    At most queue_size requests wait to be coded; the coding thread waits up to
+    batch_wait seconds for more requests to fill a batch.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, code_stories, queue_size=64, batch_size=64,
+                 batch_wait=0.0):
+        HTTPServer.__init__(self, address, CodingRequestHandler)
+        self.code_stories = code_stories
+        self.jobs = queue.Queue(queue_size)
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.counts = Counter()
+        self.counts_lock = threading.Lock()
+        self.started = time.time()
+        self.coder = threading.Thread(target=self.code_jobs)
+        self.coder.daemon = True
+        self.coder.start()
+
+    def server_close(self):
+        """ Closes the socket and stops the coding thread once it has coded the queue. """
+        HTTPServer.server_close(self)
+        if self.coder.is_alive():
+            self.jobs.put(None)
+            self.coder.join()
+        while True:  # put by a request that was still being read
+            try:
+                job = self.jobs.get_nowait()
+            except queue.Empty:
+                break
+            if job is not None:
+                job.error = 'server closed'
+                job.done.set()
+
+    def count(self, name, n=1):
+        """ Adds n to counts[name]; the counts are kept by several threads. """
+        with self.counts_lock:
+            self.counts[name] += n
+
+    def code_jobs(self):
+        """
+        The coding thread: codes the waiting requests, a batch at a time, until it
+        takes the None that server_close() puts on the queue.
+        """
+        stopping = False
+        while not stopping:
+            jobs = [self.jobs.get()]
+            if jobs[0] is None:
+                return
+            size = len(jobs[0].stories)
+            deadline = time.time() + self.batch_wait
+            while size < self.batch_size:
+                try:
+                    wait = deadline - time.time()
+                    job = self.jobs.get(timeout=wait) if wait > 0 else \
+                        self.jobs.get_nowait()
+                except queue.Empty:
+                    break
+                if job is None:
+                    stopping = True
+                    break
+                jobs.append(job)
+                size += len(job.stories)
+            try:
+                self.code_batch(jobs)
+            except BaseException as e:  # a request must never be left waiting
+                logging.getLogger('petr_log').exception('Coding failed')
+                for job in jobs:
+                    if not job.done.is_set():
+                        job.error = '{}: {}'.format(type(e).__name__, e)
+                        job.done.set()
+
+    def code_batch(self, jobs):
+        """
+        Codes the stories of jobs together. If that fails the jobs are coded one by
+        one, so that a story the coder cannot handle only fails its own request.
+        """
+        stories = [pair for job in jobs for pair in job.stories]
+        quiet = PETRglobals.Quiet
+        PETRglobals.Quiet = True  # the coder reports every sentence
+        try:
+            coded = list(self.code_stories(stories))
+        except BaseException as e:  # including the coder's sys.exit() on bad input
+            coded = e
+            if len(jobs) == 1:
+                logging.getLogger('petr_log').exception('Coding failed')
+        finally:
+            PETRglobals.Quiet = quiet
+
+        if isinstance(coded, BaseException):
+            if len(jobs) > 1:
+                for job in jobs:
+                    self.code_batch([job])
+                return
+            jobs[0].error = '{}: {}'.format(type(coded).__name__, coded)
+        else:
+            start = 0
+            for job in jobs:
+                event_dict = dict(coded[start:start + len(job.stories)])
+                start += len(job.stories)
+                job.result = PETRwriter.pipe_output(event_dict)
+                self.count('events', sum(len(events)
+                                         for events in job.result.values()))
+        self.count('batches')
+        self.count('stories', len(stories))
+        for job in jobs:
+            job.done.set()
+
+    def health(self):
+        with self.counts_lock:
+            counts = self.counts.copy()
+        return {'status': 'ok',
+                'uptime': round(time.time() - self.started, 1),
+                'queued': self.jobs.qsize(),
+                'queue_size': self.jobs.maxsize,
+                'batch_size': self.batch_size,
+                'requests': counts['requests'],
+                'rejected': counts['rejected'],
+                'batches': counts['batches'],
+                'stories': counts['stories'],
+                'events': counts['events'],
+                'dictionaries': PETRglobals.DictVersion}
+
+
+class CodingRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.rstrip('/') == '/health':
+            self.send_json(200, self.server.health())
+        else:
+            self.send_json(404, {'error': 'not found: ' + self.path})
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/code':
+            self.send_json(404, {'error': 'not found: ' + self.path})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            records = json.loads(self.rfile.read(length).decode('utf-8'))
+            if isinstance(records, dict):
+                records = records['records']
+            stories = list(PETRreader.read_pipeline_input(records).items())
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            self.send_json(400, {'error': 'bad request: {}: {}'.format(
+                type(e).__name__, e)})
+            return
+
+        self.server.count('requests')
+        job = _Job(stories)
+        try:
+            self.server.jobs.put_nowait(job)
+        except queue.Full:
+            self.server.count('rejected')
+            self.send_json(503, {'error': 'coding queue full'}, {'Retry-After': '1'})
+            return
+        job.done.wait()
+        if job.error:
+            self.send_json(500, {'error': job.error})
+        else:
+            self.send_json(200, job.result)
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logging.getLogger('petr_log').debug('%s %s', self.address_string(),
+                                            format % args)
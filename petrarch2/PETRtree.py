@@ -6,6 +6,7 @@ from __future__ import unicode_literals
 
 import PETRglobals
 import PETRreader
+import PETRtrie
 import time
 import utilities
 import types
@@ -36,13 +37,28 @@ import logging
 # pas 16.04.22: print() statements commented-out with '# --' were used in
 # the debugging and can probably be removed
 
-class Phrase:
+# A phrase is made for every bracket of every parse, so the phrase classes use
+# __slots__. The methods that work out a value once and then keep returning it record
+# that they have run in these bits of Phrase.memo.
+_HEAD = 1              # get_head()
+_MEANING = 2           # NounPhrase.get_meaning() and VerbPhrase.get_meaning()
+_PASSIVE = 4           # VerbPhrase.check_passive()
+_FORCED_PASSIVE = 8    # VerbPhrase.get_code() found only a passive code
+_S = 16                # VerbPhrase.get_S()
+_UPPER = 32            # VerbPhrase.get_upper()
+
+
+class Phrase(object):
     """
     This is a general class for all Phrase instances, which make up the nodes in the syntactic tree.
     The three subtypes are below.
 
     """
 
+    __slots__ = ('label', 'children', 'phrasetype', 'annotation', 'text', 'parent',
+                 'meaning', 'verbclass', 'date', 'index', 'head', 'head_phrase',
+                 'color', 'sentence', 'memo')
+
     def __init__(self, label, date, sentence):
         """
         Initialization for Phrase classes.
@@ -73,6 +89,7 @@ class Phrase:
         self.head_phrase = None
         self.color = False
         self.sentence = sentence
+        self.memo = 0
 
     def get_meaning(self):
         """
@@ -232,9 +249,6 @@ class Phrase:
                     codes.add(code)
         return list(codes)
 
-    def return_head(self):
-        return self.head, self.head_phrase
-
     def get_head(self):
         """
         Method for finding the head of a phrase. The head of a phrase is the rightmost
@@ -253,7 +267,9 @@ class Phrase:
 
 
         """
-        self.get_head = self.return_head
+        if self.memo & _HEAD:
+            return self.head, self.head_phrase
+        self.memo |= _HEAD
         try:
             if self.label == 'S':
                 self.head, self.head_phrase = map(
@@ -304,12 +320,11 @@ class NounPhrase(Phrase):
 
     """
 
+    __slots__ = ()
+
     def __init__(self, label, date, sentence):
         Phrase.__init__(self, label, date, sentence)
 
-    def return_meaning(self):
-        return self.meaning
-
     def get_text(self):
         """
         Noun-specific get text method
@@ -403,69 +418,12 @@ class NounPhrase(Phrase):
 
         """
 
-        code = None
-        try:
-
-            for j in match:
-                dates = j[1]
-                date = []
-                code = ""
-                for d in dates:
-                    if d[0] in '<>':
-                        date.append(d[0] +
-                                    str(PETRreader.dstr_to_ordate(d[1:])))
-                    else:
-                        date.append(str(PETRreader.dstr_to_ordate(d)))
-                curdate = self.date
-                if not date:
-                    code = j[0]
-                elif len(date) == 1:
-                    if date[0][0] == '<':
-                        if curdate < int(date[0][1:]):
-                            code = j[0]
-                    else:
-                        if curdate >= int(date[0][1:]):
-                            code = j[0]
-                else:
-                    if curdate < int(date[1]):
-                        if curdate >= int(date[0]):
-                            code = j[0]
-
-                if code:
-                    return code
-        except Exception as e:
-            # print(e)
-            return code
-
-        return code
+        return PETRtrie.first_match(
+            PETRtrie.date_records(match, PETRreader.actor_date_interval), self.date)
 
     def get_meaning(self):
-
-        def recurse(path, words, length, so_far=""):
-
-            # --            print('NPgm-rec-lev:',len(getouterframes(currentframe(1))))  # --
-
-            if words and words[0] in path:
-                match = recurse(
-                    path[
-                        words[0]], words[
-                        1:], length + 1, so_far + " " + words[0])
-                if match:
-                    return match
-            if '#' in path:
-                if isinstance(path["#"], list):
-                    code = self.check_date(path['#'])
-                    if not code is None:
-                        # --                         print('NPgm-rec-1:',code)  # --
-                        # --                         print('NPgm-rec-1.1:',path['#'][-1])
-                        # 16.04.25 this branch always resolves to an actor;
-                        # path['#'][-1] is the root string
-                        return [code], so_far, length, [path['#'][-1]]
-                else:
-                    # --                    print('NPgm-rec-2:',path['#'])
-                    # 16.04.25 this branch always resolves to an agent
-                    return [path['#']], so_far, length
-            return False
+        if self.memo & _MEANING:
+            return self.meaning
 
         text_children = []
         PPcodes = []
@@ -542,27 +500,29 @@ class NounPhrase(Phrase):
         # check whether there are codes in the noun Phrase
         index = 0
         while index < len(text_children):
-            match = recurse(
-                PETRglobals.ActorDict, text_children[
-                    index:], 0)  # checking for actors
+            match = PETRglobals.ActorDict.match(
+                text_children, index, self.date)  # checking for actors
             if match:
                 # --                print('NPgm-m-1:',match)
-                codes += match[0]
-                roots += match[3]
-                index += match[2]
-                matched_txt += [match[1]]
+                node, length, code = match
+                codes += [code]
+                roots += [PETRglobals.ActorDict.root_entry(node)]
+                matched_txt += [''.join(' ' + word for word in
+                                        text_children[index:index + length])]
+                index += length
 # --                print('NPgm-1:',matched_txt)
                 continue
 
-            match = recurse(
-                PETRglobals.AgentDict, text_children[
-                    index:], 0)  # checking for agents
+            match = PETRglobals.AgentDict.match(
+                text_children, index, self.date)  # checking for agents
             if match:
                 # --                print('NPgm-2.0:',roots)
-                codes += match[0]
+                node, length, code = match
+                codes += [code]
                 roots += [['~']]
-                index += match[2]
-                matched_txt += [match[1]]
+                matched_txt += [''.join(' ' + word for word in
+                                        text_children[index:index + length])]
+                index += length
                 """print('NPgm-2:',matched_txt) # --
                 print('NPgm-2.1:',roots)"""
                 continue
@@ -606,7 +566,7 @@ class NounPhrase(Phrase):
             print('NPgm-m-roots     :',roots)"""
 
         self.meaning = self.mix_codes(agentcodes, actorcodes)
-        self.get_meaning = self.return_meaning
+        self.memo |= _MEANING
         """print('NPgm-3:',self.meaning)
         print('NPgm-4:',matched_txt)"""
         if matched_txt:
@@ -638,6 +598,8 @@ class NounPhrase(Phrase):
 
 class PrepPhrase(Phrase):
 
+    __slots__ = ('prep',)
+
     def __init__(self, label, date, sentence):
         Phrase.__init__(self, label, date, sentence)
         self.meaning = ""
@@ -691,6 +653,8 @@ class VerbPhrase(Phrase):
 
     """
 
+    __slots__ = ('upper', 'lower', 'passive', 'code', 'valid', 'S')
+
     def __init__(self, label, date, sentence):
         Phrase.__init__(self, label, date, sentence)
         self.meaning = ""    # "meaning" for the verb, i.e. the events coded by the vp
@@ -748,9 +712,6 @@ class VerbPhrase(Phrase):
             return m[0][0]
         return [m[0][1]]
 
-    def return_meaning(self):
-        return self.meaning
-
     def get_meaning(self):
         """
         This determines the event coding of the subtree rooted in this verb phrase.
@@ -793,8 +754,10 @@ class VerbPhrase(Phrase):
 
         """
 
+        if self.memo & _MEANING:
+            return self.meaning
         time1 = time.time()
-        self.get_meaning = self.return_meaning
+        self.memo |= _MEANING
 
         c, passive, meta = self.get_code()
         """print('VP-gm-0:',self.get_text())
@@ -940,12 +903,6 @@ class VerbPhrase(Phrase):
         self.meaning = maps
         return maps
 
-    def return_upper(self):
-        return self.upper
-
-    def return_passive(self):
-        return self.passive
-
     def check_passive(self):
         """
         Check if the verb is passive under these conditions:
@@ -962,7 +919,11 @@ class VerbPhrase(Phrase):
                       Whether or not it is passive
         """
 # --          print('cp-entry')
-        self.check_passive = self.return_passive
+        if self.memo & _FORCED_PASSIVE:
+            return True
+        if self.memo & _PASSIVE:
+            return self.passive
+        self.memo |= _PASSIVE
         if True:
             if self.children[0].label in ["VBD", "VBN"]:
                 level = self.parent
@@ -984,10 +945,6 @@ class VerbPhrase(Phrase):
         self.passive = False
         return False
 
-    def return_S(self):
-        # --          print('rS-entry')
-        return self.S
-
     def get_S(self):
         """
         Navigate up the tree following a VP path to find the closest s-level phrase.
@@ -1005,7 +962,9 @@ class VerbPhrase(Phrase):
                Lowest non-TO S-level phrase object above the verb
         """
 # --          print('gS-entry')
-        self.get_S = self.return_S
+        if self.memo & _S:
+            return self.S
+        self.memo |= _S
         not_found = True
         level = self
         while not_found and not level.parent is None:
@@ -1034,7 +993,9 @@ class VerbPhrase(Phrase):
         self.upper: List
                     Actor codes of spec-VP
         """
-        self.get_upper = self.return_upper
+        if self.memo & _UPPER:
+            return self.upper
+        self.memo |= _UPPER
         for child in self.parent.children:
             if isinstance(child, NounPhrase) and not child.get_meaning() == [
                     "~"]:
@@ -1043,9 +1004,6 @@ class VerbPhrase(Phrase):
                 return self.upper
         return []
 
-    def return_lower(self):
-        return self.lower
-
     def get_lower(self):
         """
         Find the meaning of the children of the VP, and whether or not there is a "not" in the VP.
@@ -1070,8 +1028,6 @@ class VerbPhrase(Phrase):
 
         """
 
-#        self.get_lower = self.return_lower
-
         lower = []
         v_options = filter(
             lambda a: (
@@ -1145,9 +1101,6 @@ class VerbPhrase(Phrase):
         self.lower = self.mix_codes(agentcodes, actorcodes)
         return self.lower, negated
 
-    def return_code(self):
-        return self.code
-
     def get_code(self):
         """
         Match the codes from the Verb Dictionary.
@@ -1167,7 +1120,6 @@ class VerbPhrase(Phrase):
                 Code described by this verb, best read in hex
         """
 
-#        self.get_code = self.return_code
         meta = []
         dict = PETRglobals.VerbDict['verbs']
         if 'AND' in map(lambda a: a.text, self.children):
@@ -1223,7 +1175,7 @@ class VerbPhrase(Phrase):
             active, passive = utilities.convert_code(match['code'])
             self.code = active
         if passive and not active:
-            self.check_passive = lambda: True
+            self.memo |= _FORCED_PASSIVE
             self.code = passive
         return self.code, passive, meta
 
@@ -1522,8 +1474,8 @@ class Sentence:
 
     """
 
-    def __init__(self, parse, text, date):
-        self.treestr = parse.replace(')', ' )')
+    def __init__(self, parse, text, date, tokens=None):
+        self.tokens = tokens  # utilities.SentenceTokens shared with the other stages
         self.parse = parse
         self.agent = ""
         self.ID = -1
@@ -1532,9 +1484,10 @@ class Sentence:
         self.longlat = (-1, -1)
         self.verbs = []  # 16.06.23: nice, but is this actually used anywhere?
         self.txt = ""
-        self.tree = self.str_to_tree(parse.strip())
+        self.tree = self.str_to_tree(parse)
         self.verb_analysis = {}
         self.events = []
+        self.coded = False  # get_events() has run
         self.metadata = {'nouns': []}
         if PETRglobals.NullVerbs or PETRglobals.NullActors:
             #            self.metadata['nulls'] = [] # is this still needed?
@@ -1549,31 +1502,35 @@ class Sentence:
         Parameters
         -----------
         str: string
-             Pre-processed CoreNLP parse, needs to be formated by utilities.format_parsed_str
-             before being passed.
+             CoreNLP parse, either as read or as formatted by
+             utilities._format_parsed_str(). It is only read if the sentence has no
+             SentenceTokens, whose segs are used instead.
 
         Returns
         -------
         root: Phrase object
               Top level of the tree that represents the sentence
         """
-        segs = str.split()
-        root = Phrase(segs[0][1:], self.date, self)
+        segs = self.tokens.segs if self.tokens is not None else \
+            utilities.parse_tokens(str)
+        date = self.date
+        root = Phrase(segs[0][1:], date, self)
         level_stack = [root]
         existentials = []
+        words = []
 
         for element in segs[1:]:
-            if element.startswith("("):
+            if element[0] == "(":
                 lab = element[1:]
                 if lab == "NP":
-                    new = NounPhrase(lab, self.date, self)
+                    new = NounPhrase(lab, date, self)
                 elif lab == "VP":
-                    new = VerbPhrase(lab, self.date, self)
+                    new = VerbPhrase(lab, date, self)
                     self.verbs.append(new)
                 elif lab == "PP":
-                    new = PrepPhrase(lab, self.date, self)
+                    new = PrepPhrase(lab, date, self)
                 else:
-                    new = Phrase(lab, self.date, self)
+                    new = Phrase(lab, date, self)
                     if lab == "EX":
                         existentials.append(new)
 
@@ -1581,14 +1538,16 @@ class Sentence:
                 new.index = len(level_stack[-1].children)
                 level_stack[-1].children.append(new)
                 level_stack.append(new)
-            elif element.endswith(")"):
+            elif element[-1] == ")":
                 try:
                     level_stack.pop()
-                except:
+                except IndexError:
                     break
             else:
                 level_stack[-1].text = element
-                self.txt += " " + element
+                words.append(element)
+        if words:
+            self.txt = " " + " ".join(words)
 
         for element in existentials:
             try:
@@ -1619,9 +1578,6 @@ class Sentence:
             next = store[0]
         return map(lambda a: a[-2] if len(a) > 1 else a[0], meta_total[::-1])
 
-    def return_events(self):
-        return self.events
-
     def get_events(self, require_dyad=1):
         """
         Take the coding of the highest verb phrase and return that, given:
@@ -1646,6 +1602,8 @@ class Sentence:
             print('==',ch.label, ch.get_text())
         for ch in self.tree.children:
             print('--',ch.label, ch.get_text())"""
+        if self.coded:
+            return self.events
         if PETRglobals.NullVerbs or PETRglobals.NullActors:
             utilities.nulllist = []
         events = map(
@@ -1717,7 +1675,7 @@ class Sentence:
                                         # aren't going into 'meta'
 
             self.events = list(set(valid))
-            self.get_events = self.return_events
+            self.coded = True
 #--            print('GF3',valid,'\nGF4',meta) # --
             return valid, meta
         except Exception as e:  # 16.06.27 pas: need to log this, and also figure out where it comes from
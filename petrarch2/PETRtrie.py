@@ -0,0 +1,913 @@
+##	PETRtrie.py [module]
+##
+# Compact, array-backed form of the actor dictionary for the PETRARCH event coder
+#
+# read_actor_dictionary() builds PETRglobals.ActorDict as a tree of nested dicts, one
+# dict per word per node, which for the Phoenix actor files is several hundred thousand
+# small dicts. Once all of the actor files have been read, that tree is compiled into an
+# ActorTrie: the words are interned as integers and the tree is stored breadth-first in
+# flat arrays, so the children of a node are a contiguous, sorted run of node ids that
+# can be searched with bisect. The codes and their date restrictions go into a side
+# table of (code, start ordinal, end ordinal) records. The agent dictionary, whose
+# nodes hold a bare code rather than a list of dated codes, is compiled the same way.
+#
+# write_image() lays compiled tries, and plain trees of dicts such as the verb
+# dictionary, out in a flat binary file and open_image() maps it back read-only with
+# mmap: the tries and MappedDicts it returns read straight from the mapped pages, so
+# every coding process on a host shares a single physical copy of the dictionaries
+# instead of holding its own.
+#
+# This code is covered under the MIT license
+# ------------------------------------------------------------------------
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import sys
+import mmap
+import numbers
+import struct
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque
+
+# Interval bounds of a date restriction record. A record applies to a date when
+# lo <= date < hi; NO_LO and NO_HI mark a missing bound. POISON marks a restriction
+# that NounPhrase.check_date() could not evaluate: in that case the lookup stops and
+# returns the null code '' -- see PETRreader.actor_date_interval()
+POISON = -2 ** 31
+NO_LO = -2 ** 31 + 1
+NO_HI = 2 ** 31 - 1
+
+# seg_code values that are not code ids: the null code '' and no code at all (None)
+NULL_CODE = -1
+NO_CODE = -2
+
+
+def _to_bytes(arr):
+    return arr.tobytes() if hasattr(arr, 'tobytes') else arr.tostring()
+
+
+def _from_bytes(typecode, data):
+    arr = array(str(typecode))
+    if hasattr(arr, 'frombytes'):
+        arr.frombytes(data)
+    else:
+        arr.fromstring(data)
+    return arr
+
+
+def date_records(entries, date_interval):
+    """
+    Converts the '#' list of an actor -- (code, dates) entries, plus the root phrase
+    when WriteActorRoot is set -- into (lo, hi, code) records for first_match(). The
+    root phrase is never a match: it gets a POISON record whose code is None if
+    check_date() would have failed on it before setting a code (a one-word phrase).
+    """
+    records = []
+    for entry in entries:
+        if isinstance(entry, tuple):
+            records.append(date_interval(entry[1]) + (entry[0],))
+        else:
+            records.append((POISON, NO_HI, None if len(entry) < 2 else ''))
+    return records
+
+
+def first_match(records, date):
+    """
+    The code that the (lo, hi, code) records of an actor give on date, with the
+    semantics of NounPhrase.check_date(): the first record with a non-empty code whose
+    interval contains date wins; a POISON record reached first stops the search with
+    the null code ''; no records at all give None.
+    """
+    if not records:
+        return None
+    for index, (lo, hi, code) in enumerate(records):
+        if hi != NO_HI and not date < hi:
+            continue
+        if lo == POISON:
+            return None if index == 0 and code is None else ''
+        if (lo == NO_LO or date >= lo) and code:
+            return code
+    return ''
+
+
+class ActorTrie(object):
+    """
+    Read-only actor dictionary.
+
+    Nodes are numbered breadth-first from the root (node 0), so the children of node n
+    are the nodes first_child[n] ... first_child[n + 1] - 1, sorted on the id of the
+    word leading to them (node_token). The records of node n -- the entries of the
+    '#' list in the nested-dict form -- are first_record[n] ... first_record[n + 1] - 1.
+
+    The date restrictions of a node are precompiled into segments
+    first_segment[n] ... first_segment[n + 1] - 1: segment i covers the dates from
+    seg_bound[i] up to the bound of the next segment and resolves to seg_code[i], so
+    finding the code for a date is a bisect over the bounds. The first segment of a
+    node is open below and its seg_bound entry is unused.
+
+    Lookups go through match(); to_dict() and item access rebuild the nested dicts
+    produced by read_actor_dictionary(), which is only intended for debugging and tests.
+
+    A trie compiled with single=True holds the agent dictionary: each node has at most
+    one record, which is a bare code with no date restriction.
+    """
+
+    _arrays = [('node_token', 'i'), ('first_child', 'i'), ('first_record', 'i'),
+               ('terminal', 'b'), ('rec_code', 'i'), ('rec_dates', 'i'),
+               ('first_segment', 'i'), ('seg_bound', 'i'), ('seg_code', 'i')]
+
+    __slots__ = ['single', 'tokens', 'token_ids', 'codes', 'date_specs', 'extras'] + \
+        [name for name, _ in _arrays]
+
+    @classmethod
+    def from_dict(cls, actordict, date_interval=None):
+        """
+        Compiles the nested-dict actor dictionary. date_interval(dates) converts the
+        date restrictions of an entry to its (lo, hi) record bounds; without it the
+        dictionary is taken to be in the agent format.
+        """
+        trie = cls()
+        trie.single = date_interval is None
+        words = set()
+        queue = deque([actordict])
+        while queue:
+            node = queue.popleft()
+            for word, child in node.items():
+                if word != '#':
+                    words.add(word)
+                    queue.append(child)
+        trie.tokens = sorted(words)
+        trie.token_ids = dict((word, i) for i, word in enumerate(trie.tokens))
+
+        for name, typecode in cls._arrays:
+            setattr(trie, name, array(str(typecode)))
+        trie.codes = []
+        trie.date_specs = []
+        trie.extras = {}
+        code_ids = {}
+        date_ids = {}
+
+        def code_id(code):
+            if code not in code_ids:
+                code_ids[code] = len(trie.codes)
+                trie.codes.append(code)
+            return code_ids[code]
+
+        trie.node_token.append(-1)
+        queue = deque([actordict])
+        while queue:
+            node = queue.popleft()
+            trie.first_child.append(len(trie.node_token))
+            trie.first_record.append(len(trie.rec_code))
+            trie.first_segment.append(len(trie.seg_code))
+            children = sorted((trie.token_ids[word], child)
+                              for word, child in node.items() if word != '#')
+            for tid, child in children:
+                trie.node_token.append(tid)
+                queue.append(child)
+
+            trie.terminal.append('#' in node)
+            if '#' not in node:
+                continue
+            if trie.single:
+                trie.rec_code.append(code_id(node['#']))
+                trie.rec_dates.append(-1)
+                trie.seg_bound.append(NO_LO)
+                trie.seg_code.append(code_id(node['#']))
+                continue
+
+            for entry in node['#']:
+                if isinstance(entry, tuple):
+                    dates = tuple(entry[1])
+                    if dates not in date_ids:
+                        date_ids[dates] = len(trie.date_specs)
+                        trie.date_specs.append(dates)
+                    trie.rec_code.append(code_id(entry[0]))
+                    trie.rec_dates.append(date_ids[dates])
+                else:
+                    # root phrase stored when WriteActorRoot is set
+                    trie.extras[len(trie.rec_code)] = entry
+                    trie.rec_code.append(-1)
+                    trie.rec_dates.append(-1)
+
+            # the code only changes at the record bounds: evaluate each stretch once
+            records = date_records(node['#'], date_interval)
+            bounds = sorted(set(bound for lo, hi, _ in records for bound in (lo, hi)
+                                if bound not in (POISON, NO_LO, NO_HI)))
+            previous = None
+            for bound in [NO_LO] + bounds:
+                code = first_match(records, bound)
+                if code is None:
+                    code = NO_CODE
+                elif code == '':
+                    code = NULL_CODE
+                else:
+                    code = code_id(code)
+                if code != previous:
+                    trie.seg_bound.append(bound)
+                    trie.seg_code.append(code)
+                    previous = code
+
+        trie.first_child.append(len(trie.node_token))
+        trie.first_record.append(len(trie.rec_code))
+        trie.first_segment.append(len(trie.seg_code))
+        return trie
+
+    def __getstate__(self):
+        state = dict((name, _to_bytes(getattr(self, name)))
+                     for name, _ in self._arrays)
+        state.update(single=self.single, tokens=list(self.tokens),
+                     codes=list(self.codes), date_specs=list(self.date_specs),
+                     extras=dict(self.extras.items()))
+        return state
+
+    def __setstate__(self, state):
+        for name, typecode in self._arrays:
+            setattr(self, name, _from_bytes(typecode, state[name]))
+        self.single = state['single']
+        self.tokens = state['tokens']
+        self.codes = state['codes']
+        self.date_specs = state['date_specs']
+        self.extras = state['extras']
+        self.token_ids = dict((word, i) for i, word in enumerate(self.tokens))
+
+    # ---- lookups ---- #
+
+    def child(self, node, word):
+        """ Returns the child of node reached by word, or -1. """
+        tid = self.token_ids.get(word)
+        if tid is None:
+            return -1
+        hi = self.first_child[node + 1]
+        i = bisect_left(self.node_token, tid, self.first_child[node], hi)
+        if i < hi and self.node_token[i] == tid:
+            return i
+        return -1
+
+    def resolve(self, node, date):
+        """
+        Returns the code of node that applies on date: the first record whose date
+        restriction contains date, '' if there are records but none applies, and None
+        if node has no records.
+        """
+        start = self.first_segment[node]
+        end = self.first_segment[node + 1]
+        if start == end:
+            return None
+        code = self.seg_code[bisect_right(self.seg_bound, date, start + 1, end) - 1]
+        if code >= 0:
+            return self.codes[code]
+        return '' if code == NULL_CODE else None
+
+    def match(self, words, start, date):
+        """
+        Finds the longest phrase in the dictionary that begins at words[start] and has
+        a code for date, backing off to shorter phrases as needed.
+
+        Returns (node, length, code) or None.
+        """
+        path = [0]
+        node = 0
+        for word in words[start:]:
+            node = self.child(node, word)
+            if node < 0:
+                break
+            path.append(node)
+        for length in range(len(path) - 1, -1, -1):
+            code = self.resolve(path[length], date)
+            if code is not None:
+                return path[length], length, code
+        return None
+
+    def entry(self, rec):
+        """ Rebuilds the '#' list entry of record rec. """
+        if self.single:
+            return self.codes[self.rec_code[rec]]
+        if rec in self.extras:
+            return self.extras[rec]
+        return (self.codes[self.rec_code[rec]],
+                list(self.date_specs[self.rec_dates[rec]]))
+
+    def root_entry(self, node):
+        """ The last entry stored at node: the root phrase if WriteActorRoot is set. """
+        return self.entry(self.first_record[node + 1] - 1)
+
+    # ---- nested-dict view ---- #
+
+    def to_dict(self, node=0):
+        """ Rebuilds the nested-dict form of the subtree rooted at node. """
+        result = {}
+        for child in range(self.first_child[node], self.first_child[node + 1]):
+            result[self.tokens[self.node_token[child]]] = self.to_dict(child)
+        if self.terminal[node] and self.single:
+            result['#'] = self.entry(self.first_record[node])
+        elif self.terminal[node]:
+            result['#'] = [self.entry(rec) for rec in
+                           range(self.first_record[node], self.first_record[node + 1])]
+        return result
+
+    def has_phrase_in(self, words):
+        """
+        Returns True if some phrase of the trie is made up only of words in the set
+        words, whatever their order. This is a cheap necessary condition for match()
+        to find a phrase in a sentence with those words.
+        """
+        word_ids = [self.token_ids.get(word) for word in words]
+        word_ids = [tid for tid in word_ids if tid is not None]
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            lo = self.first_child[node]
+            hi = self.first_child[node + 1]
+            for tid in word_ids:
+                i = bisect_left(self.node_token, tid, lo, hi)
+                if i < hi and self.node_token[i] == tid:
+                    if self.terminal[i]:
+                        return True
+                    stack.append(i)
+        return False
+
+    def __contains__(self, word):
+        return self.child(0, word) >= 0
+
+    def __getitem__(self, word):
+        node = self.child(0, word)
+        if node < 0:
+            raise KeyError(word)
+        return self.to_dict(node)
+
+    def __len__(self):
+        return self.first_child[1] - self.first_child[0]
+
+
+# ==== Multi-phrase matching
+
+
+class PhraseAutomaton(object):
+    """
+    Aho-Corasick automaton over word tokens: finds every occurrence of a set of
+    phrases in a token list in a single left-to-right pass, however the phrases
+    overlap.
+
+    States are numbered from the root (state 0); goto[s] maps a word to the next
+    state, fail[s] is the state of the longest proper suffix of s that is also a
+    phrase prefix, and outputs[s] lists (length, value) for every phrase ending at s,
+    including those inherited through the failure links, longest first.
+    """
+
+    __slots__ = ['goto', 'fail', 'outputs']
+
+    def __init__(self, phrases):
+        """ phrases is an iterable of (words, value) pairs. """
+        self.goto = [{}]
+        self.outputs = [[]]
+        for words, value in phrases:
+            state = 0
+            for word in words:
+                if word not in self.goto[state]:
+                    self.goto[state][word] = len(self.goto)
+                    self.goto.append({})
+                    self.outputs.append([])
+                state = self.goto[state][word]
+            self.outputs[state].append((len(words), value))
+
+        # breadth-first, so that the failure state of every state is done before it
+        self.fail = [0] * len(self.goto)
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for word, nxt in self.goto[state].items():
+                queue.append(nxt)
+                back = self.fail[state]
+                while back and word not in self.goto[back]:
+                    back = self.fail[back]
+                self.fail[nxt] = self.goto[back].get(word, 0)
+                self.outputs[nxt] = sorted(
+                    self.outputs[nxt] + self.outputs[self.fail[nxt]], reverse=True)
+
+    def __len__(self):
+        return len(self.goto)
+
+    def finditer(self, words):
+        """
+        Yields (end, length, value) for every phrase occurring in words, where the
+        phrase is words[end - length + 1:end + 1], in order of end position.
+        """
+        goto = self.goto
+        fail = self.fail
+        outputs = self.outputs
+        root = goto[0]
+        state = 0
+        for end, word in enumerate(words):
+            if not state and word not in root:
+                continue  # the common case: nothing under way, nothing starting
+            while state and word not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(word, 0)
+            if outputs[state]:
+                for length, value in outputs[state]:
+                    yield end, length, value
+
+
+# ==== Memory-mapped dictionary image
+#
+# The image is written in the native byte order of the host that compiled it (the
+# mapped arrays are read without conversion) and starts with a fixed header:
+#
+#   magic      8 bytes   ImageMagic
+#   byteorder  1 byte    b'<' or b'>'
+#   key       40 bytes   the dictionary manifest key, see PETRreader
+#   count      int32     number of sections
+#
+# followed by count (name, kind, offset) entries pointing to the sections. A section
+# holds either a compiled trie (ImageTrie) or a tree of dicts, lists and strings such
+# as the verb dictionary (ImageTree).
+#
+# A trie section is a directory of (offset, length) pairs for its parts, in the order
+# of _image_parts, followed by the parts themselves. Integer parts are int32 arrays;
+# the string tables are an int32 array of offsets into a UTF-8 blob. Date restrictions
+# and root phrases are stored as strings joined with ImageSep.
+#
+# A tree section is a set of records, each starting with a one-byte type tag; the
+# section offset points to the root record. See _TreeWriter for the record layout.
+
+ImageMagic = b'PETRIMG\x02'
+ImageSep = '\x1f'
+ImageTrie = 1
+ImageTree = 2
+
+_image_header = struct.Struct(str('=8sc40si'))
+_image_entry = struct.Struct(str('=16siq'))
+_image_part = struct.Struct(str('=qq'))
+_image_parts = [name for name, _ in ActorTrie._arrays] + [
+    'flags', 'token_order', 'token_offsets', 'token_blob', 'code_offsets',
+    'code_blob', 'date_offsets', 'date_blob', 'extra_recs', 'extra_offsets',
+    'extra_blob']
+
+
+def _byteorder():
+    return b'<' if sys.byteorder == 'little' else b'>'
+
+
+def _align(size):
+    return (size + 7) & ~7
+
+
+def _string_table(strings):
+    offsets = array(str('i'), [0])
+    blob = []
+    for text in strings:
+        data = text.encode('utf-8')
+        blob.append(data)
+        offsets.append(offsets[-1] + len(data))
+    return _to_bytes(offsets), b''.join(blob)
+
+
+def _trie_section(trie, offset):
+    # the bytes of trie laid out at offset: the part directory, then the parts
+    parts = dict((name, _to_bytes(getattr(trie, name)))
+                 for name, _ in trie._arrays)
+    parts['flags'] = _to_bytes(array(str('i'), [int(trie.single)]))
+    encoded = [token.encode('utf-8') for token in trie.tokens]
+    parts['token_order'] = _to_bytes(array(str('i'), sorted(
+        range(len(encoded)), key=encoded.__getitem__)))
+    parts['token_offsets'], parts['token_blob'] = _string_table(trie.tokens)
+    parts['code_offsets'], parts['code_blob'] = _string_table(trie.codes)
+    parts['date_offsets'], parts['date_blob'] = _string_table(
+        ImageSep.join(dates) for dates in trie.date_specs)
+    recs = sorted(trie.extras)
+    parts['extra_recs'] = _to_bytes(array(str('i'), recs))
+    parts['extra_offsets'], parts['extra_blob'] = _string_table(
+        ImageSep.join(trie.extras[rec]) for rec in recs)
+
+    directory = []
+    chunks = []
+    start = offset + _image_part.size * len(_image_parts)
+    for name in _image_parts:
+        padded = _align(start)
+        chunks.append(b'\0' * (padded - start) + parts[name])
+        directory.append(_image_part.pack(padded, len(parts[name])))
+        start = padded + len(parts[name])
+    return b''.join(directory + chunks)
+
+
+_text_type = type('')
+_missing = object()  # marks a key that is not in a mapped section or cache
+_count = struct.Struct(str('=I'))
+_integer = struct.Struct(str('=q'))
+
+
+def _search_key(key):
+    # the bytes that tree dicts are sorted and searched on: equal keys give equal
+    # bytes whatever their string type. None for a key type that cannot be stored.
+    if isinstance(key, _text_type):
+        return b's' + key.encode('utf-8')
+    if isinstance(key, bytes):
+        return b's' + key
+    if isinstance(key, numbers.Integral):
+        return b'i' + str(int(key)).encode('ascii')
+    return None
+
+
+class _TreeWriter(object):
+    """
+    Encodes a tree of dicts, lists, tuples, strings, integers and None. Every record
+    starts with a tag byte; counts and record offsets (relative to the start of the
+    section) are uint32:
+
+        b'd'  count, then count (search key, key, value) offsets sorted on the key
+        b'l'  count, then count item offsets; b't' for tuples
+        b'u'  length, then the UTF-8 bytes of a text string; b'b' for byte strings
+        b'i'  int64
+        b'N'  None
+
+    Search keys (see _search_key) are stored untagged as length and bytes. Equal
+    scalars and search keys are written only once.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+        self.memo = {}
+
+    def emit(self, data):
+        offset = self.size
+        self.chunks.append(data)
+        self.size += len(data)
+        return offset
+
+    def scalar(self, memo_key, data):
+        if memo_key not in self.memo:
+            self.memo[memo_key] = self.emit(data)
+        return self.memo[memo_key]
+
+    def write(self, obj):
+        if obj is None:
+            return self.scalar(('N',), b'N')
+        if isinstance(obj, _text_type):
+            data = obj.encode('utf-8')
+            return self.scalar(('u', obj), b'u' + _count.pack(len(data)) + data)
+        if isinstance(obj, bytes):
+            return self.scalar(('b', obj), b'b' + _count.pack(len(obj)) + obj)
+        if isinstance(obj, (list, tuple)):
+            items = [self.write(item) for item in obj]
+            tag = b'l' if isinstance(obj, list) else b't'
+            return self.emit(tag + _count.pack(len(items)) +
+                             b''.join(_count.pack(item) for item in items))
+        if isinstance(obj, dict):
+            entries = []
+            for key, value in obj.items():
+                skey = _search_key(key)
+                if skey is None:
+                    raise TypeError('Cannot map dictionary key {!r}'.format(key))
+                entries.append((skey,
+                                self.scalar(('k', skey),
+                                            _count.pack(len(skey)) + skey),
+                                self.write(key), self.write(value)))
+            entries.sort()
+            return self.emit(b'd' + _count.pack(len(entries)) + b''.join(
+                _count.pack(sk) + _count.pack(k) + _count.pack(v)
+                for _, sk, k, v in entries))
+        if _search_key(obj) is not None and not isinstance(obj, bool):
+            return self.scalar(('i', obj), b'i' + _integer.pack(obj))
+        raise TypeError('Cannot map {!r}'.format(obj))
+
+    def section(self, obj):
+        # the bytes of obj: the root offset, then the records
+        root = self.write(obj)
+        return _integer.pack(root) + b''.join(self.chunks)
+
+
+def write_image(path, key, sections):
+    """
+    Writes sections, a list of (name, value) pairs where each value is an ActorTrie or
+    a tree of dicts, lists and strings, to the image file path. key identifies the
+    dictionaries they were compiled from and is checked by open_image().
+    """
+    offset = _image_header.size + _image_entry.size * len(sections)
+    entries = []
+    chunks = []
+    for name, value in sections:
+        offset = _align(offset)
+        if isinstance(value, ActorTrie):
+            kind = ImageTrie
+            data = _trie_section(value, offset)
+        else:
+            kind = ImageTree
+            data = _TreeWriter().section(value)
+        entries.append(_image_entry.pack(name.encode('ascii'), kind, offset))
+        chunks.append((offset, data))
+        offset += len(data)
+
+    with open(path, 'wb') as fout:
+        fout.write(_image_header.pack(ImageMagic, _byteorder(),
+                                      key.encode('ascii'), len(sections)))
+        fout.write(b''.join(entries))
+        for start, data in chunks:
+            fout.write(b'\0' * (start - fout.tell()))
+            fout.write(data)
+
+
+class _ArrayView(object):
+    """ Read-only array of typecode 'i' or 'b' over a slice of a buffer. """
+
+    __slots__ = ['buf', 'offset', 'count', 'item']
+
+    def __init__(self, buf, offset, nbytes, typecode):
+        self.buf = buf
+        self.offset = offset
+        self.item = struct.Struct(str('=' + typecode))
+        self.count = nbytes // self.item.size
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError(index)
+        return self.item.unpack_from(self.buf, self.offset + self.item.size * index)[0]
+
+    def __iter__(self):
+        for index in range(self.count):
+            yield self[index]
+
+    def tobytes(self):
+        return self.buf[self.offset:self.offset + self.item.size * self.count]
+
+
+def _array_view(buf, offset, nbytes, typecode='i'):
+    # Python 3 can index the mapped arrays directly through a memoryview
+    if hasattr(memoryview, 'cast'):
+        return memoryview(buf)[offset:offset + nbytes].cast(typecode)
+    return _ArrayView(buf, offset, nbytes, typecode)
+
+
+class _StringView(object):
+    """ Read-only list of strings stored as an offset array and a UTF-8 blob. """
+
+    __slots__ = ['buf', 'offsets', 'blob', 'split']
+
+    def __init__(self, buf, offsets, blob, split=False):
+        self.buf = buf
+        self.offsets = offsets
+        self.blob = blob
+        self.split = split
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def raw(self, index):
+        return self.buf[self.blob + self.offsets[index]:
+                        self.blob + self.offsets[index + 1]]
+
+    def __getitem__(self, index):
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        text = self.raw(index).decode('utf-8')
+        if self.split:
+            return tuple(text.split(ImageSep)) if text else ()
+        return text
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+
+class _TokenIndex(object):
+    """
+    Word -> token id lookup by binary search over the tokens in byte order. The
+    answer for each word looked up, found or not, is kept in cache.
+    """
+
+    __slots__ = ['tokens', 'order', 'cache']
+
+    def __init__(self, tokens, order):
+        self.tokens = tokens
+        self.order = order
+        self.cache = {}
+
+    def get(self, word, default=None):
+        token = self.cache.get(word, _missing)
+        if token is _missing:
+            token = self.cache[word] = self._search(word)
+        return default if token is None else token
+
+    def _search(self, word):
+        key = word.encode('utf-8')
+        lo, hi = 0, len(self.order)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.tokens.raw(self.order[mid]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self.order) and self.tokens.raw(self.order[lo]) == key:
+            return self.order[lo]
+        return None
+
+
+class _ExtrasView(object):
+    """ Record id -> root phrase mapping over the sorted record ids. """
+
+    __slots__ = ['recs', 'phrases']
+
+    def __init__(self, recs, phrases):
+        self.recs = recs
+        self.phrases = phrases
+
+    def _find(self, rec):
+        i = bisect_left(self.recs, rec)
+        return i if i < len(self.recs) and self.recs[i] == rec else -1
+
+    def __contains__(self, rec):
+        return self._find(rec) >= 0
+
+    def __getitem__(self, rec):
+        i = self._find(rec)
+        if i < 0:
+            raise KeyError(rec)
+        return list(self.phrases[i])
+
+    def get(self, rec, default=None):
+        return self[rec] if rec in self else default
+
+    def items(self):
+        return [(rec, list(self.phrases[i])) for i, rec in enumerate(self.recs)]
+
+
+def _map_trie(buf, offset):
+    parts = {}
+    for j, part in enumerate(_image_parts):
+        parts[part] = _image_part.unpack_from(buf, offset + j * _image_part.size)
+
+    def ints(part, typecode='i'):
+        return _array_view(buf, parts[part][0], parts[part][1], typecode)
+
+    trie = ActorTrie()
+    for name, typecode in ActorTrie._arrays:
+        setattr(trie, name, ints(name, typecode))
+    trie.single = bool(ints('flags')[0])
+    trie.tokens = _StringView(buf, ints('token_offsets'), parts['token_blob'][0])
+    trie.token_ids = _TokenIndex(trie.tokens, ints('token_order'))
+    trie.codes = _StringView(buf, ints('code_offsets'), parts['code_blob'][0])
+    trie.date_specs = _StringView(buf, ints('date_offsets'),
+                                  parts['date_blob'][0], split=True)
+    trie.extras = _ExtrasView(ints('extra_recs'), _StringView(
+        buf, ints('extra_offsets'), parts['extra_blob'][0], split=True))
+    return trie
+
+
+def _tree_value(buf, base, offset):
+    # decodes the record at offset: dicts stay mapped, everything else is copied out
+    tag = buf[base + offset:base + offset + 1]
+    if tag == b'd':
+        return MappedDict(buf, base, offset)
+    if tag in (b'u', b'b'):
+        size = _count.unpack_from(buf, base + offset + 1)[0]
+        data = buf[base + offset + 5:base + offset + 5 + size]
+        return data.decode('utf-8') if tag == b'u' else data
+    if tag in (b'l', b't'):
+        count = _count.unpack_from(buf, base + offset + 1)[0]
+        items = [_tree_value(buf, base, _count.unpack_from(
+            buf, base + offset + 5 + 4 * i)[0]) for i in range(count)]
+        return items if tag == b'l' else tuple(items)
+    if tag == b'i':
+        return _integer.unpack_from(buf, base + offset + 1)[0]
+    return None
+
+
+class MappedDict(object):
+    """
+    Read-only dict stored in a tree section of a mapped image. Lookups binary-search
+    the sorted keys in place; nested dicts are returned as further MappedDicts and
+    all other values as ordinary Python objects. The value decoded for each key
+    looked up, or its absence, is kept in cache, so that only the first lookup of a
+    key pays for the search and the copy: like a dict, later lookups return the
+    same object.
+    """
+
+    __slots__ = ['buf', 'base', 'offset', 'count', 'cache']
+
+    _entry = struct.Struct(str('=III'))
+
+    def __init__(self, buf, base, offset):
+        self.buf = buf
+        self.base = base
+        self.offset = offset
+        self.count = _count.unpack_from(buf, base + offset + 1)[0]
+        self.cache = {}
+
+    def _entry_at(self, index):
+        return self._entry.unpack_from(
+            self.buf, self.base + self.offset + 5 + self._entry.size * index)
+
+    def _search_key_at(self, index):
+        start = self.base + self._entry_at(index)[0]
+        size = _count.unpack_from(self.buf, start)[0]
+        return self.buf[start + 4:start + 4 + size]
+
+    def _find(self, key):
+        skey = _search_key(key)
+        if skey is None:
+            return -1
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._search_key_at(mid) < skey:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count and self._search_key_at(lo) == skey:
+            return lo
+        return -1
+
+    def __len__(self):
+        return self.count
+
+    def _lookup(self, key):
+        # the value for key, or _missing
+        try:
+            return self.cache[key]
+        except KeyError:
+            index = self._find(key)
+            value = _missing if index < 0 else _tree_value(
+                self.buf, self.base, self._entry_at(index)[2])
+            self.cache[key] = value
+            return value
+
+    def __contains__(self, key):
+        return self._lookup(key) is not _missing
+
+    def __getitem__(self, key):
+        value = self._lookup(key)
+        if value is _missing:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        value = self._lookup(key)
+        return default if value is _missing else value
+
+    def keys(self):
+        return [_tree_value(self.buf, self.base, self._entry_at(i)[1])
+                for i in range(self.count)]
+
+    def values(self):
+        return [_tree_value(self.buf, self.base, self._entry_at(i)[2])
+                for i in range(self.count)]
+
+    def items(self):
+        return list(zip(self.keys(), self.values()))
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def to_dict(self):
+        """ Copies the mapping, and every mapping nested in it, into ordinary dicts. """
+        def copy(value):
+            if isinstance(value, MappedDict):
+                return value.to_dict()
+            if isinstance(value, (list, tuple)):
+                return type(value)(copy(item) for item in value)
+            return value
+        return dict((key, copy(value)) for key, value in self.items())
+
+    def __reduce__(self):
+        # a mapped section is pickled, and so sent to other processes, as a plain dict
+        return (dict, (self.to_dict(),))
+
+
+def open_image(path, key=None):
+    """
+    Maps the image file path read-only and returns {name: section} for the sections
+    in it: an ActorTrie for a trie, a MappedDict for a tree. Returns None if the file
+    is missing, was written on a host with the other byte order or, when key is given,
+    was compiled from other dictionaries.
+    """
+    try:
+        with open(path, 'rb') as fin:
+            buf = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, OSError, ValueError):
+        return None
+    if len(buf) < _image_header.size:
+        return None
+    magic, order, image_key, count = _image_header.unpack_from(buf, 0)
+    if (magic != ImageMagic or order != _byteorder() or
+            (key and image_key.decode('ascii') != key)):
+        return None
+
+    sections = {}
+    for i in range(count):
+        name, kind, offset = _image_entry.unpack_from(
+            buf, _image_header.size + i * _image_entry.size)
+        if kind == ImageTrie:
+            value = _map_trie(buf, offset)
+        else:
+            root = _integer.unpack_from(buf, offset)[0]
+            value = _tree_value(buf, offset + _integer.size, root)
+        sections[name.rstrip(b'\0').decode('ascii')] = value
+    return sections
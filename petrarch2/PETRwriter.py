@@ -52,88 +52,9 @@ def write_events(event_dict, output_file):
     output_file: String.
                     Filepath to which events should be written.
     """
-    global StorySource
-    global NEvents
-    global StoryIssues
-
     event_output = []
     for key in event_dict:
-        story_dict = event_dict[key]
-        if not story_dict['sents']:
-            continue    # skip cases eliminated by story-level discard
-#        print('WE1',story_dict)
-        story_output = []
-        filtered_events = utilities.story_filter(story_dict, key)
-#        print('WE2',filtered_events)
-        if 'source' in story_dict['meta']:
-            StorySource = story_dict['meta']['source']
-        else:
-            StorySource = 'NULL'
-        if 'url' in story_dict['meta']:
-            url = story_dict['meta']['url']
-        else:
-            url = ''
-        for event in filtered_events:
-            story_date = event[0]
-            source = event[1]
-            target = event[2]
-            code = filter(lambda a: not a == '\n', event[3])
-
-            ids = ';'.join(filtered_events[event]['ids'])
-
-            if 'issues' in filtered_events[event]:
-                iss = filtered_events[event]['issues']
-                issues = ['{},{}'.format(k, v) for k, v in iss.items()]
-                joined_issues = ';'.join(issues)
-            else:
-                joined_issues = []
-
-            print('Event: {}\t{}\t{}\t{}\t{}\t{}'.format(story_date, source,
-                                                         target, code, ids,
-                                                         StorySource))
-#            event_str = '{}\t{}\t{}\t{}'.format(story_date,source,target,code)
-            # 15.04.30: a very crude hack around an error involving multi-word
-            # verbs
-            if not isinstance(event[3], basestring):
-                event_str = '\t'.join(
-                    event[:3]) + '\t010\t' + '\t'.join(event[4:])
-            else:
-                event_str = '\t'.join(event)
-            # print(event_str)
-            if joined_issues:
-                event_str += '\t{}'.format(joined_issues)
-            else:
-                event_str += '\t'
-
-            if url:
-                event_str += '\t{}\t{}\t{}'.format(ids, url, StorySource)
-            else:
-                event_str += '\t{}\t{}'.format(ids, StorySource)
-
-            if PETRglobals.WriteActorText:
-                if 'actortext' in filtered_events[event]:
-                    event_str += '\t{}\t{}'.format(
-                        filtered_events[event]['actortext'][0],
-                        filtered_events[event]['actortext'][1])
-                else:
-                    event_str += '\t---\t---'
-            if PETRglobals.WriteEventText:
-                if 'eventtext' in filtered_events[event]:
-                    event_str += '\t{}'.format(
-                        filtered_events[event]['eventtext'])
-                else:
-                    event_str += '\t---'
-            if PETRglobals.WriteActorRoot:
-                if 'actorroot' in filtered_events[event]:
-                    event_str += '\t{}\t{}'.format(
-                        filtered_events[event]['actorroot'][0],
-                        filtered_events[event]['actorroot'][1])
-                else:
-                    event_str += '\t---\t---'
-
-            story_output.append(event_str)
-
-        story_events = '\n'.join(story_output)
+        story_events = '\n'.join(format_story_events(key, event_dict[key]))
         event_output.append(story_events)
 
     # Filter out blank lines
@@ -147,6 +68,132 @@ def write_events(event_dict, output_file):
         f.close()
 
 
+def write_events_stream(stories, output_file, mode='w', checkpoint=None):
+    """
+    Streaming version of write_events(): writes the events of each (StoryID, story)
+    pair of the iterable stories as soon as it arrives, so that only the current
+    story is held here and the file fills up as the coding goes on. Returns the
+    number of events written.
+
+    Parameters
+    ----------
+
+    stories: Iterable.
+                (StoryID, story dictionary) pairs, as yielded by
+                petrarch2.iter_coding().
+
+
+    output_file: String.
+                    Filepath to which events should be written.
+
+    mode: String.
+            'w' to start a new file, 'a' to append to an existing one.
+
+    checkpoint: Function.
+                Called as checkpoint(f, key) with the open output file after the
+                events of each story have been written; used by
+                petrarch2.run_checkpointed() to record its progress.
+    """
+    count = 0
+    with codecs.open(output_file, encoding='utf-8', mode=mode) as f:
+        for key, story_dict in stories:
+            story_output = format_story_events(key, story_dict)
+            for event_str in story_output:
+                f.write(event_str + '\n')
+            count += len(story_output)
+            if story_output:
+                f.flush()
+            if checkpoint:
+                checkpoint(f, key)
+    return count
+
+
+def format_story_events(key, story_dict):
+    """
+    Formats the coded events of one story, returning a list with one line of
+    output for each event; used by write_events() and write_events_stream().
+    """
+    global StorySource
+    global NEvents
+    global StoryIssues
+
+    story_output = []
+    if not story_dict['sents']:
+        return story_output    # skip cases eliminated by story-level discard
+#    print('WE1',story_dict)
+    filtered_events = utilities.story_filter(story_dict, key)
+#    print('WE2',filtered_events)
+    if 'source' in story_dict['meta']:
+        StorySource = story_dict['meta']['source']
+    else:
+        StorySource = 'NULL'
+    if 'url' in story_dict['meta']:
+        url = story_dict['meta']['url']
+    else:
+        url = ''
+    for event in filtered_events:
+        story_date = event[0]
+        source = event[1]
+        target = event[2]
+        code = filter(lambda a: not a == '\n', event[3])
+
+        ids = ';'.join(filtered_events[event]['ids'])
+
+        if 'issues' in filtered_events[event]:
+            iss = filtered_events[event]['issues']
+            issues = ['{},{}'.format(k, v) for k, v in iss.items()]
+            joined_issues = ';'.join(issues)
+        else:
+            joined_issues = []
+
+        print('Event: {}\t{}\t{}\t{}\t{}\t{}'.format(story_date, source,
+                                                     target, code, ids,
+                                                     StorySource))
+#        event_str = '{}\t{}\t{}\t{}'.format(story_date,source,target,code)
+        # 15.04.30: a very crude hack around an error involving multi-word
+        # verbs
+        if not isinstance(event[3], basestring):
+            event_str = '\t'.join(
+                event[:3]) + '\t010\t' + '\t'.join(event[4:])
+        else:
+            event_str = '\t'.join(event)
+        # print(event_str)
+        if joined_issues:
+            event_str += '\t{}'.format(joined_issues)
+        else:
+            event_str += '\t'
+
+        if url:
+            event_str += '\t{}\t{}\t{}'.format(ids, url, StorySource)
+        else:
+            event_str += '\t{}\t{}'.format(ids, StorySource)
+
+        if PETRglobals.WriteActorText:
+            if 'actortext' in filtered_events[event]:
+                event_str += '\t{}\t{}'.format(
+                    filtered_events[event]['actortext'][0],
+                    filtered_events[event]['actortext'][1])
+            else:
+                event_str += '\t---\t---'
+        if PETRglobals.WriteEventText:
+            if 'eventtext' in filtered_events[event]:
+                event_str += '\t{}'.format(
+                    filtered_events[event]['eventtext'])
+            else:
+                event_str += '\t---'
+        if PETRglobals.WriteActorRoot:
+            if 'actorroot' in filtered_events[event]:
+                event_str += '\t{}\t{}'.format(
+                    filtered_events[event]['actorroot'][0],
+                    filtered_events[event]['actorroot'][1])
+            else:
+                event_str += '\t---\t---'
+
+        story_output.append(event_str)
+
+    return story_output
+
+
 def write_nullverbs(event_dict, output_file):
     """
     Formats and writes the null verb data to a file as a set of lines in a JSON format.
@@ -0,0 +1,812 @@
+##	benchmark.py [module]
+##
+# Timing and memory benchmarks for the PETRARCH event coder
+#
+# Run with
+#
+#       python -m petrarch2.benchmark [name ...]
+#
+# where the optional names select individual benchmarks (see BENCHMARKS at the end of
+# the file); with no names every benchmark is run. Results are written to stdout;
+# the chatter from the readers and the coder is suppressed.
+#
+# This code is covered under the MIT license
+# ------------------------------------------------------------------------
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import io
+import os
+import re
+import sys
+import copy
+import time
+import shutil
+import threading
+import tempfile
+import contextlib
+import multiprocessing
+
+import PETRglobals
+import PETRreader
+import PETRserver
+import PETRwriter
+import loadgen
+import utilities
+import petrarch2
+
+
+@contextlib.contextmanager
+def quiet():
+    """ Sends stdout to /dev/null for the duration of the block. """
+    saved = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = saved
+
+
+def timed(func, *args, **kwargs):
+    """ Returns (seconds, result) for a single quiet call of func. """
+    with quiet():
+        t1 = time.time()
+        result = func(*args, **kwargs)
+        return time.time() - t1, result
+
+
+def load_config(config=None):
+    with quiet():
+        PETRreader.parse_Config(config or utilities._get_data(
+            'data/config/', 'PETR_config.ini'))
+
+
+def deep_sizeof(obj):
+    """ Total size in bytes of obj and everything reachable from it, counted once. """
+    seen = set()
+    stack = [obj]
+    total = 0
+    while stack:
+        item = stack.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        total += sys.getsizeof(item)
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple, set)):
+            stack.extend(item)
+        elif hasattr(item, '__slots__'):
+            stack.extend(getattr(item, name) for name in item.__slots__
+                         if hasattr(item, name))
+    return total
+
+
+def process_memory():
+    """
+    Resident memory of this process in kB from /proc/self/status: 'RssAnon' is private
+    to the process, 'RssFile' is file-backed and shared with other processes mapping
+    the same file. Empty where /proc is not available.
+    """
+    result = {}
+    try:
+        with open('/proc/self/status') as fin:
+            for line in fin:
+                if line.startswith(('RssAnon', 'RssFile')):
+                    name, value = line.split(':')
+                    result[name] = int(value.split()[0])
+    except IOError:
+        pass
+    return result
+
+
+def in_child(func, *args, **kwargs):
+    """ Runs func(*args, **kwargs) in a fresh worker process and returns its result. """
+    pool = multiprocessing.Pool(1)
+    try:
+        return pool.apply(func, args, kwargs)
+    finally:
+        pool.terminate()
+
+
+def report(title, rows):
+    print('\n' + title)
+    print('-' * len(title))
+    for label, value in rows:
+        print('  {:<40} {}'.format(label, value))
+
+
+# ========================== BENCHMARKS ========================== #
+
+
+def bench_dictionary_load():
+    """ Parsing the text dictionaries vs. loading the compiled dictionary cache. """
+    load_config()
+    tempdir = tempfile.mkdtemp()
+    try:
+        PETRglobals.DictCacheFileName = ''
+        parse_time, _ = timed(petrarch2.read_dictionaries)
+
+        PETRglobals.DictCacheFileName = os.path.join(tempdir, 'bench.cache')
+        build_time, _ = timed(petrarch2.read_dictionaries, rebuild_cache=True)
+        load_time, _ = timed(petrarch2.read_dictionaries)
+        size = os.path.getsize(PETRglobals.DictCacheFileName)
+    finally:
+        shutil.rmtree(tempdir)
+
+    report('Dictionary load', [
+        ('parse text dictionaries', '{:.3f} s'.format(parse_time)),
+        ('parse + write cache', '{:.3f} s'.format(build_time)),
+        ('load from cache', '{:.3f} s'.format(load_time)),
+        ('speedup', '{:.1f}x'.format(parse_time / load_time)),
+        ('cache size', '{:.1f} MB'.format(size / 1e6))])
+
+
+def bench_actor_memory():
+    """ Size of the nested-dict actor dictionary vs. the compiled ActorTrie. """
+    load_config()
+    PETRglobals.DictCacheFileName = ''
+    timed(petrarch2.read_dictionaries)
+    trie = PETRglobals.ActorDict
+    nested = trie.to_dict()
+
+    words = 'THE UNITED NATIONS SECURITY COUNCIL SAID'.split()
+    date = PETRreader.dstr_to_ordate('20150813')
+    rounds = 100000
+    t1 = time.time()
+    for _ in range(rounds):
+        trie.match(words, 1, date)
+    match_time = time.time() - t1
+
+    report('Actor dictionary memory', [
+        ('nested dicts', '{:.1f} MB'.format(deep_sizeof(nested) / 1e6)),
+        ('ActorTrie', '{:.1f} MB'.format(deep_sizeof(trie) / 1e6)),
+        ('trie nodes', len(trie.node_token)),
+        ('match() call', '{:.2f} us'.format(match_time / rounds * 1e6))])
+
+
+def _code_with_cache(cache_path, mapped):
+    # worker for bench_mapped_image: load the dictionaries, code the sample text
+    PETRglobals.DictMapImage = mapped
+    before = process_memory()
+    load_time, _ = timed(PETRreader.read_dictionary_cache, cache_path)
+    loaded = process_memory()
+    events = PETRreader.read_xml_input([utilities._get_data(
+        'data/text', 'GigaWord.sample.PETR.xml')], True)
+    code_time, _ = timed(petrarch2.do_coding, events)
+    return (load_time, code_time,
+            loaded.get('RssAnon', 0) - before.get('RssAnon', 0),
+            process_memory().get('RssFile', 0) - before.get('RssFile', 0))
+
+
+def bench_mapped_image():
+    """ Per-process memory and coding time with pickled vs. mapped dictionaries. """
+    load_config()
+    tempdir = tempfile.mkdtemp()
+    try:
+        PETRglobals.DictCacheFileName = os.path.join(tempdir, 'bench.cache')
+        PETRglobals.DictMapImage = True
+        in_child(timed, petrarch2.read_dictionaries, rebuild_cache=True)
+        image_size = os.path.getsize(
+            PETRreader.dictionary_image_path(PETRglobals.DictCacheFileName))
+        rows = []
+        for label, mapped in [('pickled', False), ('mapped image', True)]:
+            load_time, code_time, anon, shared = in_child(
+                _code_with_cache, PETRglobals.DictCacheFileName, mapped)
+            rows += [(label + ': load', '{:.3f} s'.format(load_time)),
+                     (label + ': code GigaWord sample', '{:.3f} s'.format(code_time)),
+                     (label + ': private memory', '{:.1f} MB'.format(anon / 1e3)),
+                     (label + ': shared file pages', '{:.1f} MB'.format(shared / 1e3))]
+    finally:
+        PETRglobals.DictMapImage = False
+        shutil.rmtree(tempdir)
+    report('Memory-mapped dictionary image', rows +
+           [('image size', '{:.1f} MB'.format(image_size / 1e6))])
+
+
+def bench_date_resolution():
+    """ Converting date restrictions on every lookup vs. the precompiled segments. """
+    import PETRtree
+    load_config()
+    PETRglobals.DictCacheFileName = ''
+    timed(petrarch2.read_dictionaries)
+    trie = PETRglobals.ActorDict
+    nodes = [node for node in range(len(trie.terminal))
+             if trie.first_record[node + 1] - trie.first_record[node] > 1]
+    entries = [trie.to_dict(node)['#'] for node in nodes]
+    phrase = PETRtree.NounPhrase('NP', 0, None)
+    phrase.date = PETRreader.dstr_to_ordate('20150813')
+
+    t1 = time.time()
+    for match in entries:
+        phrase.check_date(match)
+    parse_time = time.time() - t1
+    t1 = time.time()
+    for node in nodes:
+        trie.resolve(node, phrase.date)
+    resolve_time = time.time() - t1
+
+    report('Actor date resolution', [
+        ('actors with several codes', len(nodes)),
+        ('check_date(), dates converted per call',
+         '{:.2f} us'.format(parse_time / len(nodes) * 1e6)),
+        ('ActorTrie.resolve()', '{:.2f} us'.format(resolve_time / len(nodes) * 1e6))])
+
+
+def legacy_check_discards(SentenceText, DiscardList):
+    # check_discards() as it was before the discard automaton, over the word tree
+    # built by PETRreader.read_discard_list(); kept for comparison only
+    sent = SentenceText.upper().split()
+    level = DiscardList
+    depart_index = [0]
+    discardPhrase = ""
+
+    for i in range(len(sent)):
+
+        if '+' in level:
+            return [2, '+ ' + discardPhrase]
+        elif '$' in level:
+            return [1, ' ' + discardPhrase]
+        elif sent[i] in level:
+            depart_index.append(i)
+            level = level[sent[i]]
+            discardPhrase += " " + sent[i]
+        else:
+            if len(depart_index) == 0:
+                continue
+            i = depart_index[0]
+            level = DiscardList
+    return [0, '']
+
+
+def legacy_get_issues(SentenceText, IssueList):
+    # get_issues() as it was before the issue automaton, over the word tree built by
+    # PETRreader.read_issue_list(); kept for comparison only
+    def recurse(words, path, length):
+        if '#' in path:
+            return path['#'], length
+        elif words and words[0] in path:
+            return recurse(words[1:], path[words[0]], length + 1)
+        return False
+
+    sent = SentenceText.upper().split()
+    issues = []
+
+    index = 0
+    while index < len(sent):
+        match = recurse(sent[index:], IssueList, 0)
+        if match:
+            index += match[1]
+            code = PETRglobals.IssueCodes[match[0]]
+            if code[0] == '~':
+                return []
+            ka = 0
+            while ka < len(issues):
+                if code == issues[ka][0]:
+                    issues[ka][1] += 1
+                    break
+                ka += 1
+            if ka == len(issues):
+                issues.append([code, 1])
+        else:
+            index += 1
+    return issues
+
+
+def sample_sentences():
+    """ The text of every sentence in the GigaWord sample. """
+    events = PETRreader.read_xml_input([utilities._get_data(
+        'data/text', 'GigaWord.sample.PETR.xml')], True)
+    return [sent['content'] for _, story in sorted(events.items())
+            for _, sent in sorted(story['sents'].items())]
+
+
+def bench_discards():
+    """ The word-tree walk vs. the discard automaton on the GigaWord sample. """
+    load_config()
+    with quiet():
+        PETRglobals.DiscardList = {}
+        PETRreader.read_discard_list(utilities._get_data(
+            'data/dictionaries', PETRglobals.DiscardFileName))
+        tree = PETRglobals.DiscardList
+        PETRreader.compile_discard_list()
+        sentences = sample_sentences()
+    rounds = 200
+
+    t1 = time.time()
+    for _ in range(rounds):
+        legacy = [legacy_check_discards(text, tree) for text in sentences]
+    legacy_time = time.time() - t1
+    t1 = time.time()
+    for _ in range(rounds):
+        found = [petrarch2.check_discards(text) for text in sentences]
+    automaton_time = time.time() - t1
+
+    calls = rounds * len(sentences)
+    report('Discard matching', [
+        ('sentences', len(sentences)),
+        ('word tree, per sentence', '{:.2f} us'.format(legacy_time / calls * 1e6)),
+        ('automaton, per sentence', '{:.2f} us'.format(automaton_time / calls * 1e6)),
+        ('discarded: word tree / automaton', '{} / {}'.format(
+            sum(1 for disc in legacy if disc[0]), sum(1 for disc in found if disc[0])))])
+
+
+def bench_issues():
+    """ The recursive issue matcher vs. the issue automaton on the GigaWord sample. """
+    load_config()
+    with quiet():
+        PETRglobals.IssueCodes = []
+        PETRreader.read_issue_list(utilities._get_data(
+            'data/dictionaries', PETRglobals.IssueFileName))
+        tree = PETRglobals.IssueList
+        PETRreader.compile_issue_list()
+        sentences = sample_sentences()
+    rounds = 100
+
+    t1 = time.time()
+    for _ in range(rounds):
+        legacy = [legacy_get_issues(text, tree) for text in sentences]
+    legacy_time = time.time() - t1
+    t1 = time.time()
+    for _ in range(rounds):
+        found = petrarch2.get_issues_batch(sentences)
+    automaton_time = time.time() - t1
+
+    calls = rounds * len(sentences)
+    report('Issue coding', [
+        ('sentences', len(sentences)),
+        ('recursive matcher, per sentence',
+         '{:.2f} us'.format(legacy_time / calls * 1e6)),
+        ('automaton, per sentence', '{:.2f} us'.format(automaton_time / calls * 1e6)),
+        ('same issues', all(sorted(map(tuple, old)) == sorted(new.items())
+                            for old, new in zip(legacy, found)))])
+
+
+def bench_workers():
+    """ Coding throughput of do_coding() with 1 to N worker processes. """
+    load_config()
+    with quiet():
+        petrarch2.read_dictionaries()
+        sample = PETRreader.read_xml_input([utilities._get_data(
+            'data/text', 'GigaWord.sample.PETR.xml')], True)
+    copies = 20
+    events = {}
+    for ka in range(copies):
+        for key, story in sample.items():
+            events['{}-{:02}'.format(key, ka)] = story
+    counts = sorted(set(n for n in [1, 2, 4, 8, 16, 32, multiprocessing.cpu_count()]
+                        if n <= multiprocessing.cpu_count()))
+
+    rows = [('stories', len(events))]
+    serial = None
+    for workers in counts:
+        seconds, coded = timed(petrarch2.do_coding, copy.deepcopy(events), workers)
+        if serial is None:
+            serial = (seconds, coded)
+        rows += [('{} worker(s)'.format(workers),
+                  '{:.1f} stories/s   x{:.2f}   same events: {}'.format(
+                      len(events) / seconds, serial[0] / seconds, coded == serial[1]))]
+    report('Parallel coding', rows)
+
+
+def replicated_sample(path, copies):
+    """ Writes the GigaWord sample to path copies times over, with distinct story ids. """
+    with open(utilities._get_data('data/text', 'GigaWord.sample.PETR.xml')) as fin:
+        text = fin.read()
+    body = text[text.index('<Sentences>') + len('<Sentences>'):text.index('</Sentences>')]
+    with open(path, 'w') as fout:
+        fout.write('<Sentences>\n')
+        for ka in range(copies):
+            fout.write(re.sub(r'id *= *"([^"_]*)', r'id ="\1-{}'.format(ka), body))
+        fout.write('</Sentences>\n')
+
+
+def sampled(func, *args):
+    """
+    Runs func(*args), returning (seconds, result, growth), where growth is the peak
+    growth of the private memory of the process in kB, sampled every 10 ms.
+    """
+    before = process_memory().get('RssAnon', 0)
+    peak = [before]
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(0.01):
+            peak[0] = max(peak[0], process_memory().get('RssAnon', 0))
+    sampler = threading.Thread(target=sample)
+    sampler.start()
+    try:
+        t1 = time.time()
+        result = func(*args)
+        seconds = time.time() - t1
+    finally:
+        done.set()
+        sampler.join()
+    return seconds, result, peak[0] - before
+
+
+def _code_file(path, out_file, stream):
+    # worker for bench_stream: code path in batch or streaming mode, return the time
+    # and the peak growth of the private memory
+    def code():
+        if stream:
+            petrarch2.run_stream([path], out_file)
+        else:
+            PETRwriter.write_events(petrarch2.do_coding(
+                PETRreader.read_xml_input([path], True)), out_file)
+    with quiet():
+        petrarch2.read_dictionaries()
+        seconds, _, growth = sampled(code)
+    return seconds, growth
+
+
+def bench_stream():
+    """ Peak memory of coding a file in batch mode vs. streaming mode. """
+    load_config()
+    tempdir = tempfile.mkdtemp()
+    try:
+        rows = []
+        for copies in [10, 40]:
+            path = os.path.join(tempdir, 'sample.xml')
+            replicated_sample(path, copies)
+            rows += [('input of {:.1f} MB'.format(os.path.getsize(path) / 1e6), '')]
+            for label, stream in [('batch', False), ('stream', True)]:
+                seconds, peak = in_child(_code_file, path,
+                                         os.path.join(tempdir, label + '.txt'), stream)
+                rows += [('  ' + label, '{:.1f} s   peak memory growth {:.1f} MB'.format(
+                    seconds, peak / 1e3))]
+    finally:
+        shutil.rmtree(tempdir)
+    report('Streaming coding', rows)
+
+
+def legacy_xml_records(path):
+    # the XML reading loop of read_xml_input() before it dropped the finished
+    # elements from the tree, kept for comparison only
+    import xml.etree.ElementTree as ET
+    for event, elem in ET.iterparse(path):
+        if event == "end" and elem.tag == "Sentence":
+            yield elem.attrib['id'], elem.find('Text').text, elem.find('Parse').text
+            elem.clear()
+
+
+def _read_xml(path, reader):
+    # worker for bench_xml_input: read every sentence of path with reader
+    if reader == 'legacy':
+        records = legacy_xml_records(path)
+    else:
+        if reader == 'cElementTree':
+            PETRreader.lxml_etree = None
+        records = ((elem.attrib['id'], elem.find('Text').text, elem.find('Parse').text)
+                   for elem in PETRreader._iter_sentence_elements(path))
+    seconds, count, growth = sampled(lambda: sum(1 for _ in records))
+    return seconds, count, growth
+
+
+def bench_xml_input():
+    """ Reading speed and memory of the XML reader on enlarged unit test records. """
+    load_config()
+    with io.open(utilities._get_data('data/text', 'PETR.UnitTest.records.xml'),
+                 encoding='utf-8') as fin:
+        text = fin.read()
+    start = text.index('<Sentences>') + len('<Sentences>')
+    end = text.index('</Sentences>')
+    readers = ['legacy', 'cElementTree'] + (['lxml'] if PETRreader.lxml_etree else [])
+    tempdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tempdir, 'records.xml')
+        with io.open(path, 'w', encoding='utf-8') as fout:
+            fout.write(text[:start])
+            for _ in range(50):
+                fout.write(text[start:end])
+            fout.write(text[end:])
+        size = os.path.getsize(path)
+        rows = [('input', '{:.1f} MB'.format(size / 1e6))]
+        for reader in readers:
+            seconds, count, growth = in_child(_read_xml, path, reader)
+            rows += [(reader, '{:.1f} MB/s   peak memory growth {:.1f} MB   {} sentences'.format(
+                size / 1e6 / seconds, growth / 1e3, count))]
+    finally:
+        shutil.rmtree(tempdir)
+    report('XML input', rows)
+
+
+def bench_xml_ranges():
+    """ Coding one large XML file by byte ranges with 1 to N worker processes. """
+    load_config()
+    with quiet():
+        petrarch2.read_dictionaries()
+    counts = sorted(set(n for n in [1, 2, 4, 8, 16, 32, multiprocessing.cpu_count()]
+                        if n <= multiprocessing.cpu_count()))
+    tempdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tempdir, 'sample.xml')
+        replicated_sample(path, 20)
+        size = os.path.getsize(path)
+        rows = [('input', '{:.1f} MB'.format(size / 1e6))]
+        seconds, _ = timed(petrarch2.run_stream, [path], os.path.join(tempdir, 'stream.txt'))
+        rows += [('streaming, one process', '{:.2f} MB/s'.format(size / 1e6 / seconds))]
+        for workers in counts:
+            seconds, _ = timed(petrarch2.code_xml_ranges, [path],
+                               os.path.join(tempdir, 'ranges.txt'), workers, size // 16)
+            rows += [('byte ranges, {} worker(s)'.format(workers),
+                      '{:.2f} MB/s'.format(size / 1e6 / seconds))]
+    finally:
+        shutil.rmtree(tempdir)
+    report('Parallel reading of one XML file', rows)
+
+
+def legacy_sentence_segmenter(paragr):
+    # PETRreader._sentence_segmenter() as it was before the single-pass version,
+    # recounting the brackets and quotes of the prefix at each terminator; kept
+    # for comparison only
+    abbrevs = list(PETRreader.ABBREV_LIST)
+    sentlist = []
+    searchstart = 0
+    terloc = PETRreader.SENTENCE_END.search(paragr)
+    while terloc:
+        isok = True
+        if paragr[terloc.start()] == '.':
+            if (paragr[terloc.start() - 1].isupper() and
+                    paragr[terloc.start() - 2] == ' '):
+                isok = False
+            else:
+                loc = paragr.rfind(' ', 0, terloc.start() - 1)
+                if loc > 0:
+                    if paragr[loc + 1:terloc.start() + 1].lower() in abbrevs:
+                        isok = False
+        if paragr[:terloc.start()].count('(') != paragr[:terloc.start()].count(')'):
+            isok = False
+        if paragr[:terloc.start()].count('"') % 2 != 0:
+            isok = False
+        if isok:
+            if (len(paragr[:terloc.start()]) > PETRreader.MIN_SENTLENGTH and
+                    len(paragr[:terloc.start()]) < PETRreader.MAX_SENTLENGTH):
+                sentlist.append(paragr[:terloc.start() + 2])
+            paragr = paragr[terloc.end() - 1:]
+            searchstart = 0
+        else:
+            searchstart = terloc.start() + 2
+        terloc = PETRreader.SENTENCE_END.search(paragr, searchstart)
+    if (len(paragr) > PETRreader.MIN_SENTLENGTH and
+            len(paragr) < PETRreader.MAX_SENTLENGTH):
+        sentlist.append(paragr)
+    return sentlist
+
+
+def bench_segmenter():
+    """ The prefix-recounting vs. the single-pass sentence segmenter on long stories. """
+    load_config()
+    with quiet():
+        sentences = sample_sentences()
+    rows = []
+    for copies in [1, 10, 40]:
+        paragr = ' '.join(sentences * copies)
+        legacy_time, legacy = timed(legacy_sentence_segmenter, paragr)
+        linear_time, linear = timed(
+            lambda text: list(PETRreader._sentence_segmenter(text)), paragr)
+        assert legacy == linear
+        rows += [('{} characters, {} sentences'.format(len(paragr), len(linear)),
+                  'prefix counts {:.1f} ms   single pass {:.1f} ms'.format(
+                      legacy_time * 1e3, linear_time * 1e3))]
+    report('Sentence segmentation', rows)
+
+
+def bench_server():
+    """
+    Throughput of run_pipeline() called once per batch vs. a coding server with the
+    dictionaries resident, at a few client concurrencies.
+    """
+    load_config()
+    records = loadgen.sample_records(utilities._get_data(
+        'data/text', 'GigaWord.sample.PETR.xml'))
+    stories = 10
+    batches = 3
+    config = utilities._get_data('data/config/', 'PETR_config.ini')
+
+    def per_call():
+        for ka in range(batches):
+            petrarch2.run_pipeline(records[ka * stories:(ka + 1) * stories],
+                                   config=config, write_output=False, parsed=True)
+    seconds, _ = timed(per_call)
+    rows = [('run_pipeline per batch', '{:.2f} requests/s   {:.1f} stories/s'.format(
+        batches / seconds, batches * stories / seconds))]
+
+    server = PETRserver.CodingServer(('127.0.0.1', 0), petrarch2.iter_coding,
+                                     queue_size=16, batch_size=64)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    try:
+        for concurrency in [1, 4, 16]:
+            with quiet():
+                result = loadgen.run_load(url, records, 40, concurrency, stories)
+            rows += [('server, {} client(s)'.format(concurrency), '')]
+            rows += [('  ' + label, value)
+                     for label, value in loadgen.summary_rows(result)]
+    finally:
+        server.shutdown()
+        server.server_close()
+    report('Coding server', rows)
+
+
+def bench_sentences():
+    """
+    Coding parsed sentences through the holding dictionary -- read_pipeline_input(),
+    do_coding() and pipe_output() -- vs. code_sentences().
+    """
+    load_config()
+    with quiet():
+        petrarch2.read_dictionaries()
+    records = loadgen.sample_records(utilities._get_data(
+        'data/text', 'GigaWord.sample.PETR.xml'))
+    # only the sentences that the pipeline reader's segmenter keeps
+    stories = PETRreader.read_pipeline_input(records)
+    records = [record for record in records if stories[record['_id']]['sents']] * 10
+    records = [dict(record, _id='{}-{}'.format(record['_id'], ka))
+               for ka, record in enumerate(records)]
+    tuples = [(record['_id'], record['parsed_sents'][0], record['content'],
+               record['date']) for record in records]
+
+    def holding():
+        return PETRwriter.pipe_output(petrarch2.do_coding(
+            PETRreader.read_pipeline_input(records)))
+
+    def flat():
+        latencies = []
+        t1 = time.time()
+        for _ in petrarch2.code_sentences(tuples):
+            latencies.append(time.time() - t1)
+            t1 = time.time()
+        return sorted(latencies)
+
+    holding_time, _ = timed(holding)
+    flat_time, latencies = timed(flat)
+    report('Sentence coding API', [
+        ('sentences', len(records)),
+        ('holding dictionary', '{:.1f} sentences/s'.format(len(records) / holding_time)),
+        ('code_sentences()', '{:.1f} sentences/s   p50 {:.2f} ms   p95 {:.2f} ms'.format(
+            len(records) / flat_time, latencies[len(latencies) // 2] * 1e3,
+            latencies[int(len(latencies) * 0.95)] * 1e3))])
+
+
+def _tree_nodes(root):
+    nodes = []
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        nodes.append(node)
+        stack.extend(node.children)
+    return nodes
+
+
+def bench_tree():
+    """
+    Memory and time per sentence of building and coding the PETRtree parse trees of
+    the GigaWord sample. The node memory is the size of the phrase objects and of their
+    instance dictionaries, if they have any; under Python 3 the bytes allocated per
+    sentence are also measured with tracemalloc.
+    """
+    import PETRtree
+    load_config()
+    with quiet():
+        petrarch2.read_dictionaries()
+        events = PETRreader.read_xml_input([utilities._get_data(
+            'data/text', 'GigaWord.sample.PETR.xml')], True)
+    sentences = []
+    for _, story in sorted(events.items()):
+        for _, sent in sorted(story['sents'].items()):
+            tokens = utilities.SentenceTokens(sent['content'], sent['parsed'])
+            sentences.append((sent['parsed'], sent['content'],
+                              PETRreader.dstr_to_ordate(story['meta']['date']), tokens))
+
+    def code(parse, text, date, tokens):
+        sentence = PETRtree.Sentence(parse, text, date, tokens)
+        sentence.get_events()
+        return sentence
+
+    nodes = node_bytes = 0
+    with quiet():
+        for args in sentences:
+            tree = _tree_nodes(code(*args).tree)
+            nodes += len(tree)
+            node_bytes += sum(sys.getsizeof(node) + sys.getsizeof(
+                getattr(node, '__dict__', None)) * hasattr(node, '__dict__')
+                for node in tree)
+    rows = [('sentences', len(sentences)),
+            ('phrase nodes per sentence',
+             '{:.1f}'.format(nodes / float(len(sentences)))),
+            ('node memory per sentence', '{:.0f} bytes   {:.0f} bytes per node'.format(
+                node_bytes / float(len(sentences)), node_bytes / float(nodes)))]
+
+    try:
+        import tracemalloc
+    except ImportError:
+        tracemalloc = None
+    if tracemalloc:
+        with quiet():
+            tracemalloc.start()
+            kept = [code(*args) for args in sentences]
+            allocated = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+        del kept
+        rows += [('allocated per sentence (tracemalloc)',
+                  '{:.0f} bytes'.format(allocated / float(len(sentences))))]
+
+    repeats = 20
+    with quiet():
+        t1 = time.time()
+        for _ in range(repeats):
+            for args in sentences:
+                code(*args)
+        seconds = time.time() - t1
+    rows += [('build and code, per sentence',
+              '{:.1f} us'.format(seconds / repeats / len(sentences) * 1e6))]
+    report('Parse trees', rows)
+
+
+def bench_tokenizer():
+    """
+    Reading the elements of the GigaWord sample parses: formatting each parse and
+    splitting it, as the readers and PETRtree.Sentence did, vs. utilities.parse_tokens(),
+    and vs. utilities.tree_tokens() for the parses given as nested lists.
+    """
+    import xml.etree.ElementTree as ET
+    parses = [parse.text for parse in ET.parse(utilities._get_data(
+        'data/text', 'GigaWord.sample.PETR.xml')).getroot().iter('Parse')]
+    repeats = 200
+
+    def per_parse(func):
+        t1 = time.time()
+        for _ in range(repeats):
+            for parse in parses:
+                func(parse)
+        return (time.time() - t1) / repeats / len(parses) * 1e6
+
+    def format_and_split(parse):
+        return utilities._format_parsed_str(parse).replace(')', ' )').strip().split()
+
+    assert all(utilities.parse_tokens(parse) == format_and_split(parse)
+               for parse in parses)
+    formatted = per_parse(format_and_split)
+    scanned = per_parse(utilities.parse_tokens)
+    trees = dict((parse, utilities.parse_to_tree(parse)) for parse in parses)
+    from_trees = per_parse(lambda parse: utilities.tree_tokens(trees[parse]))
+    report('Parse tokenizer', [
+        ('parses', len(parses)),
+        ('format and split, per parse', '{:.1f} us'.format(formatted)),
+        ('parse_tokens(), per parse', '{:.1f} us'.format(scanned)),
+        ('speedup', '{:.1f}x'.format(formatted / scanned)),
+        ('tree_tokens() of nested lists, per parse', '{:.1f} us'.format(from_trees))])
+
+
+BENCHMARKS = [('dictionary_load', bench_dictionary_load),
+              ('actor_memory', bench_actor_memory),
+              ('mapped_image', bench_mapped_image),
+              ('date_resolution', bench_date_resolution),
+              ('discards', bench_discards),
+              ('issues', bench_issues),
+              ('workers', bench_workers),
+              ('stream', bench_stream),
+              ('xml_input', bench_xml_input),
+              ('xml_ranges', bench_xml_ranges),
+              ('segmenter', bench_segmenter),
+              ('server', bench_server),
+              ('sentences', bench_sentences),
+              ('tree', bench_tree),
+              ('tokenizer', bench_tokenizer)]
+
+
+def main(names):
+    selected = [(name, func) for name, func in BENCHMARKS
+                if not names or name in names]
+    for name, func in selected:
+        func()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
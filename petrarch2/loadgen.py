@@ -0,0 +1,154 @@
+##	loadgen.py [module]
+##
+# Load generator for the PETRARCH coding server
+#
+# Run with
+#
+#       python -m petrarch2.loadgen [--url URL] [--requests N] [--concurrency N]
+#                                   [--stories N] [--input FILE]
+#
+# against a server started with "petrarch2 serve". The stories are made from the
+# sentences of an XML input file -- the GigaWord sample by default -- as parsed
+# pipeline records, and sent stories-per-request at a time from concurrency threads.
+# A request refused with 503 because the server's queue is full is retried after its
+# Retry-After delay. The throughput and the request latencies are written to stdout.
+#
+# This code is covered under the MIT license
+# ------------------------------------------------------------------------
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import sys
+import json
+import time
+import argparse
+import threading
+import xml.etree.ElementTree as ET
+
+try:
+    from urllib2 import urlopen, Request, HTTPError
+except ImportError:
+    from urllib.request import urlopen, Request
+    from urllib.error import HTTPError
+
+import PETRreader
+import utilities
+
+
+def sample_records(path):
+    """
+    A parsed pipeline record for each <Sentence> of the XML file path whose text is
+    a single sentence, since a record carries one parse per sentence of its content.
+    """
+    records = []
+    for sent in ET.parse(path).getroot().iter('Sentence'):
+        if len(list(PETRreader._sentence_segmenter(sent.find('Text').text))) > 1:
+            continue
+        records.append({'_id': sent.get('id'), 'date': sent.get('date'),
+                        'date_added': '', 'source': sent.get('source', ''),
+                        'title': '', 'url': '',
+                        'content': sent.find('Text').text.strip(),
+                        'parsed_sents': [sent.find('Parse').text]})
+    return records
+
+
+def post(url, records):
+    """ POSTs records to the /code endpoint of url; returns the decoded reply. """
+    request = Request(url.rstrip('/') + '/code', json.dumps(records).encode('utf-8'),
+                      {'Content-Type': 'application/json'})
+    return json.loads(urlopen(request).read().decode('utf-8'))
+
+
+def health(url):
+    return json.loads(urlopen(url.rstrip('/') + '/health').read().decode('utf-8'))
+
+
+def run_load(url, records, requests=200, concurrency=8, stories=10):
+    """
+    Sends requests requests of stories records each from concurrency threads, and
+    returns a dict of the elapsed time, the latency of each request, and the
+    number of events, retries after 503 and failed requests.
+    """
+    lock = threading.Lock()
+    counts = {'next': 0, 'events': 0, 'retries': 0, 'errors': 0}
+    latencies = []
+
+    def client():
+        while True:
+            with lock:
+                n = counts['next']
+                counts['next'] += 1
+            if n >= requests:
+                return
+            start = n * stories
+            batch = [dict(records[(start + i) % len(records)],
+                          _id='{}-{}'.format(n, i)) for i in range(stories)]
+            t1 = time.time()
+            while True:
+                try:
+                    reply = post(url, batch)
+                except HTTPError as e:
+                    if e.code == 503:
+                        with lock:
+                            counts['retries'] += 1
+                        time.sleep(float(e.headers.get('Retry-After', 1)))
+                        continue
+                    with lock:
+                        counts['errors'] += 1
+                    break
+                with lock:
+                    latencies.append(time.time() - t1)
+                    counts['events'] += sum(len(events) for events in reply.values())
+                break
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    t1 = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return {'seconds': time.time() - t1, 'latencies': sorted(latencies),
+            'events': counts['events'], 'retries': counts['retries'],
+            'errors': counts['errors'], 'stories': stories}
+
+
+def summary_rows(result):
+    """ (label, value) rows describing a run_load() result. """
+    latencies = result['latencies']
+    done = len(latencies)
+
+    def percentile(p):
+        return latencies[min(done - 1, int(p * done))] * 1e3 if done else 0
+
+    seconds = result['seconds']
+    return [('requests', '{} ok   {} failed   {} retried after 503'.format(
+                done, result['errors'], result['retries'])),
+            ('throughput', '{:.1f} requests/s   {:.1f} stories/s   {} events'.format(
+                done / seconds, done * result['stories'] / seconds, result['events'])),
+            ('latency', 'p50 {:.1f} ms   p95 {:.1f} ms   max {:.1f} ms'.format(
+                percentile(0.5), percentile(0.95), percentile(1.0)))]
+
+
+def main(argv):
+    aparse = argparse.ArgumentParser(prog='loadgen', description="""Measures the
+                                     throughput of a running petrarch2 serve.""")
+    aparse.add_argument('--url', default='http://127.0.0.1:8765')
+    aparse.add_argument('--requests', type=int, default=200)
+    aparse.add_argument('--concurrency', type=int, default=8)
+    aparse.add_argument('--stories', type=int, default=10,
+                        help='Stories per request.')
+    aparse.add_argument('--input', default=utilities._get_data(
+        'data/text', 'GigaWord.sample.PETR.xml'),
+        help='XML file of parsed sentences to make the stories from.')
+    args = aparse.parse_args(argv)
+
+    result = run_load(args.url, sample_records(args.input), args.requests,
+                      args.concurrency, args.stories)
+    for label, value in summary_rows(result):
+        print('  {:<12}{}'.format(label, value))
+    print('  server      {}'.format(health(args.url)))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -5,10 +5,20 @@ from __future__ import unicode_literals
 
 import os
 import sys
+import copy
 import glob
 import time
+import types
 import logging
+import json
+import pickle
+import codecs
+import datetime
 import argparse
+import threading
+import contextlib
+import multiprocessing
+from collections import Counter, deque
 
 # petrarch.py
 ##
@@ -53,6 +63,9 @@ import PETRreader  # input routines
 import PETRwriter
 import utilities
 import PETRtree
+import PETRcache
+import PETRindex
+import PETRserver
 
 
 # ========================== VALIDATION FUNCTIONS ========================== #
@@ -112,219 +125,708 @@ def check_discards(SentenceText):
        0 : no matches
        1 : simple match
        2 : story match [+ prefix]
+
+    All of the phrases are found in one pass over the words of the sentence by the
+    automaton that PETRreader.compile_discard_list() built; match is the first
+    story phrase found or, if there is none, the first sentence phrase.
+    SentenceText can also be the sentence's utilities.SentenceTokens.
     """
-    sent = SentenceText.upper().split()  # case insensitive matching
-    #size = len(sent)
-    level = PETRglobals.DiscardList
-    depart_index = [0]
-    discardPhrase = ""
+    sent = utilities.sentence_words(SentenceText)  # case insensitive matching
+    found = [0, '']
+    for end, length, marker in PETRglobals.DiscardList.finditer(sent):
+        discardPhrase = ''.join(' ' + word for word in sent[end - length + 1:end + 1])
+        if marker == '+':
+            return [2, '+ ' + discardPhrase]
+        if not found[0]:
+            found = [1, ' ' + discardPhrase]
+    return found
 
-    for i in range(len(sent)):
 
-        if '+' in level:
-            return [2, '+ ' + discardPhrase]
-        elif '$' in level:
-            return [1, ' ' + discardPhrase]
-        elif sent[i] in level:
-            # print(sent[i],SentenceText.upper(),level[sent[i]])
-            depart_index.append(i)
-            level = level[sent[i]]
-            discardPhrase += " " + sent[i]
-        else:
-            if len(depart_index) == 0:
-                continue
-            i = depart_index[0]
-            level = PETRglobals.DiscardList
-    return [0, '']
+def check_prefilter(tokens):
+    """
+    The pre-filter run by do_coding() when PETRglobals.PreFilter is set: returns False
+    if the sentence cannot produce an event, True otherwise. tokens is the sentence's
+    utilities.SentenceTokens.
+
+    PETRtree only finds a verb code through a head verb in VerbDict['verbs'] and only
+    finds an actor code through an actor or agent phrase made of the words of a noun
+    phrase, so a sentence whose parse has no dictionary verb, or no set of words that
+    could spell out an actor or agent phrase, is never going to give an event. The
+    check is only valid for the normal coding mode, so do_coding() skips it when
+    coding nulls.
+    """
+    words = set(tokens.segs)
+    if PETRreader.prefilter_verbs().isdisjoint(words):
+        return False
+    return (PETRglobals.ActorDict.has_phrase_in(words) or
+            PETRglobals.AgentDict.has_phrase_in(words))
 
 
 def get_issues(SentenceText):
     """
-    Finds the issues in SentenceText, returns as a list of [code,count]
+    Finds the issues in SentenceText, returns them as a Counter of code: count
 
     <14.02.28> stops coding and sets the issues to zero if it finds *any*
     ignore phrase
 
+    The issue automaton built by PETRreader.compile_issue_list() finds every issue
+    phrase in one pass over the words; the phrases are then taken from left to right,
+    the shortest one at each position, skipping any that overlap a phrase already
+    taken. SentenceText can also be the sentence's utilities.SentenceTokens.
     """
-    def recurse(words, path, length):
-        if '#' in path:  # <16.06.06 pas> Swapped the ordering if these checks since otherwise it crashes when '#' is a "word" in the text
-            return path['#'], length
-        elif words and words[0] in path:
-            return recurse(words[1:], path[words[0]], length + 1)
-        return False
-
-    sent = SentenceText.upper().split()  # case insensitive matching
-    issues = []
-
+    sent = utilities.sentence_words(SentenceText)  # case insensitive matching
+    shortest = {}
+    for end, length, codeindex in PETRglobals.IssueList.finditer(sent):
+        # phrases come in order of their end, so the first one seen at a start is the
+        # shortest
+        start = end - length + 1
+        if start not in shortest:
+            shortest[start] = (length, codeindex)
+
+    issues = Counter()
     index = 0
-    while index < len(sent):
-        match = recurse(sent[index:], PETRglobals.IssueList, 0)
-        if match:
-            index += match[1]
-            code = PETRglobals.IssueCodes[match[0]]
-            if code[0] == '~':  # ignore code, so bail
-                return []
-            ka = 0
-            #gotcode = False
-            while ka < len(issues):
-                if code == issues[ka][0]:
-                    issues[ka][1] += 1
-                    break
-                ka += 1
-            if ka == len(issues):  # didn't find the code, so add it
-                issues.append([code, 1])
-        else:
-            index += 1
+    for start in sorted(shortest):
+        if start < index:
+            continue
+        length, codeindex = shortest[start]
+        code = PETRglobals.IssueCodes[codeindex]
+        if code[0] == '~':  # ignore code, so bail
+            return Counter()
+        issues[code] += 1
+        index = start + length
     return issues
 
 
-def do_coding(event_dict):
+def get_issues_batch(texts):
+    """ Runs get_issues() on each of the sentence texts, returning a list of Counters. """
+    return [get_issues(text) for text in texts]
+
+
+def code_issues(event_dict, tokens=None):
     """
-    Main coding loop Note that entering any character other than 'Enter' at the
-    prompt will stop the program: this is deliberate.
-    <14.02.28>: Bug: PETRglobals.PauseByStory actually pauses after the first
-                sentence of the *next* story
+    Codes the issues of every sentence in event_dict that has events, storing them
+    under the 'issues' key of the sentence. do_coding() runs this as its last stage
+    when an issues file is configured, passing the SentenceTokens it made for each
+    coded sentence in tokens, a dictionary keyed by (story id, sentence id); it can
+    also be run on its own over coded events.
+    """
+    tokens = tokens or {}
+    sentences = [(sent_dict, tokens.get((key, sent), sent_dict['content']))
+                 for key, story in event_dict.items() if story['sents']
+                 for sent, sent_dict in story['sents'].items()
+                 if sent_dict.get('events')]
+    for (sent_dict, _), issues in zip(sentences, get_issues_batch(
+            [text for _, text in sentences])):
+        if issues:
+            sent_dict['issues'] = issues
+
+
+def change_Config_Options(line):
+    """
+    Changes a coding option for the rest of the run from the config entry of a
+    sentence: a dict with the 'option' name, as in the config file, and its 'value'.
     """
+    logger = logging.getLogger('petr_log')
+    theoption = line['option']
+    value = line['value']
+    if theoption == 'new_actor_length':
+        try:
+            PETRglobals.NewActorLength = int(value)
+        except ValueError:
+            logger.warning(
+                "<Config>: new_actor_length must be an integer; command ignored")
+    elif theoption == 'require_dyad':
+        PETRglobals.RequireDyad = 'false' not in value.lower()
+    elif theoption == 'stop_on_error':
+        PETRglobals.StoponError = 'false' not in value.lower()
+    elif theoption in _comma_options:
+        try:
+            setattr(PETRglobals, _comma_options[theoption], int(value))
+        except ValueError:
+            logger.warning(
+                "<Config>: {} must be an integer; command ignored".format(theoption))
+    else:
+        logger.warning("<Config>: " + theoption + " is not a recognized option")
 
-    treestr = ""
 
-    NStory = 0
-    NSent = 0
-    NEvents = 0
-    NEmpty = 0
-    NDiscardSent = 0
-    NDiscardStory = 0
+_comma_options = {'comma_min': 'CommaMin', 'comma_max': 'CommaMax',
+                  'comma_bmin': 'CommaBMin', 'comma_bmax': 'CommaBMax',
+                  'comma_emin': 'CommaEMin', 'comma_emax': 'CommaEMax'}
 
-    logger = logging.getLogger('petr_log')
-    times = 0
-    sents = 0
-    for key, val in sorted(event_dict.items()):
-        NStory += 1
-        prev_code = []
 
-        SkipStory = False
+def sentence_events(treestr, text, date, tokens, stats, cache=None, show=False):
+    """
+    Codes one parsed sentence: treestr is its parse as formatted by
+    utilities._format_parsed_str() -- which only matters for the key of cache --
+    date its ordinal date and tokens its utilities.SentenceTokens. Returns the (events, meta, sentence text) of
+    PETRtree.Sentence, from the ResultCache cache when it has them, and adds the time
+    taken to stats. show prints the sentence text.
+    """
+    t1 = time.time()
+    cached = None
+    if cache:
+        cache_key = cache.key(treestr, date)
+        cached = cache.get(cache_key)
+        stats['cache_hits' if cached else 'cache_misses'] += 1
+    if cached:
+        coded_events, meta, sentence_txt = cached
+        if show:
+            print(sentence_txt)
+    else:
+        sentence = PETRtree.Sentence(treestr, text, date, tokens)
+        if show:
+            print(sentence.txt)
+        # this is the entry point into the processing in PETRtree
+        coded_events, meta = sentence.get_events()
+        sentence_txt = sentence.txt
+        if cache:
+            cache.put(cache_key, (coded_events, meta, sentence_txt))
+        del(sentence)
+    stats['code_time'] += time.time() - t1
+    stats['coded'] += 1
+    return coded_events, meta, sentence_txt
+
+
+def code_story(key, story, stats):
+    """
+    Codes the sentences of one story of the event_dict, storing the events and their
+    metadata in the sentence dictionaries of story, and adds the story's counts to
+    the Counter stats. The issues of the sentences with events are coded at the end of
+    the story when an issues file is configured.
+    """
+    logger = logging.getLogger('petr_log')
+    prefilter = PETRglobals.PreFilter and not (
+        PETRglobals.NullVerbs or PETRglobals.NullActors)
+    cache = None
+    if not (PETRglobals.NullVerbs or PETRglobals.NullActors):
+        cache = PETRcache.result_cache()
+    sentence_tokens = {}  # kept for code_issues()
+
+    stats['stories'] += 1
+    SkipStory = False
+    verbose = not PETRglobals.Quiet
+    if verbose:
         print('\n\nProcessing story {}'.format(key))
-        StoryDate = event_dict[key]['meta']['date']
-        for sent in val['sents']:
-            NSent += 1
-            if 'parsed' in event_dict[key]['sents'][sent]:
-                if 'config' in val['sents'][sent]:
-                    for _, config in event_dict[key]['sents'][sent]['config'].items():
-                        change_Config_Options(config)
-
-                SentenceID = '{}_{}'.format(key, sent)
-                SentenceText = event_dict[key]['sents'][sent]['content']
-                SentenceDate = event_dict[key]['sents'][sent][
-                    'date'] if 'date' in event_dict[key]['sents'][sent] else StoryDate
-                Date = PETRreader.dstr_to_ordate(SentenceDate)
-
+    StoryDate = story['meta']['date']
+    for sent in story['sents']:
+        stats['sents'] += 1
+        sent_dict = story['sents'][sent]
+        SentenceID = '{}_{}'.format(key, sent)
+        if 'parsed' in sent_dict:
+            if 'config' in sent_dict:
+                for _, config in sent_dict['config'].items():
+                    change_Config_Options(config)
+
+            SentenceText = sent_dict['content']
+            SentenceDate = sent_dict[
+                'date'] if 'date' in sent_dict else StoryDate
+            Date = PETRreader.dstr_to_ordate(SentenceDate)
+
+            if verbose:
                 print("\n", SentenceID)
-                parsed = event_dict[key]['sents'][sent]['parsed']
-                treestr = parsed
-                disc = check_discards(SentenceText)
-                if disc[0] > 0:
-                    if disc[0] == 1:
+            parsed = sent_dict['parsed']
+            treestr = parsed
+            tokens = utilities.SentenceTokens(SentenceText, parsed)
+            disc = check_discards(tokens)
+            if disc[0] > 0:
+                if disc[0] == 1:
+                    if verbose:
                         print("Discard sentence:", disc[1])
-                        logger.info('\tSentence discard. {}'.format(disc[1]))
-                        NDiscardSent += 1
-                        continue
-                    else:
-                        print("Discard story:", disc[1])
-                        logger.info('\tStory discard. {}'.format(disc[1]))
-                        SkipStory = True
-                        NDiscardStory += 1
-                        break
-
-                t1 = time.time()
-                sentence = PETRtree.Sentence(treestr, SentenceText, Date)
-                print(sentence.txt)
-                # this is the entry point into the processing in PETRtree
-                coded_events, meta = sentence.get_events()
-                code_time = time.time() - t1
-                if PETRglobals.NullVerbs or PETRglobals.NullActors:
-                    event_dict[key]['meta'] = meta
-                    event_dict[key]['text'] = sentence.txt
-                elif PETRglobals.NullActors:
-                    event_dict[key]['events'] = coded_events
-                    coded_events = None   # skips additional processing
-                    event_dict[key]['text'] = sentence.txt
+                    logger.info('\tSentence discard. {}'.format(disc[1]))
+                    stats['discard_sents'] += 1
+                    continue
                 else:
-                    # 16.04.30 pas: we're using the key value 'meta' at two
-                    # very different
-                    event_dict[key]['meta']['verbs'] = meta
-                    # levels of event_dict -- see the code about ten lines below -- and
-                    # this is potentially confusing, so it probably would be useful to
-                    # change one of those
-
-                del(sentence)
-                times += code_time
-                sents += 1
-                # print('\t\t',code_time)
-
-                if coded_events:
-                    event_dict[key]['sents'][sent]['events'] = coded_events
-                    event_dict[key]['sents'][sent]['meta'] = meta
-                    #print('DC-events:', coded_events) # --
-                    #print('DC-meta:', meta) # --
-                    #print('+++',event_dict[key]['sents'][sent])  # --
-                    if PETRglobals.WriteActorText or PETRglobals.WriteEventText or PETRglobals.WriteActorRoot:
-                        text_dict = utilities.extract_phrases(event_dict[key]['sents'][sent], SentenceID)
-# --                        print('DC-td1:',text_dict) # --
-                        if text_dict:
-                            event_dict[key]['sents'][sent][
-                                'meta']['actortext'] = {}
-                            event_dict[key]['sents'][sent][
-                                'meta']['eventtext'] = {}
-                            event_dict[key]['sents'][sent][
-                                'meta']['actorroot'] = {}
-# --                            print('DC1:',text_dict) # --
-                            for evt in coded_events:
-                                if evt in text_dict:  # 16.04.30 pas bypasses problems with expansion of compounds
-                                    event_dict[key]['sents'][sent]['meta'][
-                                        'actortext'][evt] = text_dict[evt][:2]
-                                    event_dict[key]['sents'][sent]['meta'][
-                                        'eventtext'][evt] = text_dict[evt][2]
-                                    event_dict[key]['sents'][sent]['meta'][
-                                        'actorroot'][evt] = text_dict[evt][3:5]
-
-                if coded_events and PETRglobals.IssueFileName != "":
-                    event_issues = get_issues(SentenceText)
-                    if event_issues:
-                        event_dict[key]['sents'][sent]['issues'] = event_issues
-
-                if PETRglobals.PauseBySentence:
-                    if len(input("Press Enter to continue...")) > 0:
-                        sys.exit()
-
-                prev_code = coded_events
-                NEvents += len(coded_events)
-                if len(coded_events) == 0:
-                    NEmpty += 1
+                    if verbose:
+                        print("Discard story:", disc[1])
+                    logger.info('\tStory discard. {}'.format(disc[1]))
+                    SkipStory = True
+                    stats['discard_stories'] += 1
+                    break
+
+            if prefilter and not check_prefilter(tokens):
+                if verbose:
+                    print("Filtered: no verb or actor")
+                stats['filtered'] += 1
+                stats['empty'] += 1
+                continue
+
+            coded_events, meta, sentence_txt = sentence_events(
+                treestr, SentenceText, Date, tokens, stats, cache, show=verbose)
+            if PETRglobals.NullVerbs or PETRglobals.NullActors:
+                story['meta'] = meta
+                story['text'] = sentence_txt
+            elif PETRglobals.NullActors:
+                story['events'] = coded_events
+                coded_events = None   # skips additional processing
+                story['text'] = sentence_txt
             else:
-                logger.info('{} has no parse information. Passing.'.format(SentenceID))
-                pass
+                # 16.04.30 pas: we're using the key value 'meta' at two
+                # very different
+                story['meta']['verbs'] = meta
+                # levels of event_dict -- see the code about ten lines below -- and
+                # this is potentially confusing, so it probably would be useful to
+                # change one of those
+
+            if coded_events:
+                sent_dict['events'] = coded_events
+                sent_dict['meta'] = meta
+                if PETRglobals.IssueFileName != "":
+                    sentence_tokens[(key, sent)] = tokens
+                #print('DC-events:', coded_events) # --
+                #print('DC-meta:', meta) # --
+                #print('+++',sent_dict)  # --
+                if PETRglobals.WriteActorText or PETRglobals.WriteEventText or PETRglobals.WriteActorRoot:
+                    text_dict = utilities.extract_phrases(sent_dict, SentenceID, tokens)
+# --                    print('DC-td1:',text_dict) # --
+                    if text_dict:
+                        sent_dict['meta']['actortext'] = {}
+                        sent_dict['meta']['eventtext'] = {}
+                        sent_dict['meta']['actorroot'] = {}
+# --                        print('DC1:',text_dict) # --
+                        for evt in coded_events:
+                            if evt in text_dict:  # 16.04.30 pas bypasses problems with expansion of compounds
+                                sent_dict['meta']['actortext'][evt] = text_dict[evt][:2]
+                                sent_dict['meta']['eventtext'][evt] = text_dict[evt][2]
+                                sent_dict['meta']['actorroot'][evt] = text_dict[evt][3:5]
+
+            if PETRglobals.PauseBySentence:
+                if len(input("Press Enter to continue...")) > 0:
+                    sys.exit()
+
+            stats['events'] += len(coded_events)
+            if len(coded_events) == 0:
+                stats['empty'] += 1
+        else:
+            logger.info('{} has no parse information. Passing.'.format(SentenceID))
+            pass
+
+    if cache:
+        cache.commit()
+    if SkipStory:
+        story['sents'] = None
+    elif PETRglobals.IssueFileName != "":
+        code_issues({key: story}, sentence_tokens)
+    return story
+
+
+def _code_stories(stories):
+    """ Pool worker for iter_coding(): codes a chunk of (key, story) pairs. """
+    stats = Counter()
+    coded = [(key, code_story(key, story, stats)) for key, story in stories]
+    return coded, stats
+
+
+def _chunks(items, size):
+    """ Yields lists of up to size consecutive elements of the iterable items. """
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _install_coder(coder):
+    """ Pool initializer: installs the state of coder in the worker's PETRglobals. """
+    if coder.state is not None:
+        _set_global_state(coder.state)
+
+
+def _worker_pool(workers, coder):
+    """
+    A multiprocessing.Pool of workers processes that code with the state of coder.
+    The workers are forked where the platform can, so that they share the parent's
+    copy of the dictionaries; otherwise they start with empty PETRglobals and coder
+    is pickled to each of them.
+    """
+    context = multiprocessing
+    if 'fork' in getattr(multiprocessing, 'get_all_start_methods', list)():
+        context = multiprocessing.get_context('fork')
+    return context.Pool(workers, _install_coder, (coder,))
+
+
+def _code_parsed_sentence(parse, text, date, stats, cache=None):
+    """
+    Codes one sentence for code_sentences(), with the discard check and the
+    pre-filter. Returns its (events, meta, tokens); a discarded or filtered sentence
+    has no events. As in code_story(), the null modes skip the pre-filter and cache.
+    """
+    null_mode = PETRglobals.NullVerbs or PETRglobals.NullActors
+    if null_mode:
+        cache = None
+    stats['sents'] += 1
+    tokens = utilities.SentenceTokens(text, segs=utilities.parse_tokens(parse))
+    if check_discards(tokens)[0] > 0:
+        stats['discard_sents'] += 1
+        return [], {}, tokens
+    if PETRglobals.PreFilter and not null_mode and not check_prefilter(tokens):
+        stats['filtered'] += 1
+        stats['empty'] += 1
+        return [], {}, tokens
+    # the formatted parse is only needed as the key of the cache
+    treestr = utilities.format_parse(parse) if cache else parse
+    events, meta, _ = sentence_events(treestr, text, PETRreader.dstr_to_ordate(date),
+                                      tokens, stats, cache)
+    stats['events'] += len(events)
+    if not events:
+        stats['empty'] += 1
+    return events, meta, tokens
+
+
+def code_sentences(records):
+    """
+    Codes (id, parse, text, date) records with the configuration and dictionaries in
+    PETRglobals; see Coder.code_sentences().
+    """
+    return default_coder().code_sentences(records)
+
+
+def iter_coding(stories, workers=1, window=None, chunksize=None):
+    """
+    Codes the (key, story) pairs of the iterable stories with the configuration and
+    dictionaries in PETRglobals; see Coder.code_stories().
+    """
+    return default_coder().code_stories(stories, workers, window, chunksize)
 
-        if SkipStory:
-            event_dict[key]['sents'] = None
 
+def print_summary(stats, workers=1, elapsed=0):
+    """ Prints the coding summary from the counts that code_story() made. """
+    if PETRglobals.Quiet:
+        return
     print("\nSummary:")
     print(
         "Stories read:",
-        NStory,
+        stats['stories'],
         "   Sentences coded:",
-        NSent,
+        stats['sents'],
         "  Events generated:",
-        NEvents)
+        stats['events'])
     print(
         "Discards:  Sentence",
-        NDiscardSent,
+        stats['discard_sents'],
         "  Story",
-        NDiscardStory,
+        stats['discard_stories'],
         "  Sentences without events:",
-        NEmpty)
-    print("Average Coding time = ", times / sents if sents else 0)
-# --    print('DC-exit:',event_dict)
-    return event_dict
+        stats['empty'])
+    if PETRglobals.PreFilter and not (PETRglobals.NullVerbs or PETRglobals.NullActors):
+        print("Filtered by pre-filter:", stats['filtered'])
+    if stats['cache_hits'] or stats['cache_misses']:
+        print("Result cache:  Hits", stats['cache_hits'], "  Misses",
+              stats['cache_misses'], "  Hit rate {:.1%}".format(
+                  stats['cache_hits'] / float(stats['cache_hits'] + stats['cache_misses'])))
+    print("Average Coding time = ",
+          stats['code_time'] / stats['coded'] if stats['coded'] else 0)
+    if workers > 1:
+        print("Workers:", workers, "  Stories per second: {:.1f}".format(
+            stats['stories'] / elapsed if elapsed else 0))
+
+
+def _code_xml_range(task):
+    """
+    Pool worker for code_xml_ranges(): reads, codes and formats the stories of one
+    byte range of an XML file, returning the event lines, the counts and the
+    StoryIDs of the range.
+    """
+    path, start, end = task
+    stats = Counter()
+    lines = []
+    keys = set()
+    for key, story in PETRreader.iter_xml_range(path, start, end, True,
+                                                PETRglobals.StreamWindow):
+        lines += PETRwriter.format_story_events(key, code_story(key, story, stats))
+        keys.add(key)
+    return lines, stats, keys
+
+
+def code_xml_ranges(filepaths, out_file, workers=1, chunk_bytes=64 << 20):
+    """
+    Codes large files of parsed XML input with a pool of workers, writing the events
+    to out_file. Each file is split with PETRreader.xml_byte_ranges() into ranges of
+    about chunk_bytes; each worker memory-maps the file and reads, codes and formats
+    its own ranges, so the text is never sent between processes, and the event lines
+    come back and are written in file order. At most two ranges per
+    worker are in hand at once. Returns the number of events written.
+
+    A range only ends between stories, but a story whose sentences are not together
+    in the file can still fall into two ranges, and is then coded as two stories; a
+    warning is logged when that happens.
+    """
+    logger = logging.getLogger('petr_log')
+    stats = Counter()
+    count = 0
+    done = set()  # the StoryIDs of the ranges already written
+    t1 = time.time()
+    tasks = [(path, start, end) for path in filepaths
+             for start, end in PETRreader.xml_byte_ranges(path, chunk_bytes)]
+    pending = deque()
+    pool = _worker_pool(workers, default_coder())
+    try:
+        with codecs.open(out_file, encoding='utf-8', mode='w') as fout:
+            for ka, task in enumerate(tasks):
+                pending.append(pool.apply_async(_code_xml_range, (task,)))
+                while pending and (len(pending) >= 2 * workers or ka == len(tasks) - 1):
+                    lines, range_stats, keys = pending.popleft().get()
+                    stats.update(range_stats)
+                    for key in sorted(keys & done):
+                        logger.warning('Story {} has sentences in more than one range: '
+                                       'they are coded as separate stories'.format(key))
+                    done |= keys
+                    for line in lines:
+                        fout.write(line + '\n')
+                    fout.flush()
+                    count += len(lines)
+        pool.close()
+        pool.join()
+    finally:
+        pool.terminate()
+    print_summary(stats, workers, time.time() - t1)
+    return count
+
+
+def do_coding(event_dict, workers=1):
+    """
+    Main coding loop Note that entering any character other than 'Enter' at the
+    prompt will stop the program: this is deliberate.
+    <14.02.28>: Bug: PETRglobals.PauseByStory actually pauses after the first
+                sentence of the *next* story
+
+    Codes event_dict with the configuration and dictionaries in PETRglobals; see
+    Coder.do_coding().
+    """
+    return default_coder().do_coding(event_dict, workers)
+
+
+# ========================== CODER OBJECTS ========================== #
+
+# The coder in PETRtree and the readers keep the configuration and the dictionaries in
+# PETRglobals. A Coder owns its own copy of that state and installs it in PETRglobals
+# while it codes, under _globals_lock, so that coders with different configurations
+# can be used in one process and from several threads. Coding itself is serialised by
+# the lock; use the workers argument for parallel coding.
+
+_globals_lock = threading.RLock()
+
+
+def _global_state():
+    """ The configuration and dictionaries currently in PETRglobals, as a dict. """
+    return dict((name, value) for name, value in vars(PETRglobals).items()
+                if not name.startswith('_') and
+                not isinstance(value, types.ModuleType))
+
+
+def _set_global_state(state):
+    for name, value in state.items():
+        setattr(PETRglobals, name, value)
+
+
+_initial_state = copy.deepcopy(_global_state())  # PETRglobals before any config is read
+
+
+class Coder(object):
+    """
+    An event coder with its own configuration, dictionaries and coding counts.
+
+    Coder(config) reads the config file -- the default PETR_config.ini if none -- and
+    the dictionaries it names, or those of dict_bundle, without touching the state of
+    any other coder. default_coder() is the coder of the state already in PETRglobals,
+    which the module-level functions use. A Coder can be pickled, e.g. to send it to a
+    worker process, in which case a mapped dictionary image is copied into dicts.
+    """
+
+    def __init__(self, config=None, dict_bundle=None, rebuild_cache=False):
+        self.stats = Counter()
+        with _globals_lock:
+            saved = _global_state()
+            _set_global_state(copy.deepcopy(_initial_state))
+            try:
+                PETRreader.parse_Config(config or utilities._get_data(
+                    'data/config/', 'PETR_config.ini'))
+                read_dictionaries(rebuild_cache=rebuild_cache, bundle=dict_bundle)
+                self.state = _global_state()
+            finally:
+                _set_global_state(saved)
+
+    @classmethod
+    def from_globals(cls):
+        """ A Coder that uses whatever is in PETRglobals when it codes. """
+        coder = cls.__new__(cls)
+        coder.stats = Counter()
+        coder.state = None
+        return coder
+
+    def __getstate__(self):
+        with _globals_lock:
+            state = _global_state() if self.state is None else self.state
+        return {'state': state, 'stats': self.stats}
+
+    def __setstate__(self, state):
+        self.state = state['state']
+        self.stats = state['stats']
+
+    @contextlib.contextmanager
+    def active(self):
+        """
+        Installs the coder's state in PETRglobals for the duration of the block, and
+        keeps any change made to it there -- by change_Config_Options() or the lazily
+        built lookup tables -- when the block ends.
+        """
+        with _globals_lock:
+            if self.state is None:
+                yield
+                return
+            saved = _global_state()
+            _set_global_state(self.state)
+            try:
+                yield
+            finally:
+                self.state = _global_state()
+                _set_global_state(saved)
+
+    def code_story(self, key, story, stats=None):
+        """
+        Codes one story of an event_dict; see code_story(). The story's counts are
+        added to the coder's stats and, if given, to the Counter stats.
+        """
+        story_stats = Counter()
+        with self.active():
+            story = code_story(key, story, story_stats)
+        self.stats.update(story_stats)
+        if stats is not None:
+            stats.update(story_stats)
+        return story
+
+    def code_sentence(self, parse, text, date):
+        """
+        Codes a single sentence: parse is its Penn Treebank parse, as a string or a
+        tree structure (see utilities.tree_tokens()), text the sentence and date a
+        YYYYMMDD string. Returns the (events, meta) of the sentence, which
+        are empty if it was discarded or has no events.
+        """
+        story = {'sents': {'0': {'content': text,
+                                 'parsed': utilities.format_parse(parse)}},
+                 'meta': {'date': date}}
+        sent = (self.code_story('', story)['sents'] or {}).get('0', {})
+        return sent.get('events', []), sent.get('meta', {})
+
+    def code_sentences(self, records):
+        """
+        Codes parsed sentences one at a time, without the holding dictionary. records
+        is an iterable of (id, parse, text, date) tuples: parse is the sentence's Penn
+        Treebank parse, as for code_sentence(), text the sentence and date a YYYYMMDD
+        string. Yields an (id, events) pair for each record, as soon as it is coded,
+        where events is a list of (source, target, code, issues, text) tuples, one for
+        each distinct event of the sentence:
+
+            issues  the issues of the sentence, joined as ISSUE,COUNT;ISSUE,COUNT as in
+                    PETRwriter.pipe_output(), when an issues file is configured;
+                    otherwise None
+            text    the (source text, target text, event text, source root, target
+                    root) of utilities.extract_phrases() when write_actor_text,
+                    write_event_text or write_actor_root is set; otherwise None
+
+        A sentence matching a discard phrase, of either kind, has no events. The
+        null_verbs and null_actors options apply as in code_story(): with null_verbs
+        the sentences have no events, and neither mode uses the pre-filter or the
+        result cache.
+        """
+        for record_id, parse, text, date in records:
+            stats = Counter()
+            with self.active():
+                cache = PETRcache.result_cache()
+                events, meta, tokens = _code_parsed_sentence(parse, text, date,
+                                                             stats, cache)
+                issues = texts = None
+                if events and PETRglobals.IssueFileName != "":
+                    issues = ';'.join('{},{}'.format(issue, count) for issue, count
+                                      in get_issues(tokens).items())
+                if events and (PETRglobals.WriteActorText or
+                               PETRglobals.WriteEventText or PETRglobals.WriteActorRoot):
+                    texts = utilities.extract_phrases({'content': text, 'meta': meta},
+                                                      record_id, tokens)
+                coded = []
+                seen = set()
+                for event in events:
+                    if event not in seen:
+                        seen.add(event)
+                        coded.append(tuple(event) + (
+                            issues, tuple(texts[event]) if texts and event in texts
+                            else None))
+                if cache:
+                    cache.commit()
+            self.stats.update(stats)
+            yield record_id, coded
+
+    def code_stories(self, stories, workers=1, window=None, chunksize=None):
+        """
+        Codes the (key, story) pairs of the iterable stories, yielding each coded pair in
+        the order read, and prints the summary once stories is used up.
+
+        With workers > 1 the stories are coded by a pool of that many processes
+        (see _worker_pool()), which have the coder's state installed and are sent
+        chunks of chunksize stories. When window is set, no more than about window
+        stories are read ahead of the one being yielded, so the memory used does not
+        depend on the length of stories. Pausing by sentence needs the terminal, so it always codes serially.
+        """
+        stats = Counter()
+        t1 = time.time()
+        with self.active():
+            pause = PETRglobals.PauseBySentence
+        if workers > 1 and not pause:
+            if not chunksize:
+                chunksize = max(1, min(64, (window or 64) // (4 * workers)))
+            limit = max(1, window // chunksize) if window else 0
+            pending = deque()
+            pool = _worker_pool(workers, self)
+            try:
+                for chunk in _chunks(stories, chunksize):
+                    pending.append(pool.apply_async(_code_stories, (chunk,)))
+                    while limit and len(pending) >= limit:
+                        coded, chunk_stats = pending.popleft().get()
+                        stats.update(chunk_stats)
+                        for item in coded:
+                            yield item
+                while pending:
+                    coded, chunk_stats = pending.popleft().get()
+                    stats.update(chunk_stats)
+                    for item in coded:
+                        yield item
+                pool.close()
+                pool.join()
+            finally:
+                pool.terminate()
+            self.stats.update(stats)
+        else:
+            workers = 1
+            for key, story in stories:
+                yield key, self.code_story(key, story, stats)
+        with self.active():
+            print_summary(stats, workers, time.time() - t1)
+
+    def do_coding(self, event_dict, workers=1):
+        """
+        Codes the stories of event_dict in story-id order -- with workers > 1, by a
+        pool of processes -- and puts the coded stories back into event_dict, which
+        gives the same output whatever the number of workers.
+        """
+        stories = sorted(event_dict.items())
+        if len(stories) < 2:
+            workers = 1
+        # about four chunks per worker to even out the load, but no more than 64
+        # stories at a time so that results keep flowing back
+        chunksize = max(1, min(64, len(stories) // (4 * workers)))
+        for key, story in self.code_stories(stories, workers, chunksize=chunksize):
+            event_dict[key] = story
+        return event_dict
+
+
+_default_coder = Coder.from_globals()
+
+
+def default_coder():
+    """ The Coder of the configuration and dictionaries in PETRglobals. """
+    return _default_coder
 
 
 def parse_cli_args():
@@ -357,6 +859,10 @@ PETRARCH2
                                help="""Filepath for the PETRARCH configuration
                                file. Defaults to PETR_config.ini""",
                                required=False)
+    parse_command.add_argument('--rebuild-cache', action='store_true',
+                               default=False, help="""Parse the text
+                               dictionaries and rewrite the compiled
+                               dictionary cache even if it is current.""")
 
     batch_command = sub_parse.add_parser('batch', help="""Command to run a batch
                                          process from parsed files specified by
@@ -370,7 +876,9 @@ PETRARCH2
                                required=False)
 
     batch_command.add_argument('-i', '--inputs',
-                               help="""Filepath for the input XML file. Defaults to
+                               help="""Filepath for the input XML or JSON-lines
+                               file (.jsonl or .ndjson, optionally .gz, .bz2 or
+                               .xz), or a directory of them. Defaults to
                                data/text/Gigaword.sample.PETR.xml""",
                                required=False)
 
@@ -379,6 +887,136 @@ PETRARCH2
                                data/text/Gigaword.sample.PETR.xml""",
                                required=False)
 
+    batch_command.add_argument('--rebuild-cache', action='store_true',
+                               default=False, help="""Parse the text
+                               dictionaries and rewrite the compiled
+                               dictionary cache even if it is current.""")
+
+    batch_command.add_argument('--dict-bundle',
+                               help="""Dictionary bundle written by
+                               compile-dicts; used in place of the dictionary
+                               files named in the config.""",
+                               required=False)
+
+    batch_command.add_argument('--workers', type=int, default=1,
+                               help="""Number of processes to code the
+                               stories with. Defaults to 1.""",
+                               required=False)
+
+    batch_command.add_argument('--chunk-mb', type=int, default=0,
+                               help="""With --workers, split the input files
+                               into byte ranges of about this many MB that the
+                               workers read and code themselves; for very large
+                               files. Events are written in file order. The
+                               sentences of each story should be together in
+                               the file.""",
+                               required=False)
+
+    batch_command.add_argument('--stream', action='store_true',
+                               default=False, help="""Read, code and write
+                               the stories one at a time, in input order, so
+                               that memory does not grow with the input;
+                               stream_window in the config sets how many
+                               stories can be in memory at once, and so how
+                               far apart the sentences of a story can be.""")
+
+    batch_command.add_argument('--checkpoint', action='store_true',
+                               default=False, help="""Code as with --stream,
+                               and every checkpoint_stories stories or
+                               checkpoint_seconds seconds (see the config) make
+                               sure the output is on disk and record the stories
+                               coded so far in <output file>.checkpoint.""")
+
+    batch_command.add_argument('--resume', action='store_true',
+                               default=False, help="""Carry on from the last
+                               checkpoint of an earlier --checkpoint run with the
+                               same input, skipping the stories it coded and
+                               appending to its output file.""")
+
+    batch_command.add_argument('--index',
+                               help="""Code as with --stream, and keep the
+                               stories, their events and an index of their words
+                               in this SQLite file, so that after dictionary edits
+                               the recode command can code again only the
+                               stories the edits could change.""",
+                               required=False)
+
+    recode_command = sub_parse.add_parser('recode', help="""Command to code
+                                          again, with the current dictionaries,
+                                          the stories of a batch --index file
+                                          that the dictionary edits since could
+                                          change.""",
+                                          description="""Command to code again
+                                          only the stories of a batch --index
+                                          file containing a word whose
+                                          dictionary entries have changed, and
+                                          write the events of all of its
+                                          stories.""")
+    recode_command.add_argument('--index', help="""SQLite file written by
+                                batch --index; updated in place.""",
+                                required=True)
+    recode_command.add_argument('-o', '--outputs',
+                                help='File to write the events of the index to.',
+                                required=True)
+    recode_command.add_argument('-c', '--config',
+                                help="""Filepath for the PETRARCH configuration
+                                file. Defaults to PETR_config.ini""",
+                                required=False)
+    recode_command.add_argument('--workers', type=int, default=1,
+                                help="""Number of processes to code the
+                                stories with. Defaults to 1.""",
+                                required=False)
+
+    serve_command = sub_parse.add_parser('serve', help="""Command to run a
+                                         local HTTP server that keeps the
+                                         dictionaries loaded and codes parsed
+                                         stories posted to it.""",
+                                         description="""Command to run a local
+                                         HTTP server that reads the dictionaries
+                                         once and codes the parsed pipeline
+                                         records POSTed as JSON to /code,
+                                         replying with their events; GET /health
+                                         reports its state.""")
+    serve_command.add_argument('-c', '--config',
+                               help="""Filepath for the PETRARCH configuration
+                               file. Defaults to PETR_config.ini""",
+                               required=False)
+    serve_command.add_argument('--dict-bundle',
+                               help="""Dictionary bundle written by
+                               compile-dicts; used in place of the dictionary
+                               files named in the config.""",
+                               required=False)
+    serve_command.add_argument('--host', default='127.0.0.1',
+                               help="""Address to listen on. Defaults to
+                               127.0.0.1.""")
+    serve_command.add_argument('--port', type=int, default=8765,
+                               help="""Port to listen on. Defaults to 8765.""")
+    serve_command.add_argument('--queue-size', type=int, default=64,
+                               help="""Number of requests that can wait to be
+                               coded; more are refused with 503. Defaults to
+                               64.""")
+    serve_command.add_argument('--batch-size', type=int, default=64,
+                               help="""Number of stories from waiting requests
+                               to code together. Defaults to 64.""")
+    serve_command.add_argument('--batch-wait', type=float, default=0.0,
+                               help="""Milliseconds to wait for more requests
+                               to fill a batch. Defaults to 0.""")
+
+    compile_command = sub_parse.add_parser('compile-dicts', help="""Command to
+                                           compile the dictionaries named in the
+                                           config file into a single bundle.""",
+                                           description="""Command to compile
+                                           the dictionaries named in the config
+                                           file into a single bundle that batch
+                                           can read with --dict-bundle.""")
+    compile_command.add_argument('-c', '--config',
+                                 help="""Filepath for the PETRARCH configuration
+                                 file. Defaults to PETR_config.ini""",
+                                 required=False)
+    compile_command.add_argument('-o', '--output',
+                                 help='File to write the dictionary bundle to.',
+                                 required=True)
+
     nulloptions = aparse.add_mutually_exclusive_group()
 
     nulloptions.add_argument(
@@ -432,17 +1070,32 @@ def main():
         PETRglobals.NullActors = True
         PETRglobals.NewActorLength = int(cli_args.nullactors)
 
-    read_dictionaries()
+    if cli_args.command_name == 'compile-dicts':
+        compile_dictionaries(cli_args.output)
+        print("Finished")
+        return
+
+    read_dictionaries(rebuild_cache=getattr(cli_args, 'rebuild_cache', False),
+                      bundle=getattr(cli_args, 'dict_bundle', None))
     start_time = time.time()
     print('\n\n')
 
+    if cli_args.command_name == 'serve':
+        serve(cli_args.host, cli_args.port, cli_args.queue_size,
+              cli_args.batch_size, cli_args.batch_wait / 1000.0)
+        return
+
+    if cli_args.command_name == 'recode':
+        recode(cli_args.index, 'evts.' + cli_args.outputs, cli_args.workers)
+        print("Coding time:", time.time() - start_time)
+        print("Finished")
+        return
+
     paths = PETRglobals.TextFileList
     if cli_args.inputs:
         if os.path.isdir(cli_args.inputs):
-            if cli_args.inputs[-1] != '/':
-                paths = glob.glob(cli_args.inputs + '/*.xml')
-            else:
-                paths = glob.glob(cli_args.inputs + '*.xml')
+            paths = [path for path in glob.glob(os.path.join(cli_args.inputs, '*'))
+                     if path.endswith('.xml') or PETRreader.is_jsonl_input(path)]
         elif os.path.isfile(cli_args.inputs):
             paths = [cli_args.inputs]
         else:
@@ -460,14 +1113,73 @@ def main():
         run(paths, out, cli_args.parsed)
 
     else:
-        run(paths, out, True)  # <===
+        run(paths, out, True, workers=cli_args.workers,
+            stream=cli_args.stream, chunk_mb=cli_args.chunk_mb,
+            checkpoint=cli_args.checkpoint, resume=cli_args.resume,
+            index=cli_args.index)  # <===
 
     print("Coding time:", time.time() - start_time)
 
     print("Finished")
 
 
-def read_dictionaries(validation=False):
+def read_dictionaries(validation=False, rebuild_cache=False, bundle=None):
+    """
+    Reads the dictionaries named in the config into PETRglobals. If a cachefile_name is
+    configured, the dictionaries are loaded from the compiled cache when it matches the
+    current dictionary files and options; otherwise the text dictionaries are parsed and
+    the cache is (re)written. rebuild_cache forces the parse.
+
+    If bundle is given, everything is read from that file -- see compile_dictionaries()
+    -- and the text dictionaries are not needed at all.
+    """
+    logger = logging.getLogger('petr_log')
+    if bundle:
+        manifest = PETRreader.read_dictionary_cache(bundle)
+        if not manifest:
+            print("\aError: Could not read the dictionary bundle:", bundle)
+            print("Terminating program")
+            sys.exit()
+        print('Dictionary bundle:', bundle, manifest.get('created', ''))
+        for label, name, digest in manifest['sources']:
+            print('   {:<9}{}  [{}]'.format(label, name, digest[:12]))
+        if manifest['options'] != PETRreader.dictionary_options():
+            print('Warning: bundle was compiled with', manifest['options'])
+            logger.warning('Dictionary bundle compiled with options {}'.format(
+                manifest['options']))
+        logger.info('Dictionaries loaded from bundle ' + bundle)
+        PETRglobals.DictVersion = manifest['key']
+        return
+
+    cache_path = ''
+    if PETRglobals.DictCacheFileName:
+        cache_path = utilities._get_data('data/dictionaries',
+                                         PETRglobals.DictCacheFileName)
+        try:
+            manifest = PETRreader.make_dictionary_manifest(
+                PETRreader.get_dictionary_paths())
+        except IOError:
+            cache_path = ''  # a dictionary is missing: let the readers report it
+        if cache_path and not rebuild_cache:
+            t1 = time.time()
+            if PETRreader.read_dictionary_cache(cache_path, manifest):
+                print('Dictionaries loaded from cache:', cache_path,
+                      '({:.2f} s)'.format(time.time() - t1))
+                logger.info('Dictionaries loaded from cache')
+                PETRglobals.DictVersion = manifest['key']
+                return
+
+    parse_dictionaries()
+
+    if cache_path:
+        PETRglobals.DictVersion = manifest['key']
+        if PETRreader.write_dictionary_cache(cache_path, manifest):
+            print('Dictionary cache written:', cache_path)
+
+
+def parse_dictionaries():
+    """ Parses the text dictionaries named in the config into PETRglobals. """
+    PETRreader.reset_dictionaries()
 
     print('Verb dictionary:', PETRglobals.VerbFileName)
     verb_path = utilities._get_data(
@@ -479,30 +1191,68 @@ def read_dictionaries(validation=False):
     for actdict in PETRglobals.ActorFileList:
         actor_path = utilities._get_data('data/dictionaries', actdict)
         PETRreader.read_actor_dictionary(actor_path)
+    PETRreader.compile_actor_dictionary()
 
     print('Agent dictionary:', PETRglobals.AgentFileName)
     agent_path = utilities._get_data('data/dictionaries',
                                      PETRglobals.AgentFileName)
     PETRreader.read_agent_dictionary(agent_path)
+    PETRreader.compile_agent_dictionary()
 
     print('Discard dictionary:', PETRglobals.DiscardFileName)
     discard_path = utilities._get_data('data/dictionaries',
                                        PETRglobals.DiscardFileName)
     PETRreader.read_discard_list(discard_path)
+    PETRreader.compile_discard_list()
 
     if PETRglobals.IssueFileName != "":
         print('Issues dictionary:', PETRglobals.IssueFileName)
         issue_path = utilities._get_data('data/dictionaries',
                                          PETRglobals.IssueFileName)
         PETRreader.read_issue_list(issue_path)
+        PETRreader.compile_issue_list()
 
 
-def run(filepaths, out_file, s_parsed):
+def compile_dictionaries(bundle_path):
+    """
+    Parses the dictionaries named in the config and writes them to bundle_path as a
+    single file: the actor, agent and verb trees (with the synsets already expanded into
+    the verb patterns), the verb transformations, the discard and issue tables, and a
+    manifest of the source files' hashes and the options used. Workers can then start
+    from the bundle alone using read_dictionaries(bundle=bundle_path).
+    """
+    parse_dictionaries()
+    manifest = PETRreader.make_dictionary_manifest(
+        PETRreader.get_dictionary_paths())
+    manifest['created'] = time.asctime()
+    if not PETRreader.write_dictionary_cache(bundle_path, manifest):
+        print("\aError: Could not write the dictionary bundle:", bundle_path)
+        print("Terminating program")
+        sys.exit()
+    print('Dictionary bundle written:', bundle_path)
+
+
+def run(filepaths, out_file, s_parsed, workers=1, stream=False, chunk_mb=0,
+        checkpoint=False, resume=False, index=None):
     # this is the routine called from main()
-    events = PETRreader.read_xml_input(filepaths, s_parsed)
+    if s_parsed and not (PETRglobals.NullVerbs or PETRglobals.NullActors):
+        if index:
+            run_indexed(filepaths, 'evts.' + out_file, index, workers)
+            return
+        if checkpoint or resume:
+            run_checkpointed(filepaths, 'evts.' + out_file, workers, resume=resume)
+            return
+        if chunk_mb and workers > 1 and not any(
+                PETRreader.is_jsonl_input(path) for path in filepaths):
+            code_xml_ranges(filepaths, 'evts.' + out_file, workers, chunk_mb << 20)
+            return
+        if stream:
+            run_stream(filepaths, 'evts.' + out_file, workers)
+            return
+    events = PETRreader.read_input(filepaths, s_parsed)
     if not s_parsed:
         events = utilities.stanford_parse(events)
-    updated_events = do_coding(events)
+    updated_events = do_coding(events, workers)
     if PETRglobals.NullVerbs:
         PETRwriter.write_nullverbs(updated_events, 'nullverbs.' + out_file)
     elif PETRglobals.NullActors:
@@ -511,8 +1261,210 @@ def run(filepaths, out_file, s_parsed):
         PETRwriter.write_events(updated_events, 'evts.' + out_file)
 
 
+def run_stream(filepaths, out_file, workers=1, window=None):
+    """
+    Streaming version of run() for parsed input: the stories are read from the XML
+    or JSON-lines files, coded and written to out_file one at a time, in input order, and the
+    events appear in out_file as they are coded. Memory is bounded by window --
+    PETRglobals.StreamWindow by default -- rather than by the input: the reader holds
+    up to window stories while putting their sentences together, and up to about
+    window more are being coded. Returns the number of events written.
+    """
+    window = window or PETRglobals.StreamWindow
+    stories = PETRreader.iter_input_stories(filepaths, True, window)
+    return PETRwriter.write_events_stream(
+        iter_coding(stories, workers, window), out_file)
+
+
+def run_checkpointed(filepaths, out_file, workers=1, window=None, resume=False):
+    """
+    Version of run_stream() that can be picked up again after a crash. Every
+    PETRglobals.CheckpointStories stories or PETRglobals.CheckpointSeconds seconds,
+    whichever comes first, out_file is flushed to disk and a line is appended to the
+    manifest out_file + '.checkpoint' giving the StoryIDs coded since the last one,
+    how many stories of each input file are done, and the size of out_file.
+
+    With resume, the stories coded by the last checkpoint are skipped, out_file is
+    cut back to its size then -- dropping events of stories that were coded after
+    it and so will be coded again -- and the new events are appended. The skipped
+    stories are still read, since the XML has to be parsed to find where they end,
+    but are not coded. Returns the number of events written.
+    """
+    manifest = out_file + '.checkpoint'
+    state = read_checkpoint(manifest) if resume else None
+    mode = 'w'
+    if state and os.path.exists(out_file):
+        mode = 'a'
+        window = state['window']
+        with open(out_file, 'r+b') as fout:
+            fout.truncate(state['output_bytes'])
+        print('Resuming from checkpoint {}: {} stories already coded'.format(
+            manifest, sum(state['offsets'].values())))
+    else:
+        window = window or PETRglobals.StreamWindow
+        state = {'window': window, 'offsets': {}, 'complete': [],
+                 'output_bytes': 0}
+        open(manifest, 'w').close()
+    offsets = state['offsets']
+    complete = state['complete']
+    positions = deque()
+
+    def read_stories():
+        for path in filepaths:
+            if path in complete:
+                continue
+            done = offsets.get(path, 0)
+            stories = PETRreader.iter_input_stories([path], True, window)
+            for index, story in enumerate(stories, 1):
+                if index > done:
+                    positions.append((path, index))
+                    yield story
+            positions.append((path, None))
+
+    coded_ids = []
+    last = [time.time()]
+
+    def checkpoint(fout, key):
+        while positions[0][1] is None:  # the input files read up to this story
+            complete.append(positions.popleft()[0])
+        path, index = positions.popleft()
+        offsets[path] = index
+        coded_ids.append(key)
+        if ((PETRglobals.CheckpointStories and
+                len(coded_ids) >= PETRglobals.CheckpointStories) or
+                (PETRglobals.CheckpointSeconds and
+                 time.time() - last[0] >= PETRglobals.CheckpointSeconds)):
+            write_checkpoint(manifest, fout, state, coded_ids)
+            del coded_ids[:]
+            last[0] = time.time()
+
+    count = PETRwriter.write_events_stream(
+        iter_coding(read_stories(), workers, window), out_file, mode, checkpoint)
+    while positions:
+        complete.append(positions.popleft()[0])
+    with open(out_file, 'rb') as fout:
+        write_checkpoint(manifest, fout, state, coded_ids)
+    return count
+
+
+def run_indexed(filepaths, out_file, index_path, workers=1, window=None):
+    """
+    Version of run_stream() that also keeps the stories, as read and as coded, in the
+    PETRindex.CodedStore index_path, with the word index and dictionary signatures
+    that recode() needs. Any earlier contents of index_path are replaced. Returns the
+    number of events written.
+    """
+    window = window or PETRglobals.StreamWindow
+    store = PETRindex.CodedStore(index_path)
+    store.clear()
+    raw = deque()  # the stories as read, in the order iter_coding() returns them
+
+    def read_stories():
+        for key, story in PETRreader.iter_input_stories(filepaths, True, window):
+            raw.append(pickle.dumps(story, 2))
+            yield key, story
+
+    def store_stories(stories):
+        for key, story in stories:
+            store.add(key, raw.popleft(), story)
+            yield key, story
+
+    try:
+        count = PETRwriter.write_events_stream(
+            store_stories(iter_coding(read_stories(), workers, window)), out_file)
+        store.set_signatures(PETRindex.dictionary_signatures())
+    finally:
+        store.close()
+    return count
+
+
+def recode(index_path, out_file, workers=1):
+    """
+    Incremental re-coding after dictionary edits: codes again only the stories of the
+    CodedStore index_path, written by run_indexed(), that contain a word whose
+    dictionary entries differ from those the store was coded with, then writes the
+    events of every story in the store to out_file. Returns the number of events
+    written.
+    """
+    store = PETRindex.CodedStore(index_path)
+    try:
+        old = store.signatures()
+        new = PETRindex.dictionary_signatures()
+        words = PETRindex.changed_words(old, new)
+        if not old or PETRindex.ALL_WORDS in words:
+            seqs = store.all_stories()
+        else:
+            seqs = store.affected(words)
+        print('Dictionary words changed:', len(words),
+              '  Stories to re-code:', len(seqs), 'of', len(store.all_stories()))
+        stories = (store.story(seq) for seq in seqs)
+        for seq, (key, story) in zip(seqs, iter_coding(stories, workers)):
+            store.update(seq, story)
+        store.set_signatures(new)
+        store.commit()
+        return PETRwriter.write_events_stream(store.coded_stories(), out_file)
+    finally:
+        store.close()
+
+
+def write_checkpoint(manifest, fout, state, coded_ids):
+    """
+    Makes sure that what has been written to the open output file fout is on disk,
+    then appends a line to manifest recording it and the stories coded since the
+    last checkpoint.
+    """
+    fout.flush()
+    os.fsync(fout.fileno())
+    state['output_bytes'] = os.fstat(fout.fileno()).st_size
+    line = dict(state, stories=coded_ids,
+                time=datetime.datetime.now().isoformat())
+    with open(manifest, 'a+b') as fman:
+        fman.seek(0, os.SEEK_END)
+        if fman.tell():
+            fman.seek(-1, os.SEEK_END)
+            if fman.read(1) != b'\n':  # after a line cut short by a crash
+                fman.write(b'\n')
+        fman.write(json.dumps(line, sort_keys=True).encode('utf-8') + b'\n')
+        fman.flush()
+        os.fsync(fman.fileno())
+
+
+def read_checkpoint(manifest):
+    """
+    Returns the state recorded by the last complete line of the checkpoint manifest
+    -- the 'offsets', 'complete', 'output_bytes' and 'window' that run_checkpointed()
+    needs to resume -- or None if there is no checkpoint.
+    """
+    state = None
+    if os.path.exists(manifest):
+        with open(manifest) as fman:
+            for line in fman:
+                try:
+                    state = json.loads(line)
+                except ValueError:
+                    pass  # a line cut short by a crash
+    return state
+
+
+def serve(host='127.0.0.1', port=8765, queue_size=64, batch_size=64, batch_wait=0.0):
+    """
+    Runs a PETRserver.CodingServer on host:port until interrupted, coding with the
+    dictionaries already read. See PETRserver for the requests it accepts.
+    """
+    server = PETRserver.CodingServer((host, port), iter_coding, queue_size,
+                                     batch_size, batch_wait)
+    print('Serving on http://{}:{}/ (POST /code, GET /health)'.format(host, port))
+    logging.getLogger('petr_log').info('Serving on {}:{}'.format(host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
 def run_pipeline(data, out_file=None, config=None, write_output=True,
-                 parsed=False):
+                 parsed=False, dict_bundle=None, workers=1):
     # this is called externally
     utilities.init_logger('PETRARCH.log')
     logger = logging.getLogger('petr_log')
@@ -530,16 +1482,16 @@ def run_pipeline(data, out_file=None, config=None, write_output=True,
         PETRreader.parse_Config(utilities._get_data('data/config/',
                                                     'PETR_config.ini'))
 
-    read_dictionaries()
+    read_dictionaries(bundle=dict_bundle)
 
     logger.info('Hitting read events...')
     events = PETRreader.read_pipeline_input(data)
     if parsed:
         logger.info('Hitting do_coding')
-        updated_events = do_coding(events)
+        updated_events = do_coding(events, workers)
     else:
         events = utilities.stanford_parse(events)
-        updated_events = do_coding(events)
+        updated_events = do_coding(events, workers)
     if not write_output:
         output_events = PETRwriter.pipe_output(updated_events)
         return output_events
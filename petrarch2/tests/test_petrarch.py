@@ -1,6 +1,17 @@
-from petrarch2 import petrarch2, PETRglobals, PETRreader, utilities
+from petrarch2 import petrarch2, PETRglobals, PETRreader, PETRwriter, utilities
 from petrarch2 import PETRtree as ptree
+from petrarch2 import PETRcache, PETRserver, loadgen
 import sys
+import copy
+import time
+import gzip
+import threading
+import shutil
+import pytest
+import json
+import pickle
+import xml.etree.ElementTree as ET
+from collections import Counter
 
 
 config = petrarch2.utilities._get_data('data/config/', 'PETR_config.ini')
@@ -49,6 +60,629 @@ def test_actorDict_read():
     assert PETRglobals.ActorDict['KIRIBATI'] == actorDict6
 
 
+def test_dictionary_cache(tmpdir):
+    cache_path = str(tmpdir.join('test.cache'))
+    manifest = PETRreader.make_dictionary_manifest(
+        PETRreader.get_dictionary_paths())
+    actors = PETRglobals.ActorDict
+    assert PETRreader.write_dictionary_cache(cache_path, manifest)
+
+    assert PETRreader.read_dictionary_cache(cache_path, manifest)['key'] == manifest['key']
+    assert PETRglobals.ActorDict is not actors
+    assert PETRglobals.ActorDict['CROATIA'] == actors['CROATIA']
+
+    # a cache compiled from other files is ignored and the dictionaries are left alone
+    stale = dict(manifest, key='0' * 40)
+    actors = PETRglobals.ActorDict
+    assert PETRreader.read_dictionary_cache(cache_path, stale) is None
+    assert PETRglobals.ActorDict is actors
+
+
+def test_dictionary_image(tmpdir):
+    from petrarch2 import PETRtrie
+    cache_path = str(tmpdir.join('test.cache'))
+    manifest = PETRreader.make_dictionary_manifest(
+        PETRreader.get_dictionary_paths())
+    verbs = PETRglobals.VerbDict
+    actors = PETRglobals.ActorDict
+    PETRglobals.DictMapImage = True
+    try:
+        assert PETRreader.write_dictionary_cache(cache_path, manifest)
+        assert PETRreader.read_dictionary_cache(cache_path, manifest)
+        assert isinstance(PETRglobals.VerbDict, PETRtrie.MappedDict)
+        assert PETRglobals.VerbDict['verbs']['EXPLAIN'].to_dict() == \
+            verbs['verbs']['EXPLAIN']
+        # decoded entries, and misses, are kept after the first lookup
+        assert PETRglobals.VerbDict['verbs'] is PETRglobals.VerbDict['verbs']
+        assert 'NOT A VERB' not in PETRglobals.VerbDict['verbs']
+        assert PETRglobals.VerbDict['verbs'].get('NOT A VERB', 1) == 1
+        for protocol in [0, 2]:  # a mapped section pickles as a plain dict
+            assert pickle.loads(pickle.dumps(PETRglobals.VerbDict['verbs']['EXPLAIN'],
+                                             protocol)) == verbs['verbs']['EXPLAIN']
+        assert PETRglobals.ActorDict['CROATIA'] == actors['CROATIA']
+        assert PETRglobals.AgentDict.match(['REBELS'], 0, 0)[2] == '~REB'
+    finally:
+        PETRglobals.DictMapImage = False
+        PETRreader.read_dictionary_cache(cache_path, manifest)
+
+
+def test_dictionary_manifest_options():
+    paths = PETRreader.get_dictionary_paths()
+    key = PETRreader.make_dictionary_manifest(paths)['key']
+    PETRglobals.WriteActorRoot = not PETRglobals.WriteActorRoot
+    try:
+        assert PETRreader.make_dictionary_manifest(paths)['key'] != key
+    finally:
+        PETRglobals.WriteActorRoot = not PETRglobals.WriteActorRoot
+
+
+def test_dictionary_bundle(tmpdir):
+    bundle = str(tmpdir.join('test.bundle'))
+    petrarch2.compile_dictionaries(bundle)
+    PETRreader.reset_dictionaries()
+    assert "RUSSIA" not in PETRglobals.ActorDict
+
+    petrarch2.read_dictionaries(bundle=bundle)
+    assert "RUSSIA" in PETRglobals.ActorDict
+    assert PETRglobals.VerbDict['transformations']
+    assert petrarch2.get_issues('A humanitarian crisis') == {'HUMANITARIAN_CRISIS': 1}
+
+
+def test_actor_trie():
+    from petrarch2 import PETRtrie
+    nested = {'UNITED': {'NATIONS': {'#': [('IGOUNO', [])]},
+                         'STATES': {'#': [('USAGOV', ['<19900101']),
+                                          ('USA', ['>19900101'])]}},
+              'STATES': {'#': [('XXX', [])]}}
+    trie = PETRtrie.ActorTrie.from_dict(nested, PETRreader.actor_date_interval)
+    assert trie.to_dict() == nested
+    assert 'UNITED' in trie and 'NATIONS' not in trie
+
+    words = 'THE UNITED STATES ARMY'.split()
+    early = PETRreader.dstr_to_ordate('19800101')
+    late = PETRreader.dstr_to_ordate('20150101')
+    assert trie.match(words, 1, early)[1:] == (2, 'USAGOV')
+    assert trie.match(words, 1, late)[1:] == (2, 'USA')
+    assert trie.match(words, 2, late)[1:] == (1, 'XXX')
+    assert trie.match(words, 0, late) is None
+
+
+def test_actor_trie_dates():
+    from petrarch2 import PETRtrie
+    # overlapping restrictions: the first one that applies wins, as in check_date()
+    entries = [('OLD', ['<19900101']), ('MID', ['19850101', '19950101']),
+               ('NOW', [])]
+    trie = PETRtrie.ActorTrie.from_dict({'X': {'#': entries}},
+                                        PETRreader.actor_date_interval)
+    node = trie.child(0, 'X')
+    phrase = ptree.NounPhrase('NP', 0, None)
+    for date in ['19800101', '19891231', '19900101', '19941231', '19950101']:
+        phrase.date = PETRreader.dstr_to_ordate(date)
+        assert trie.resolve(node, phrase.date) == phrase.check_date(entries)
+    assert [trie.resolve(node, PETRreader.dstr_to_ordate(date)) for date in
+            ['19800101', '19900101', '19950101']] == ['OLD', 'MID', 'NOW']
+
+    # an unreadable restriction stops the search with the null code
+    poisoned = [('BAD', ['Consumer']), ('NOW', [])]
+    phrase.date = PETRreader.dstr_to_ordate('20150101')
+    assert phrase.check_date(poisoned) == ''
+    assert PETRreader.actor_date_interval(['Consumer'])[0] == PETRtrie.POISON
+
+
+def test_check_discards():
+    assert petrarch2.check_discards("Rebels attacked the capital") == [0, '']
+    # phrases at the end of the sentence and after a false start are found
+    assert petrarch2.check_discards("They watched baseball")[0] == 1
+    assert petrarch2.check_discards("The Asian Asian Cup began") == [1, '  ASIAN CUP']
+    # a story match anywhere wins over an earlier sentence match
+    assert petrarch2.check_discards(
+        "After the baseball game Andre Agassi spoke") == [2, '+  ANDRE AGASSI']
+
+
+def test_get_issues():
+    assert petrarch2.get_issues('Rebels attacked the capital') == {}
+    issues = petrarch2.get_issues(
+        'Refugees fled the humanitarian crisis as more refugees arrived')
+    assert issues == {'REFUGEES': 2, 'HUMANITARIAN_CRISIS': 1}
+    # an ignore phrase anywhere cancels all of the issues of the sentence
+    assert petrarch2.get_issues(
+        'Refugees got a head start') == {}
+    assert petrarch2.get_issues_batch(['A humanitarian crisis', 'Nothing']) == \
+        [{'HUMANITARIAN_CRISIS': 1}, {}]
+
+
+def test_sentence_tokens():
+    parse = "(S (NP (NNP U.S. ) ) (VP (VBD shelled ) (NP (NNS refugees ) ) ) (. . ) )".upper()
+    tokens = utilities.SentenceTokens("U.S. shelled  refugees.", parse)
+    assert tokens.words == ['U.S.', 'SHELLED', 'REFUGEES.']
+    assert tokens.segs == parse.split()
+    assert tokens.words[2] is utilities.SentenceTokens("Refugees.").words[0]
+    assert petrarch2.get_issues(tokens) == petrarch2.get_issues(tokens.text)
+    assert petrarch2.check_discards(tokens) == [0, '']
+    sentence = ptree.Sentence(parse, tokens.text, "081315", tokens)
+    assert sentence.txt == " U.S. SHELLED REFUGEES ."
+
+
+def test_tree_slots():
+    parse = utilities._format_parsed_str(
+        "(ROOT (S (NP (NNP Germany)) (VP (VBD arrested) (NP (NNP France)))))")
+    sentence = ptree.Sentence(parse, "Germany arrested France",
+                              PETRreader.dstr_to_ordate("20010101"))
+    events, meta = sentence.get_events()
+    assert events == [('DEU', 'FRA', '173')]
+    nodes = [sentence.tree]
+    for node in nodes:
+        nodes.extend(node.children)
+        assert not hasattr(node, '__dict__')
+    verb = sentence.verbs[0]
+    assert verb.memo & ptree._MEANING and verb.memo & ptree._PASSIVE
+    meaning = verb.meaning
+    assert verb.get_meaning() is meaning and not verb.check_passive()
+    assert sentence.get_events() == sentence.events
+
+
+def test_parse_tokens():
+    raw = "(ROOT\n  (S (NP (NNP Germany))\n    (VP (VBD arrested) (NP (NNP France)))))\n"
+    formatted = utilities._format_parsed_str(raw)
+    assert utilities.parse_tokens(raw) == formatted.split()
+    assert utilities.parse_tokens(formatted) == formatted.split()
+    assert utilities.parse_tokens("( (S (NP (NN x)) ) )") == \
+        utilities._format_parsed_str("( (S (NP (NN x)) ) )").split()
+    # a sentence read from the parse as the parser wrote it has the same tree
+    date = PETRreader.dstr_to_ordate("20010101")
+    sentence = ptree.Sentence(raw, "Germany arrested France", date)
+    assert sentence.tree.get_parse_string() == \
+        ptree.Sentence(formatted, "Germany arrested France", date).tree.get_parse_string()
+    assert sentence.get_events()[0] == [('DEU', 'FRA', '173')]
+
+
+def test_prefilter():
+    parse = "(S (NP (NNP OBAMA ) ) (VP (VBD SAID ) (SBAR (S (NP (PRP HE ) ) (VP (VBD WAS ) (ADJP (VBN TIRED ) ) ) ) ) ) ) "
+    assert petrarch2.check_prefilter(utilities.SentenceTokens("Obama said he was tired", parse))
+    # no verb from the verb dictionary
+    parse = "(S (NP (NNP OBAMA ) ) (VP (VBD FROWNED ) ) ) "
+    assert not petrarch2.check_prefilter(utilities.SentenceTokens("Obama frowned", parse))
+    # words of a phrase can match in any order, but all of them are needed
+    assert PETRglobals.ActorDict.has_phrase_in({'GUSTAF', 'XVI', 'CARL'})
+    assert not PETRglobals.ActorDict.has_phrase_in({'XVI'})
+
+
+def test_do_coding_workers():
+    events = PETRreader.read_xml_input([utilities._get_data(
+        'data/text', 'GigaWord.sample.PETR.xml')], True)
+    serial = petrarch2.do_coding(copy.deepcopy(events))
+    parallel = petrarch2.do_coding(copy.deepcopy(events), workers=2)
+    assert parallel == serial
+    assert sorted(parallel) == sorted(events)
+
+
+def test_coder(tmpdir):
+    with open(config) as fin:
+        text = fin.read()
+    plain = str(tmpdir.join('plain.ini'))
+    with open(plain, 'w') as fout:
+        fout.write(text.replace('write_actor_text = True', 'write_actor_text = False')
+                   .replace('write_event_text = True', 'write_event_text = False'))
+    parse = "(ROOT (S (NP (NNP Germany)) (VP (VBD arrested) (NP (NNP France)))))"
+
+    coder = petrarch2.Coder(plain)
+    assert PETRglobals.WriteActorText and PETRglobals.NewActorLength == 0
+    events, meta = coder.code_sentence(parse, 'Germany arrested France', '20010101')
+    assert events == [('DEU', 'FRA', '173')] and 'actortext' not in meta
+    events, meta = petrarch2.default_coder().code_sentence(
+        parse, 'Germany arrested France', '20010101')
+    assert events == [('DEU', 'FRA', '173')] and 'actortext' in meta
+    assert coder.stats['events'] == 1
+
+    # a sentence's config entries change the options of its coder only
+    story = {'sents': {'0': {'content': 'Germany arrested France',
+                             'parsed': utilities._format_parsed_str(parse),
+                             'config': {'0': {'option': 'new_actor_length',
+                                              'value': '5'}}}},
+             'meta': {'date': '20010101'}}
+    coder.code_story('test', story)
+    assert coder.state['NewActorLength'] == 5 and PETRglobals.NewActorLength == 0
+
+    copied = pickle.loads(pickle.dumps(coder, 2))
+    events = PETRreader.read_xml_input([utilities._get_data(
+        'data/text', 'GigaWord.sample.PETR.xml')], True)
+    coder.stats.clear()
+    serial = coder.do_coding(copy.deepcopy(events))
+    assert coder.stats['stories'] == len(events)
+    copied.stats.clear()
+    assert copied.do_coding(copy.deepcopy(events), workers=2) == serial
+    del copied.stats['code_time'], coder.stats['code_time']
+    assert copied.stats == coder.stats
+
+    # a spawned worker starts with empty PETRglobals and is sent the pickled coder
+    with petrarch2._globals_lock:
+        saved = petrarch2._global_state()
+        petrarch2._set_global_state(copy.deepcopy(petrarch2._initial_state))
+        try:
+            petrarch2._install_coder(pickle.loads(pickle.dumps(coder, 2)))
+            coded, _ = petrarch2._code_stories(sorted(copy.deepcopy(events).items()))
+        finally:
+            petrarch2._set_global_state(saved)
+    assert dict(coded) == serial
+    assert not any('actortext' in sent.get('meta', {})
+                   for story in serial.values() for sent in (story['sents'] or {}).values())
+
+
+def test_code_sentences():
+    records = list(dict((record['_id'], record) for record in loadgen.sample_records(
+        utilities._get_data('data/text', 'GigaWord.sample.PETR.xml'))).values())
+    stories = PETRreader.read_pipeline_input(records)
+    expected = PETRwriter.pipe_output(petrarch2.do_coding(stories))
+    coded = petrarch2.code_sentences(
+        (record['_id'], record['parsed_sents'][0], record['content'], record['date'])
+        for record in records)
+    assert next(coded)[0] == records[0]['_id']  # a generator, one record at a time
+    coded = dict(coded)
+    assert len(coded) == len(records) - 1
+    for key, events in coded.items():
+        if not stories[key]['sents']:
+            continue  # too short for the segmenter of the pipeline reader
+        assert sorted(event[:3] for event in events) == \
+            sorted(event[1:4] for event in expected.get(key, []))
+        assert all(event[3] is not None for event in events)  # issues are configured
+    assert coded['AFP0808020705_1'][0][3:] == (
+        'SECURITY_SERVICES,1',
+        ('court', 'Brazilian men', 'issued <{ARREST> <WARRANTS}>', '', ''))
+
+
+def test_code_sentences_null_verbs(monkeypatch):
+    record = ('0', "(ROOT (S (NP (NNP Germany)) (VP (VBD arrested) (NP (NNP France)))))",
+              'Germany arrested France', '20010101')
+    assert [event[:3] for event in dict(petrarch2.code_sentences([record]))['0']] == \
+        [('DEU', 'FRA', '173')]
+    monkeypatch.setattr(PETRglobals, 'NullVerbs', True)
+    monkeypatch.setattr(PETRglobals, 'PreFilter', True)
+    assert dict(petrarch2.code_sentences([record])) == {'0': []}
+
+
+def test_parsed_trees():
+    def preorder(tree, nodes):
+        if len(tree) == 2 and not isinstance(tree[1], list):
+            nodes.append([tree[0], tree[1]])
+        else:
+            nodes.append([tree[0], len(tree) - 1])
+            for child in tree[1:]:
+                preorder(child, nodes)
+        return nodes
+
+    parse = "(ROOT (S (NP (NNP Germany)) (VP (VBD arrested) (NP (NNP France)))))"
+    tree = utilities.parse_to_tree(parse)
+    assert tree == ['ROOT', ['S', ['NP', ['NNP', 'Germany']],
+                             ['VP', ['VBD', 'arrested'], ['NP', ['NNP', 'France']]]]]
+    assert utilities.tree_tokens(tree) == utilities.tree_tokens(preorder(tree, [])) == \
+        utilities.parse_tokens(parse)
+
+    records = list(dict((record['_id'], record) for record in loadgen.sample_records(
+        utilities._get_data('data/text', 'GigaWord.sample.PETR.xml'))).values())
+    expected = PETRwriter.pipe_output(
+        petrarch2.do_coding(PETRreader.read_pipeline_input(records)))
+    nested = [dict(record, parsed_trees=[utilities.parse_to_tree(record['parsed_sents'][0])])
+              for record in records]
+    flat = [dict(record, parsed_trees=[preorder(record['parsed_trees'][0], [])])
+            for record in nested]
+    for trees in [nested, flat]:
+        stories = PETRreader.read_pipeline_input(
+            [dict(record, parsed_sents=None) for record in trees])
+        assert PETRwriter.pipe_output(petrarch2.do_coding(stories)) == expected
+
+
+def test_stream_coding(tmpdir):
+    paths = [utilities._get_data('data/text', 'GigaWord.sample.PETR.xml')]
+    events = PETRreader.read_xml_input(paths, True)
+    assert dict(PETRreader.iter_xml_stories(paths, True, 8)) == events
+    batch = str(tmpdir.join('batch.txt'))
+    PETRwriter.write_events(petrarch2.do_coding(events), batch)
+    stream = str(tmpdir.join('stream.txt'))
+    count = petrarch2.run_stream(paths, stream, window=4)
+    with open(batch) as fin:
+        expected = sorted(fin)
+    with open(stream) as fin:
+        assert sorted(fin) == expected
+    assert count == len(expected)
+
+
+def test_stream_window_split(caplog):
+    records = [(key, {'sents': {n: {}}, 'meta': {}})
+               for n, key in enumerate(['A', 'B', 'C', 'A'])]
+    stories = list(PETRreader._group_stories(iter(records), 3))
+    assert [key for key, _ in stories] == ['B', 'C', 'A']
+    assert not caplog.records
+    stories = list(PETRreader._group_stories(iter(records), 2))
+    assert [key for key, _ in stories] == ['A', 'B', 'C', 'A']
+    assert 'Story A has sentences too far apart' in caplog.text
+
+
+def test_checkpoint_resume(tmpdir, monkeypatch):
+    sample = utilities._get_data('data/text', 'GigaWord.sample.PETR.xml')
+    paths = [str(tmpdir.join('first.xml')), str(tmpdir.join('second.xml'))]
+    for path in paths:
+        shutil.copy(sample, path)
+    expected = str(tmpdir.join('expected.txt'))
+    petrarch2.run_stream(paths, expected)
+
+    out_file = str(tmpdir.join('evts.txt'))
+    code_story = petrarch2.code_story
+    calls = Counter()
+
+    def crashing_code_story(key, story, stats):
+        calls['stories'] += 1
+        if calls['stories'] == 51:
+            raise RuntimeError('crash')
+        return code_story(key, story, stats)
+    monkeypatch.setattr(PETRglobals, 'CheckpointStories', 8)
+    monkeypatch.setattr(petrarch2, 'code_story', crashing_code_story)
+    with pytest.raises(RuntimeError):
+        petrarch2.run_checkpointed(paths, out_file)
+    state = petrarch2.read_checkpoint(out_file + '.checkpoint')
+    assert state['complete'] == paths[:1]
+    assert sum(state['offsets'].values()) == 48
+    with open(out_file + '.checkpoint', 'a') as fman:
+        fman.write('{"offsets": ')  # cut short by the crash
+
+    monkeypatch.setattr(petrarch2, 'code_story', code_story)
+    petrarch2.run_checkpointed(paths, out_file, resume=True)
+    with open(expected) as fin:
+        expected = fin.read()
+    with open(out_file) as fin:
+        assert fin.read() == expected
+    assert petrarch2.read_checkpoint(out_file + '.checkpoint')['complete'] == paths
+
+
+def test_result_cache(tmpdir, monkeypatch):
+    paths = [utilities._get_data('data/text', 'GigaWord.sample.PETR.xml')]
+    expected = str(tmpdir.join('expected.txt'))
+    PETRwriter.write_events(petrarch2.do_coding(
+        PETRreader.read_xml_input(paths, True)), expected)
+    with open(expected) as fin:
+        expected = fin.read()
+
+    monkeypatch.setattr(PETRglobals, 'ResultCacheFileName',
+                        str(tmpdir.join('results.sqlite')))
+    summaries = []
+    monkeypatch.setattr(petrarch2, 'print_summary',
+                        lambda stats, *args: summaries.append(stats))
+    for name in ['miss.txt', 'hit.txt']:
+        out_file = str(tmpdir.join(name))
+        PETRwriter.write_events(petrarch2.do_coding(
+            PETRreader.read_xml_input(paths, True)), out_file)
+        with open(out_file) as fin:
+            assert fin.read() == expected
+    first, second = summaries
+    assert first['cache_misses'] > 50
+    assert second['cache_hits'] == first['cache_hits'] + first['cache_misses']
+    assert second['cache_misses'] == 0
+
+    cache = PETRcache.result_cache()
+    parse = list(PETRreader.read_xml_input(paths, True).values())[0]['sents']
+    parse = list(parse.values())[0]['parsed']
+    bounds = cache.bounds
+    date = bounds[len(bounds) // 2]
+    assert cache.key(parse, date) == cache.key(parse, date + 1)
+    assert cache.key(parse, date) != cache.key(parse, date - 1)
+    assert cache.key(parse, date) == cache.key(utilities.parse_tokens(parse), date)
+
+
+def test_incremental_recode(tmpdir, monkeypatch):
+    paths = [utilities._get_data('data/text', 'GigaWord.sample.PETR.xml')]
+    index = str(tmpdir.join('index.sqlite'))
+    out_file = str(tmpdir.join('indexed.txt'))
+    expected = str(tmpdir.join('expected.txt'))
+    petrarch2.run_indexed(paths, out_file, index)
+    petrarch2.run_stream(paths, expected)
+    with open(expected) as fin, open(out_file) as fout:
+        assert fout.read() == fin.read()
+
+    recoded = []
+    iter_coding = petrarch2.iter_coding
+
+    def counting_iter_coding(stories, *args):
+        for key, story in iter_coding(stories, *args):
+            recoded.append(key)
+            yield key, story
+    monkeypatch.setattr(petrarch2, 'iter_coding', counting_iter_coding)
+    petrarch2.recode(index, out_file)
+    assert recoded == []
+
+    actors = PETRglobals.ActorDict.to_dict()
+    actors['BEIJING']['#'] = [('TWN', [])]
+    monkeypatch.setattr(PETRglobals, 'ActorDict', actors)
+    PETRreader.compile_actor_dictionary()
+    petrarch2.recode(index, out_file)
+    assert 0 < len(recoded) < 10
+    monkeypatch.setattr(petrarch2, 'iter_coding', iter_coding)
+    petrarch2.run_stream(paths, expected)
+    with open(expected) as fin, open(out_file) as fout:
+        expected = fin.read()
+        assert fout.read() == expected
+    assert 'TWN' in expected
+
+
+def test_coding_server(capsys):
+    records = loadgen.sample_records(
+        utilities._get_data('data/text', 'GigaWord.sample.PETR.xml'))[:20]
+    expected = PETRwriter.pipe_output(
+        petrarch2.do_coding(PETRreader.read_pipeline_input(records)))
+    capsys.readouterr()
+    server = PETRserver.CodingServer(('127.0.0.1', 0), petrarch2.iter_coding,
+                                     queue_size=4, batch_size=8)
+    threading.Thread(target=server.serve_forever).start()
+    url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    try:
+        print('serving')
+        replies = {}
+        posts = [threading.Thread(target=lambda n: replies.update(
+            loadgen.post(url, records[n:n + 5])), args=(n,)) for n in range(0, 20, 5)]
+        for thread in posts:
+            thread.start()
+        for thread in posts:
+            thread.join()
+        assert replies == json.loads(json.dumps(expected))
+        assert loadgen.post(url, {'records': records[:1]}) == \
+            json.loads(json.dumps(dict((key, expected[key])
+                                       for key in [records[0]['_id']])))
+        with pytest.raises(loadgen.HTTPError) as e:
+            loadgen.post(url, [{'content': 'no id'}])
+        assert e.value.code == 400
+        health = loadgen.health(url)
+        assert health['stories'] == 21 and health['rejected'] == 0
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert not server.coder.is_alive() and not PETRglobals.Quiet
+    # the coder's progress is not printed, and the rest of the output is untouched
+    out = capsys.readouterr()[0]
+    assert 'serving' in out and 'Processing story' not in out
+
+    # a coder that gives up fails its own request, and the server carries on
+    def exiting(stories):
+        if records[0]['_id'] in dict(stories):
+            sys.exit()
+        return petrarch2.iter_coding(stories)
+    server = PETRserver.CodingServer(('127.0.0.1', 0), exiting)
+    threading.Thread(target=server.serve_forever).start()
+    url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    try:
+        with pytest.raises(loadgen.HTTPError) as e:
+            loadgen.post(url, records[:1])
+        assert e.value.code == 500
+        assert loadgen.post(url, records[1:2]) == json.loads(json.dumps(
+            dict((key, expected[key]) for key in [records[1]['_id']])))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    # a full queue turns requests away
+    release = threading.Event()
+
+    def blocked(stories):
+        release.wait()
+        return stories
+    server = PETRserver.CodingServer(('127.0.0.1', 0), blocked, queue_size=1)
+    threading.Thread(target=server.serve_forever).start()
+    url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    try:
+        waiting = []
+        for queued in [0, 1]:  # one request being coded, then one waiting
+            waiting.append(threading.Thread(target=loadgen.post, args=(url, records[:1])))
+            waiting[-1].start()
+            while (server.counts['requests'] < len(waiting) or
+                   server.jobs.qsize() != queued):
+                time.sleep(0.01)
+        with pytest.raises(loadgen.HTTPError) as e:
+            loadgen.post(url, records[:1])
+        assert e.value.code == 503 and e.value.headers['Retry-After'] == '1'
+        release.set()
+        for thread in waiting:
+            thread.join()
+        assert loadgen.health(url)['rejected'] == 1
+    finally:
+        release.set()
+        server.shutdown()
+        server.server_close()
+
+
+def test_read_xml_input_backends(monkeypatch):
+    paths = [utilities._get_data('data/text', 'PETR.UnitTest.records.xml')]
+    events = PETRreader.read_xml_input(paths, True)
+    assert len(events) == 282
+    monkeypatch.setattr(PETRreader, 'lxml_etree', None)
+    assert PETRreader.read_xml_input(paths, True) == events
+
+
+def test_sentence_segmenter(monkeypatch):
+    filler = 'the talks on the border dispute went on for most of the week '
+    sents = ['Yesterday Mr. Smith said (as he had. Before) that ' + filler + 'in Geneva. ',
+             '"The government will not agree. No one will" said J. Doe after ' +
+             filler + 'ended. ',
+             'Too short. ',
+             'The foreign minister of Kenya met ' + filler + 'in Nairobi.']
+    paragr = ''.join(sents)
+    assert list(PETRreader._sentence_segmenter(paragr)) == [sents[0], sents[1],
+                                                           sents[3]]
+    monkeypatch.setattr(PETRglobals, 'MaxSentences', 2)
+    assert PETRreader.story_sentences(' '.join([paragr] * 3)) == sents[:2]
+    monkeypatch.setattr(PETRglobals, 'MaxSentences', 0)
+    assert len(PETRreader.story_sentences(' '.join([paragr] * 3))) == 9
+
+
+def test_read_jsonl_input(tmpdir):
+    path = utilities._get_data('data/text', 'GigaWord.sample.PETR.xml')
+    entries = []
+    for sent in ET.parse(path).getroot().iter('Sentence'):
+        if (len(list(PETRreader._sentence_segmenter(sent.find('Text').text))) > 1 or
+                sent.get('id') in [entry['_id'] for entry in entries]):
+            continue  # one parse per story, so keep the one-sentence ones
+        entries.append({'_id': sent.get('id'), 'date': sent.get('date'),
+                        'date_added': '', 'source': sent.get('source'),
+                        'title': '', 'url': '',
+                        'content': sent.find('Text').text.strip(),
+                        'parsed_sents': [sent.find('Parse').text]})
+    expected = PETRreader.read_pipeline_input(entries)
+    for entry in entries[::2]:
+        entry['_id'] = {'$oid': entry['_id']}
+        entry['date'] = {'$date': entry['date'][:4] + '-' + entry['date'][4:6] +
+                         '-' + entry['date'][6:] + 'T00:00:00Z'}
+
+    paths = [str(tmpdir.join('stories.jsonl')), str(tmpdir.join('more.jsonl.gz'))]
+    with open(paths[0], 'w') as fout:
+        fout.writelines(json.dumps(entry) + '\n' for entry in entries[:10])
+    fout = gzip.open(paths[1], 'wb')
+    fout.writelines(json.dumps(entry) + '\n' for entry in entries[10:])
+    fout.close()
+    assert all(PETRreader.is_jsonl_input(path) for path in paths)
+    assert not PETRreader.is_jsonl_input(str(tmpdir.join('stories.json')))
+    assert PETRreader.read_jsonl_input(paths) == expected
+    assert PETRreader.read_input(paths, True) == expected
+
+    batch = str(tmpdir.join('batch.txt'))
+    PETRwriter.write_events(petrarch2.do_coding(expected), batch)
+    stream = str(tmpdir.join('stream.txt'))
+    petrarch2.run_stream(paths, stream)
+    with open(batch) as fin:
+        expected = sorted(fin)
+    with open(stream) as fin:
+        assert sorted(fin) == expected
+
+
+def test_xml_byte_ranges(tmpdir):
+    path = utilities._get_data('data/text', 'PETR.UnitTest.records.xml')
+    ranges = PETRreader.xml_byte_ranges(path, 5000)
+    assert len(ranges) > 10
+    assert all(end == start for (_, end), (start, _) in zip(ranges, ranges[1:]))
+    stories = [story for start, end in ranges
+               for story in PETRreader.iter_xml_range(path, start, end, True)]
+    assert stories == list(PETRreader.iter_xml_stories([path], True))
+
+    path = utilities._get_data('data/text', 'GigaWord.sample.PETR.xml')
+    batch = str(tmpdir.join('batch.txt'))
+    PETRwriter.write_events(petrarch2.do_coding(
+        PETRreader.read_xml_input([path], True)), batch)
+    chunked = str(tmpdir.join('chunked.txt'))
+    count = petrarch2.code_xml_ranges([path], chunked, workers=2, chunk_bytes=5000)
+    with open(batch) as fin:
+        expected = sorted(fin)
+    with open(chunked) as fin:
+        assert sorted(fin) == expected
+    assert count == len(expected)
+
+
+def test_xml_byte_ranges_split(tmpdir, caplog):
+    with open(utilities._get_data('data/text', 'GigaWord.sample.PETR.xml')) as fin:
+        text = fin.read()
+    first = text[text.index('<Sentence '):text.index('</Sentence>') + 11]
+    split = str(tmpdir.join('split.xml'))
+    with open(split, 'w') as fout:  # the first story again at the end of the file
+        fout.write(text.replace('</Sentences>', first.replace('_4"', '_5"') +
+                                '\n</Sentences>'))
+    petrarch2.code_xml_ranges([split], str(tmpdir.join('evts.txt')), workers=2,
+                              chunk_bytes=5000)
+    assert 'Story AFP0808020625 has sentences in more than one range' in caplog.text
+
 ###################################
 #
 #           Unit tests
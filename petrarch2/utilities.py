@@ -29,6 +29,7 @@
 # REVISION HISTORY:
 #    Summer-14:	 Initial version
 #    April 2016: added extract_phrases()
+#    SentenceTokens: the per-sentence word buffer shared by the coding stages
 
 # pas 16.04.22: print() statements commented-out with '# --' were used in the debugging and can probably be removed
 # ------------------------------------------------------------------------
@@ -38,6 +39,8 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import os
+import re
+import numbers
 import logging
 #import corenlp
 import dateutil.parser
@@ -103,7 +106,67 @@ def parse_to_text(parse):
     return r
 
 
-def extract_phrases(sent_dict, sent_id):
+_token_pool = {}
+_TokenPoolSize = 200000  # the pool is emptied when it grows past this many words
+
+
+def intern_token(word):
+    """ Returns the pooled copy of word, so that every occurrence of a word shares one string """
+    try:
+        return _token_pool[word]
+    except KeyError:
+        if len(_token_pool) >= _TokenPoolSize:
+            _token_pool.clear()
+        _token_pool[word] = word
+        return word
+
+
+class SentenceTokens(object):
+    """
+    The upper-case words of one sentence. do_coding() makes one of these for each
+    sentence and passes it to check_discards(), PETRtree.Sentence, extract_phrases()
+    and get_issues(), so the text is upper-cased and split once rather than once per
+    stage.
+
+    text:    the sentence text
+    upper:   text.upper()
+    words:   the pooled words of upper, split on white space
+    parse:   the formatted parse, its list of elements -- see tree_tokens() -- or None
+    segs:    the white-space separated elements of parse, as read by
+             PETRtree.Sentence.str_to_tree(); given instead of parse by a caller
+             that read them from the unformatted parse with parse_tokens(), and
+             otherwise split from parse the first time they are used
+    """
+
+    __slots__ = ('text', 'upper', 'words', 'parse', '_segs')
+
+    def __init__(self, text, parse=None, segs=None):
+        self.text = text
+        self.upper = text.upper()
+        self.words = [intern_token(word) for word in self.upper.split()]
+        self.parse = parse
+        if segs is None and isinstance(parse, list):
+            segs = parse
+        self._segs = segs
+
+    def __len__(self):
+        return len(self.words)
+
+    @property
+    def segs(self):
+        if self._segs is None:
+            self._segs = self.parse.split() if self.parse else []
+        return self._segs
+
+
+def sentence_words(sentence):
+    """ The upper-case words of sentence, which is either a SentenceTokens or a string """
+    if isinstance(sentence, SentenceTokens):
+        return sentence.words
+    return sentence.upper().split()
+
+
+def extract_phrases(sent_dict, sent_id, tokens=None):
     """
     Text extraction for PETRglobals.WriteActorText and PETRglobals.WriteEventText
 
@@ -116,6 +179,9 @@ def extract_phrases(sent_dict, sent_id):
     story_id: String.
                 Unique StoryID in standard PETRARCH format.
 
+    tokens: SentenceTokens.
+                The sentence's tokens from do_coding(), if it has them.
+
     Returns
     -------
 
@@ -247,7 +313,7 @@ def extract_phrases(sent_dict, sent_id):
     """print('EP1:',sent_dict['content']) # --
     print('EP2:',sent_dict['meta'])  # -- """
     content = sent_dict['content']
-    ucont = sent_dict['content'].upper()
+    ucont = tokens.upper if tokens is not None else content.upper()
     keylist = list(sent_dict['meta'].keys())
     if len(keylist) < 2:
         logger.info('ut.EP {} len(keylist) < 2 {}'.format(sent_id, keylist))
@@ -314,11 +380,8 @@ def story_filter(story_dict, story_id):
                     event_tuple = tuple(alist)
                     filtered[event_tuple]
                     if 'issues' in sent_dict:
-                        filtered[event_tuple]['issues'] = Counter()
-                        issues = sent_dict['issues']
-                        for issue in issues:
-                            filtered[event_tuple]['issues'][
-                                issue[0]] += issue[1]
+                        filtered[event_tuple]['issues'] = Counter(
+                            sent_dict['issues'])
 
                     # Will keep track of this info, but not necessarily write
                     # it out
@@ -346,17 +409,133 @@ def story_filter(story_dict, story_id):
     return filtered
 
 
+_nested_parse_re = re.compile(r'.\s*\(', re.DOTALL | re.UNICODE)
+
+
+def _unwrap_parse(parsed_str):
+    # the parse inside a (ROOT ...) or ( ... ) wrapper: parsed_str is stripped
+    if parsed_str.startswith("(ROOT") and parsed_str.endswith(")"):
+        return parsed_str[5:-1]
+    elif _nested_parse_re.match(parsed_str):
+        return parsed_str[1:-1]
+    return parsed_str
+
+
+def parse_tokens(parsed_str):
+    """
+    The elements of a CoreNLP parse as PETRtree.Sentence reads them -- the same list
+    as _format_parsed_str(parsed_str).split() -- without making the formatted string
+    line by line: the (ROOT ...) wrapper is removed, the parse is upper-cased, and
+    every ")" is an element of its own. A parse already formatted by
+    _format_parsed_str() gives the same elements again, and a parse given as a tree
+    structure is read by tree_tokens().
+    """
+    if isinstance(parsed_str, (list, tuple)):
+        return tree_tokens(parsed_str)
+    return _unwrap_parse(parsed_str.strip()).upper().replace(')', ' ) ').split()
+
+
+def _nested_items(tree, items):
+    items.append('(' + tree[0])
+    for child in tree[1:]:
+        if isinstance(child, (list, tuple)):
+            _nested_items(child, items)
+        else:
+            items.append(child)
+    items.append(')')
+
+
+def tree_tokens(tree):
+    """
+    The elements of a parse given as a structure rather than a string: the same list
+    parse_tokens() reads from the Penn Treebank string of the tree, made without
+    writing that string. tree is one of
+
+        nested lists   [label, child, ...] where a child is a word or another such
+                       list: ["S", ["NP", ["NNP", "Germany"]], ["VP", ...]]
+        preorder       the nodes in preorder as [label, n] for a phrase of n children
+                       and [label, word] for a word: [["S", 2], ["NP", 1],
+                       ["NNP", "Germany"], ["VP", 2], ...]
+        elements       a list already read by parse_tokens(), which is returned
+
+    As for a string, the tree inside a ROOT node, or inside a node with an empty
+    label, is used. The labels and words are upper-cased and split at ")" and white
+    space in a single pass over their joined text, as parse_tokens() does.
+    """
+    items = []
+    if not tree or isinstance(tree[0], (list, tuple)):
+        remaining = []  # the nodes still to come of each open phrase
+        for label, value in tree:
+            items.append('(' + label)
+            if isinstance(value, numbers.Integral):
+                if value > 0:
+                    remaining.append(value)
+                    continue
+            else:
+                items.append(value)
+            items.append(')')
+            while remaining:
+                remaining[-1] -= 1
+                if remaining[-1]:
+                    break
+                remaining.pop()
+                items.append(')')
+        label = tree[0][0] if tree else None
+    elif tree[0].startswith('('):
+        return tree
+    else:
+        _nested_items(tree, items)
+        label = tree[0]
+    elements = ' '.join(items).upper().replace(')', ' ) ').split()
+    if label == 'ROOT' or (len(elements) > 1 and elements[0] == '(' and
+                           elements[1].startswith('(')):
+        return elements[1:-1]
+    return elements
+
+
+def parse_to_tree(parse):
+    """
+    The nested lists [label, child, ...] of a Penn Treebank parse string, with the
+    labels and words as they are written; see tree_tokens(). As in
+    PETRtree.Sentence, reading stops at a ")" with no open bracket, and brackets left
+    open at the end are closed.
+    """
+    stack = [[None]]
+    for element in parse.replace('(', ' ( ').replace(')', ' ) ').split() + \
+            [')'] * parse.count('('):
+        if element == '(':
+            if stack[-1][0] is None:
+                stack[-1][0] = ''
+            stack.append([None])
+        elif element == ')':
+            if len(stack) == 1:
+                break
+            node = stack.pop()
+            if node[0] is None:
+                node[0] = ''
+            stack[-1].append(node)
+        elif stack[-1][0] is None:
+            stack[-1][0] = element
+        else:
+            stack[-1].append(element)
+    return stack[0][1]
+
+
+def format_parse(parse):
+    """
+    The 'parsed' entry of a sentence dictionary for parse: the formatted string of a
+    parse string, or the list of elements of a parse given as a tree structure.
+    """
+    if isinstance(parse, (list, tuple)):
+        return tree_tokens(parse)
+    return _format_parsed_str(parse)
+
+
 def _format_parsed_str(parsed_str):
-    if parsed_str.strip().startswith("(ROOT") and parsed_str.strip().endswith(")"):
-        parsed_str = parsed_str.strip()[5:-1].strip()
-    elif parsed_str.strip()[1:].strip().startswith("("):
-        parsed_str = parsed_str.strip()[1:-1]
-    parsed = parsed_str.split('\n')
-    parsed = [line.strip() + ' ' for line in [line1.strip() for line1 in
-                                              parsed if line1] if line]
-    parsed = [line.replace(')', ' ) ').upper() for line in parsed]
-    treestr = ''.join(parsed)
-    return treestr
+    lines = [line for line in
+             [line.strip() for line in _unwrap_parse(parsed_str.strip()).split('\n')]
+             if line]
+    return (' '.join(lines) + ' ' if lines else '').replace(')', ' ) ').upper()
 
 
 def _format_datestr(date):
@@ -6,6 +6,7 @@ with open('requirements.txt', 'r') as f:
 setup(
     name='petrarch2',
     install_requires=required,
+    extras_require={'lxml': ['lxml']},  # faster reading of the XML input
     entry_points={
         'console_scripts': ['petrarch2 = petrarch2.petrarch2:main']},
     version='1.0.0',